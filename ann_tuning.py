@@ -0,0 +1,327 @@
+import os
+import re
+import json
+import time
+import argparse
+import threading
+from datetime import datetime, timezone
+import numpy as np
+import psycopg2
+from pgvector.psycopg2 import register_vector
+from dotenv import load_dotenv
+from metrics import registry
+
+load_dotenv()
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+KINDS = ["folders", "files", "commits"]
+KEY_COLUMNS = {
+    "folders": ['"name"'],
+    "files": ['"folder"', '"name"'],
+    "commits": ['"id"'],
+}
+
+# Default sweeps: the query-time parameter of each index type, and ivfflat lists to rebuild with
+SWEEPS = {
+    "hnsw": ("hnsw.ef_search", [10, 20, 40, 80, 160, 320]),
+    "ivfflat": ("ivfflat.probes", [1, 2, 4, 8, 16, 32, 64]),
+}
+SAMPLE_SIZE = 50
+TOP_K = 20
+TARGET_RECALL = 0.95
+
+# How long the query path reuses the settings it loaded for a repo
+SETTINGS_TTL = 300
+# Retrievals slower than this are logged with their plan, at most once per interval per repo and kind
+SLOW_RETRIEVAL_MS = float(os.getenv("SLOW_RETRIEVAL_MS", "250"))
+SLOW_RETRIEVAL_LOG = os.getenv("SLOW_RETRIEVAL_LOG", "slow_retrievals.jsonl")
+SLOW_RETRIEVAL_EXPLAIN_INTERVAL = 60
+
+FETCH_SETTINGS = """SELECT "settings" FROM retrieval_settings WHERE "repo" = %s AND "kind" = %s AND "provider" = %s"""
+FETCH_SETTINGS_ASYNC = """SELECT "settings" FROM retrieval_settings WHERE "repo" = $1 AND "kind" = $2 AND "provider" = $3"""
+SET_CONFIG = """SELECT set_config(%s, %s, true)"""
+SET_CONFIG_ASYNC = """SELECT set_config($1, $2, true)"""
+UPSERT_SETTINGS = """
+    INSERT INTO retrieval_settings ("repo", "kind", "provider", "settings", "index_options", "recall", "p50_ms", "p95_ms")
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    ON CONFLICT ("repo", "kind", "provider") DO UPDATE SET "settings" = EXCLUDED."settings", "index_options" = EXCLUDED."index_options",
+        "recall" = EXCLUDED."recall", "p50_ms" = EXCLUDED."p50_ms", "p95_ms" = EXCLUDED."p95_ms", "tuned_at" = now();
+"""
+FETCH_VECTOR_INDEX = """
+    SELECT i.relname, am.amname, pg_get_indexdef(i.oid)
+    FROM pg_index x
+    JOIN pg_class i ON i.oid = x.indexrelid
+    JOIN pg_am am ON am.oid = i.relam
+    WHERE x.indrelid = %s::regclass AND am.amname IN ('hnsw', 'ivfflat')
+      AND pg_get_indexdef(i.oid) LIKE %s
+"""
+
+_settings = {}
+_settings_lock = threading.Lock()
+_slow_logged_at = {}
+
+
+# Query path
+
+def cached_settings(repo, kind, provider):
+    """
+    Returns the cached settings for a search, or None when they need to be (re)loaded.
+    """
+    with _settings_lock:
+        cached = _settings.get((repo, kind, provider))
+    if cached and time.monotonic() - cached[1] < SETTINGS_TTL:
+        return cached[0]
+    return None
+
+
+def cache_settings(repo, kind, provider, settings):
+    with _settings_lock:
+        _settings[(repo, kind, provider)] = (settings or {}, time.monotonic())
+    return settings or {}
+
+
+def apply_settings(cur, repo, kind, provider):
+    """
+    SETs the tuned parameters for the current transaction and returns them.
+    """
+    settings = cached_settings(repo, kind, provider)
+    if settings is None:
+        cur.execute(FETCH_SETTINGS, (repo, kind, provider))
+        row = cur.fetchone()
+        settings = cache_settings(repo, kind, provider, row[0] if row else None)
+    for name, value in settings.items():
+        cur.execute(SET_CONFIG, (name, str(value)))
+    return settings
+
+
+async def apply_settings_async(conn, repo, kind, provider):
+    settings = cached_settings(repo, kind, provider)
+    if settings is None:
+        row = await conn.fetchrow(FETCH_SETTINGS_ASYNC, repo, kind, provider)
+        settings = cache_settings(repo, kind, provider,
+                                  json.loads(row[0]) if row else None)
+    for name, value in settings.items():
+        await conn.execute(SET_CONFIG_ASYNC, name, str(value))
+    return settings
+
+
+def is_slow(repo, kind, provider, seconds):
+    """
+    Counts a slow retrieval and returns whether its plan should be captured now.
+    """
+    if seconds * 1000 < SLOW_RETRIEVAL_MS:
+        return False
+    registry.inc("slow_retrievals_total", kind=kind, provider=provider)
+    key = (repo, kind, provider)
+    now = time.monotonic()
+    with _settings_lock:
+        if now - _slow_logged_at.get(key, -SLOW_RETRIEVAL_EXPLAIN_INTERVAL) < SLOW_RETRIEVAL_EXPLAIN_INTERVAL:
+            return False
+        _slow_logged_at[key] = now
+    return True
+
+
+def log_slow_retrieval(repo, kind, provider, seconds, settings, plan):
+    record = {
+        "at": datetime.now(timezone.utc).isoformat(),
+        "repo": repo,
+        "kind": kind,
+        "provider": provider,
+        "ms": round(seconds * 1000, 1),
+        "settings": settings,
+        "plan": plan,
+    }
+    print(f"Slow {kind} retrieval for '{repo}' ({provider}): {record['ms']} ms")
+    with _settings_lock:
+        with open(SLOW_RETRIEVAL_LOG, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + "\n")
+
+
+def run_retrieval(cur, repo, kind, provider, query, params):
+    """
+    Runs a vector search with the repo's tuned settings; slow searches are logged with
+    their EXPLAIN plan. The cursor must be inside a transaction (psycopg2's default).
+    """
+    settings = apply_settings(cur, repo, kind, provider)
+    start = time.perf_counter()
+    cur.execute(query, params)
+    rows = cur.fetchall()
+    seconds = time.perf_counter() - start
+    if is_slow(repo, kind, provider, seconds):
+        cur.execute("EXPLAIN " + query, params)
+        plan = "\n".join(row[0] for row in cur.fetchall())
+        log_slow_retrieval(repo, kind, provider, seconds, settings, plan)
+    return rows
+
+
+async def run_retrieval_async(conn, repo, kind, provider, query, *args):
+    async with conn.transaction():
+        settings = await apply_settings_async(conn, repo, kind, provider)
+        start = time.perf_counter()
+        rows = await conn.fetch(query, *args)
+        seconds = time.perf_counter() - start
+        if is_slow(repo, kind, provider, seconds):
+            plan = "\n".join(row[0] for row in await conn.fetch("EXPLAIN " + query, *args))
+            log_slow_retrieval(repo, kind, provider, seconds, settings, plan)
+    return rows
+
+
+# Tuner
+
+def connect():
+    conn = psycopg2.connect(DATABASE_URL)
+    register_vector(conn)
+    return conn
+
+
+def find_vector_index(cur, kind, provider):
+    cur.execute(FETCH_VECTOR_INDEX, (kind, f"%vector_{provider}%"))
+    return cur.fetchone()
+
+
+def sample_queries(cur, repo, kind, provider, sample_size):
+    cur.execute(f"""SELECT vector_{provider} FROM {kind} WHERE "repo" = %s AND vector_{provider} IS NOT NULL ORDER BY random() LIMIT %s""",
+                (repo, sample_size))
+    return [row[0] for row in cur.fetchall()]
+
+
+def search(cur, repo, kind, provider, vector, top_k):
+    keys = ", ".join(KEY_COLUMNS[kind])
+    start = time.perf_counter()
+    cur.execute(f"""SELECT {keys} FROM {kind} WHERE "repo" = %s ORDER BY vector_{provider} <-> %s LIMIT %s""",
+                (repo, vector, top_k))
+    rows = cur.fetchall()
+    return rows, time.perf_counter() - start
+
+
+def exact_neighbours(cur, repo, kind, provider, queries, top_k):
+    """
+    Ground truth: the true top_k for each query, with index scans disabled.
+    """
+    cur.execute("SET LOCAL enable_indexscan = off")
+    truth = [set(search(cur, repo, kind, provider, vector, top_k)[0])
+             for vector in queries]
+    cur.execute("RESET enable_indexscan")
+    return truth
+
+
+def measure(cur, repo, kind, provider, queries, truth, top_k, parameter, value):
+    cur.execute(SET_CONFIG, (parameter, str(value)))
+    recalls, latencies = [], []
+    for vector, expected in zip(queries, truth):
+        rows, seconds = search(cur, repo, kind, provider, vector, top_k)
+        latencies.append(seconds * 1000)
+        recalls.append(len(expected & set(rows)) / len(expected) if expected else 1.0)
+    p50, p95 = np.percentile(latencies, [50, 95])
+    return {"value": value, "recall": float(np.mean(recalls)), "p50_ms": float(p50), "p95_ms": float(p95)}
+
+
+def print_curve(label, parameter, points):
+    print(f"\n{label}")
+    print(f"  {parameter:<16}{'recall':>8}{'p50 ms':>10}{'p95 ms':>10}")
+    for point in points:
+        print(f"  {point['value']:<16}{point['recall']:>8.3f}{point['p50_ms']:>10.1f}{point['p95_ms']:>10.1f}")
+
+
+def choose(points, target_recall):
+    """
+    The cheapest point that reaches the target recall, else the one with the best recall.
+    """
+    reaching = [p for p in points if p["recall"] >= target_recall]
+    if reaching:
+        return min(reaching, key=lambda p: p["p95_ms"])
+    return max(points, key=lambda p: (p["recall"], -p["p95_ms"]))
+
+
+def rebuild_ivfflat(cur, index_name, index_definition, lists):
+    """
+    Replaces the index inside the current transaction; rolling back restores the original.
+    This holds an exclusive lock on the table until then.
+    """
+    cur.execute(f'DROP INDEX "{index_name}"')
+    definition = re.sub(r"\s+WITH \(.*?\)", "", index_definition)
+    cur.execute(f"{definition} WITH (lists = {int(lists)})")
+    cur.execute(f"ANALYZE {index_definition.split(' ON ')[1].split()[0]}")
+
+
+def tune(repo, kind, provider, sample_size=SAMPLE_SIZE, top_k=TOP_K, target_recall=TARGET_RECALL,
+         values=None, lists=None, save=False):
+    conn = connect()
+    try:
+        with conn.cursor() as cur:
+            index = find_vector_index(cur, kind, provider)
+            if not index:
+                print(f"\n{kind}.vector_{provider}: no hnsw or ivfflat index, searches are exact.")
+                return None
+            index_name, method, index_definition = index
+            parameter, default_values = SWEEPS[method]
+            values = values or default_values
+
+            queries = sample_queries(cur, repo, kind, provider, sample_size)
+            if not queries:
+                print(f"\n{kind}.vector_{provider}: no embedded rows in '{repo}'.")
+                return None
+            truth = exact_neighbours(
+                cur, repo, kind, provider, queries, top_k)
+
+            candidates = []
+            for lists_value in (lists if method == "ivfflat" and lists else [None]):
+                if lists_value:
+                    rebuild_ivfflat(cur, index_name,
+                                    index_definition, lists_value)
+                points = [measure(cur, repo, kind, provider, queries, truth, top_k, parameter, value)
+                          for value in values]
+                label = f"{kind}.vector_{provider} ({method} {index_name}" + \
+                    (f", lists = {lists_value})" if lists_value else ")")
+                print_curve(label, parameter, points)
+                best = choose(points, target_recall)
+                candidates.append((best, lists_value))
+                # Undo the rebuild (and the SET LOCALs) before trying the next lists value
+                conn.rollback()
+
+        best = choose([point for point, _ in candidates], target_recall)
+        lists_value = next(l for point, l in candidates if point is best)
+        settings = {parameter: best["value"]}
+        index_options = {"lists": lists_value} if lists_value else {}
+        print(f"Chosen for '{repo}' {kind} ({provider}): {parameter} = {best['value']}"
+              + (f", lists = {lists_value}" if lists_value else "")
+              + f" (recall {best['recall']:.3f}, p95 {best['p95_ms']:.1f} ms)")
+
+        if save:
+            with conn.cursor() as cur:
+                cur.execute(UPSERT_SETTINGS, (repo, kind, provider, json.dumps(settings), json.dumps(index_options),
+                                              best["recall"], best["p50_ms"], best["p95_ms"]))
+            conn.commit()
+        return settings
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Sweep vector index parameters per repo and report recall against latency.")
+    parser.add_argument("repo", help="The repository to tune.")
+    parser.add_argument("--provider", choices=['openai', 'ubicloud'],
+                        help="Only tune one provider's vectors (default: both).")
+    parser.add_argument("--kind", choices=KINDS, action="append",
+                        help="Only tune these tables (repeatable; default: all).")
+    parser.add_argument("--sample", type=int, default=SAMPLE_SIZE,
+                        help="Stored vectors to use as queries.")
+    parser.add_argument("--top-k", type=int, default=TOP_K,
+                        help="Neighbours per query that recall is measured on.")
+    parser.add_argument("--target-recall", type=float, default=TARGET_RECALL,
+                        help="Pick the fastest setting with at least this recall.")
+    parser.add_argument("--values", help="Comma-separated ef_search or probes values to sweep.")
+    parser.add_argument("--lists", help="Comma-separated ivfflat lists values to rebuild with "
+                        "(inside a rolled-back transaction; locks the table while it runs).")
+    parser.add_argument("--save", action="store_true",
+                        help="Store the chosen settings for the query path.")
+
+    args = parser.parse_args()
+    providers = [args.provider] if args.provider else ["openai", "ubicloud"]
+    values = [int(v) for v in args.values.split(",")] if args.values else None
+    lists = [int(v) for v in args.lists.split(",")] if args.lists else None
+    for kind in args.kind or KINDS:
+        for provider in providers:
+            tune(args.repo, kind, provider, args.sample, args.top_k,
+                 args.target_recall, values, lists, args.save)
@@ -1,16 +1,51 @@
+import os
+import asyncio
+from contextlib import asynccontextmanager
 import gradio as gr
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
 from dotenv import load_dotenv
-from ask_question import ask_question
+from ask_question import fetch_repo_names
+from ask_question_async import ask_question_async
+from metrics import start_http_server
+from warmup import warm_up, readiness
 
 load_dotenv()
 
+# Concurrent requests per event handler
+APP_CONCURRENCY_LIMIT = 64
+APP_HOST = os.getenv("GRADIO_SERVER_NAME", "127.0.0.1")
+APP_PORT = int(os.getenv("GRADIO_SERVER_PORT", "7860"))
 
-def chat_with_context(provider, repo, question, context_types):
-    return ask_question(provider, repo, question, context_types, return_prompt=True)
+# With APP_REPOS_FROM_DB=1 the repo choices come from the repos table instead of this list
+DEFAULT_REPOS = ["pg_cron", "citus", "ubicloud"]
 
 
-def chat_without_context(provider, repo, question):
-    return ask_question(provider, repo, question, [])
+def load_repos():
+    if os.getenv("APP_REPOS_FROM_DB") != "1":
+        return DEFAULT_REPOS
+    try:
+        return fetch_repo_names() or DEFAULT_REPOS
+    except Exception as e:
+        print(f"Could not load repos from the database, using the defaults: {e}")
+        return DEFAULT_REPOS
+
+
+REPOS = load_repos()
+
+
+# Handlers are coroutines so Gradio runs them on its event loop instead of a worker thread.
+def chat_with_context(provider):
+    async def handler(repo, question, context_types):
+        return await ask_question_async(provider, repo, question, context_types, return_prompt=True)
+    return handler
+
+
+def chat_without_context(provider):
+    async def handler(repo, question):
+        return await ask_question_async(provider, repo, question, [])
+    return handler
 
 
 # Define the Gradio interface.
@@ -18,8 +53,8 @@ with gr.Blocks() as demo:
     gr.Markdown("# Chat Interface with Ubicloud and OpenAI")
 
     # First row: Repository selection
-    repo = gr.Radio(["pg_cron", "citus", "ubicloud"],
-                    label="Select Repository", value="pg_cron", interactive=True)
+    repo = gr.Radio(REPOS, label="Select Repository",
+                    value=REPOS[0], interactive=True)
 
     # Second row: Question input
     question = gr.Textbox(
@@ -77,56 +112,70 @@ with gr.Blocks() as demo:
 
     # Function calls for each of the output panels
     submit_btn.click(
-        fn=lambda repo, question: chat_without_context(
-            "openai", repo, question),
+        fn=chat_without_context("openai"),
         inputs=[repo, question],
         outputs=output_openai_no_context
     )
     submit_btn.click(
-        fn=lambda repo, question: chat_without_context(
-            "ubicloud", repo, question),
+        fn=chat_without_context("ubicloud"),
         inputs=[repo, question],
         outputs=output_ubicloud_no_context
     )
     submit_btn.click(
-        fn=lambda repo, question, context_types: chat_with_context(
-            "openai", repo, question, context_types),
+        fn=chat_with_context("openai"),
         inputs=[repo, question, context_types],
         outputs=[output_openai_with_context, output_openai_with_context_prompt]
     )
     submit_btn.click(
-        fn=lambda repo, question, context_types: chat_with_context(
-            "ubicloud", repo, question, context_types),
+        fn=chat_with_context("ubicloud"),
         inputs=[repo, question, context_types],
         outputs=[output_ubicloud_with_context,
                  output_ubicloud_with_context_prompt]
     )
 
     question.submit(
-        fn=lambda repo, question: chat_without_context(
-            "openai", repo, question),
+        fn=chat_without_context("openai"),
         inputs=[repo, question],
         outputs=output_openai_no_context
     )
     question.submit(
-        fn=lambda repo, question: chat_without_context(
-            "ubicloud", repo, question),
+        fn=chat_without_context("ubicloud"),
         inputs=[repo, question],
         outputs=output_ubicloud_no_context
     )
     question.submit(
-        fn=lambda repo, question, context_types: chat_with_context(
-            "openai", repo, question, context_types),
+        fn=chat_with_context("openai"),
         inputs=[repo, question, context_types],
         outputs=[output_openai_with_context, output_openai_with_context_prompt]
     )
     question.submit(
-        fn=lambda repo, question, context_types: chat_with_context(
-            "ubicloud", repo, question, context_types),
+        fn=chat_with_context("ubicloud"),
         inputs=[repo, question, context_types],
         outputs=[output_ubicloud_with_context,
                  output_ubicloud_with_context_prompt]
     )
 
-# Launch the Gradio app.
-demo.launch()
+# The Gradio app is mounted on our own FastAPI app, so the warm-up runs on the same event
+# loop as the handlers (the pool and HTTP clients it opens belong to that loop) and the
+# /ready endpoint can report when it's done.
+@asynccontextmanager
+async def lifespan(app):
+    warm_up_task = asyncio.create_task(warm_up(REPOS))
+    yield
+    warm_up_task.cancel()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.get("/ready")
+async def ready():
+    return JSONResponse(readiness, status_code=200 if readiness["ready"] else 503)
+
+
+# Expose metrics next to the app, then launch the Gradio app. The handlers don't hold a
+# thread while they wait, so let many of them run at once instead of Gradio's default of 1.
+start_http_server()
+demo.queue(default_concurrency_limit=APP_CONCURRENCY_LIMIT)
+app = gr.mount_gradio_app(app, demo, path="/")
+uvicorn.run(app, host=APP_HOST, port=APP_PORT)
@@ -1,20 +1,54 @@
 import os
-import sys
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from pgvector.psycopg2 import register_vector
 import psycopg2
 from dotenv import load_dotenv
 from contextlib import contextmanager
-from pgconf_utils import generate_openai_embedding, generate_ubicloud_embedding, ask_openai, ask_ubicloud
+from pgconf_utils import generate_openai_embedding, generate_ubicloud_embedding, generate_openai_embeddings, generate_ubicloud_embeddings, ask_openai, ask_ubicloud, fallback_provider, provider_health, CONTEXT_TOKEN_BUDGETS, MAX_CONCURRENT_REQUESTS
+from context_assembler import assemble_context
+from metrics import TracedCursor, traced, print_summary, registry
+from snapshot import SnapshotStore
+from ann_tuning import run_retrieval
 
 # Load environment variables
 load_dotenv()
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Number of nearest neighbours fetched per context type before diversity selection
+CANDIDATES_PER_TYPE = 20
+# Questions embedded and retrieved per round trip in bulk mode
+BATCH_SIZE = 64
+
+# Where query_files/folders/commits search: "postgres" (pgvector) or "snapshot", which
+# searches the memory-mapped export from snapshot.py in process and only asks the database
+# for repos.updated_at now and then
+RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "postgres")
+_snapshot_store = None
+
+# "flat" searches files across the whole repo; "hierarchical" first picks the COARSE_FOLDERS
+# nearest folders and only searches files in their subtrees, falling back to the whole repo
+# when the nearest folder is further than COARSE_MAX_DISTANCE (L2 between unit vectors)
+# or the subtrees hold too few files
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "flat")
+COARSE_FOLDERS = 5
+COARSE_MAX_DISTANCE = 1.2
+
+SYSTEM_PROMPT = "You are a helpful agent who answers questions about the {repo} codebase. You will be given context about the codebase and asked questions about it. Please provide detailed answers to the best of your ability."
+# How long a cached system prompt is reused before the repo overview is re-read
+SYSTEM_PROMPT_TTL = 300
+# Prepended to answers that came from the fallback provider
+FALLBACK_NOTE = "_{provider} is unavailable right now; this answer is from {fallback}._\n\n"
+_system_prompts = {}
+
 
 @contextmanager
 def get_cursor():
-    conn = psycopg2.connect(DATABASE_URL)
+    conn = psycopg2.connect(DATABASE_URL, cursor_factory=TracedCursor)
     register_vector(conn)
     cur = conn.cursor()
     try:
@@ -24,25 +58,107 @@ def get_cursor():
         conn.close()
 
 
-def query_files(provider, repo, vector, top_k=5):
-    FETCH_FILES = f"""
-        SELECT "name", "code", "folder", llm_{provider}
-        FROM files 
-        WHERE repo = %s
-        ORDER BY vector_{provider} <-> %s
-        LIMIT %s
+def snapshot_store():
+    global _snapshot_store
+    if _snapshot_store is None:
+        _snapshot_store = SnapshotStore()
+    return _snapshot_store
+
+
+def set_retrieval_backend(backend):
+    global RETRIEVAL_BACKEND
+    if backend not in ["postgres", "snapshot"]:
+        raise ValueError("Invalid backend. Must be 'postgres' or 'snapshot'.")
+    RETRIEVAL_BACKEND = backend
+
+
+def like_escape(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+@traced("query_files")
+def query_files(provider, repo, vector, top_k=5, folders=None):
+    """
+    Nearest files in the repo or, with `folders`, only in those folders' subtrees.
     """
+    if RETRIEVAL_BACKEND == "snapshot":
+        return snapshot_store().search("files", provider, repo, vector, top_k, folders)
     if type(vector) == list:
         vector = np.array(vector)
+    if folders is None:
+        FETCH_FILES = f"""
+            SELECT "name", "folder", llm_{provider}, vector_{provider}
+            FROM files 
+            WHERE repo = %s
+            ORDER BY vector_{provider} <-> %s
+            LIMIT %s
+        """
+        params = (repo, vector, top_k)
+    else:
+        # The subtree is resolved against the small folders table first, so the files
+        # search is an equality match the files (repo, folder, name) index can serve
+        FETCH_FILES = f"""
+            WITH scope AS (
+                SELECT "name" FROM folders
+                WHERE repo = %s AND ("name" = ANY(%s) OR "name" LIKE ANY(%s))
+            )
+            SELECT "name", "folder", llm_{provider}, vector_{provider}
+            FROM files
+            WHERE repo = %s AND "folder" IN (SELECT "name" FROM scope)
+            ORDER BY vector_{provider} <-> %s
+            LIMIT %s
+        """
+        prefixes = [like_escape(folder) + '/%' for folder in folders]
+        params = (repo, list(folders), prefixes, repo, vector, top_k)
     with get_cursor() as cur:
-        cur.execute(FETCH_FILES, (repo, vector, top_k))
-        files = cur.fetchall()
+        files = run_retrieval(cur, repo, "files", provider, FETCH_FILES, params)
         return files
 
 
+def coarse_scope(vector, folders):
+    """
+    Picks the subtrees to search from folder rows sorted by distance, or returns None when
+    the match is too weak (or includes the repo root) to narrow the search safely.
+    """
+    folders = folders[:COARSE_FOLDERS]
+    if not folders:
+        return None
+    query = np.asarray(vector, dtype=np.float32)
+    best = np.linalg.norm(np.asarray(folders[0][2], dtype=np.float32) - query)
+    if best > COARSE_MAX_DISTANCE:
+        return None
+    names = [row[0] for row in folders]
+    if "." in names:
+        return None
+    # A folder inside another selected folder is already part of that subtree
+    return [name for name in names
+            if not any(name.startswith(other + "/") for other in names)]
+
+
+def query_files_hierarchical(provider, repo, vector, top_k=5, folders=None):
+    """
+    Coarse-to-fine file search: the nearest folders (reusing `folders` rows when the caller
+    already fetched them), then files within their subtrees, else the whole repo.
+    """
+    if folders is None:
+        folders = query_folders(provider, repo, vector, COARSE_FOLDERS)
+    scope = coarse_scope(vector, folders)
+    if scope is None:
+        registry.inc("hierarchical_fallbacks_total", reason="low_confidence")
+        return query_files(provider, repo, vector, top_k)
+    files = query_files(provider, repo, vector, top_k, scope)
+    if len(files) < top_k:
+        registry.inc("hierarchical_fallbacks_total", reason="too_few_files")
+        return query_files(provider, repo, vector, top_k)
+    return files
+
+
+@traced("query_folders")
 def query_folders(provider, repo, vector, top_k=5):
+    if RETRIEVAL_BACKEND == "snapshot":
+        return snapshot_store().search("folders", provider, repo, vector, top_k)
     FETCH_FOLDERS = f"""
-        SELECT "name", llm_{provider}
+        SELECT "name", llm_{provider}, vector_{provider}
         FROM folders 
         WHERE repo = %s
         ORDER BY vector_{provider} <-> %s
@@ -51,56 +167,116 @@ def query_folders(provider, repo, vector, top_k=5):
     if type(vector) == list:
         vector = np.array(vector)
     with get_cursor() as cur:
-        cur.execute(FETCH_FOLDERS, (repo, vector, top_k))
-        folders = cur.fetchall()
+        folders = run_retrieval(cur, repo, "folders", provider,
+                                FETCH_FOLDERS, (repo, vector, top_k))
         return folders
 
 
-def query_commits(provider, repo, vector, top_k=5):
+def commit_filter_clauses(since=None, until=None, author=None, paths=None):
+    """
+    SQL conditions for the commit filters as (clause, values) pairs, with one `{}` in the
+    clause per value so both psycopg2 (%s) and asyncpg ($n) placeholders can be filled in.
+    Each condition is served by an index, so the vector ordering only sees matching commits.
+    """
+    clauses = []
+    if since:
+        clauses.append(('"committed_at" >= {}::text::timestamptz', [since]))
+    if until:
+        clauses.append(('"committed_at" < {}::text::timestamptz', [until]))
+    if author:
+        clauses.append(('("author_name" = {} OR "author_email" = {})', [author, author]))
+    if paths:
+        paths = [path.strip("/").removeprefix("./") for path in paths]
+        clauses.append(
+            ('("files_changed" && {}::text[] OR "folders_changed" && {}::text[])', [paths, paths]))
+    return clauses
+
+
+@traced("query_commits")
+def query_commits(provider, repo, vector, top_k=5, since=None, until=None, author=None, paths=None):
+    """
+    Nearest commits, optionally only those committed in [since, until), by an author (name
+    or email), or touching any of the given files or folders.
+    """
+    clauses = commit_filter_clauses(since, until, author, paths)
+    # Snapshots don't carry commit metadata, so filtered searches always go to Postgres
+    if RETRIEVAL_BACKEND == "snapshot" and not clauses:
+        return snapshot_store().search("commits", provider, repo, vector, top_k)
+    filters = "".join(" AND " + clause.format(*["%s"] * len(values))
+                      for clause, values in clauses)
     FETCH_COMMITS = f"""
-        SELECT "repo", "id", llm_{provider}
+        SELECT "repo", "id", llm_{provider}, vector_{provider}
         FROM commits 
-        WHERE repo = %s
+        WHERE repo = %s{filters}
         ORDER BY vector_{provider} <-> %s
         LIMIT %s
     """
     if type(vector) == list:
         vector = np.array(vector)
+    params = [repo] + [value for _, values in clauses for value in values]
     with get_cursor() as cur:
-        cur.execute(FETCH_COMMITS, (repo, vector, top_k))
-        commits = cur.fetchall()
+        commits = run_retrieval(cur, repo, "commits", provider,
+                                FETCH_COMMITS, params + [vector, top_k])
         return commits
 
 
-def get_prompt(provider: str, repo: str, question: str, context_types) -> str:
+def make_candidate(kind, name, description, vector, folder=None):
+    if kind == "folder":
+        text = f"FOLDER: {name}\nDESCRIPTION: {description}"
+    elif kind == "file":
+        text = f"FILE: {name}\nFOLDER: {folder}\nDESCRIPTION:\n{description}"
+    else:
+        text = f"COMMIT: {name}\nDESCRIPTION: {description}"
+    return {"kind": kind, "name": name, "folder": folder, "vector": vector, "text": text}
+
+
+@traced("get_prompt")
+def get_prompt(provider: str, repo: str, question: str, context_types, commit_filters=None) -> str:
     if provider not in ["openai", "ubicloud"]:
         raise ValueError("Invalid provider. Must be 'openai' or 'ubicloud'.")
 
     vector = generate_openai_embedding(
         question) if provider == "openai" else generate_ubicloud_embedding(question)
 
-    context = []
+    candidates = []
+    folders = None
 
     if "folders" in context_types:
-        folders = query_folders(provider, repo, vector)
-        for folder in folders:
-            name, description = folder
-            context.append(f"FOLDER: {name}\nDESCRIPTION: {description}")
+        folders = query_folders(provider, repo, vector, CANDIDATES_PER_TYPE)
+        for name, description, folder_vector in folders:
+            candidates.append(make_candidate(
+                "folder", name, description, folder_vector))
 
     if "files" in context_types:
-        files = query_files(provider, repo, vector)
-        for file in files:
-            name, code, folder_name, description = file
-            context.append(
-                f"FILE: {name}\nFOLDER: {folder_name}\nDESCRIPTION:\n{description}")
+        if RETRIEVAL_MODE == "hierarchical":
+            files = query_files_hierarchical(
+                provider, repo, vector, CANDIDATES_PER_TYPE, folders)
+        else:
+            files = query_files(provider, repo, vector, CANDIDATES_PER_TYPE)
+        for name, folder_name, description, file_vector in files:
+            candidates.append(make_candidate(
+                "file", name, description, file_vector, folder_name))
 
     if "commits" in context_types:
-        commits = query_commits(provider, repo, vector)
-        for commit in commits:
-            repo, commit_id, description = commit
-            context.append(
-                f"COMMIT: {commit_id}\nDESCRIPTION: {description}\n\n")
+        commits = query_commits(
+            provider, repo, vector, CANDIDATES_PER_TYPE, **(commit_filters or {}))
+        for _, commit_id, description, commit_vector in commits:
+            candidates.append(make_candidate(
+                "commit", commit_id, description, commit_vector))
+
+    # Pick a diverse subset of the candidates that fits the provider's token budget
+    context = [c["text"] for c in assemble_context(
+        vector, candidates, CONTEXT_TOKEN_BUDGETS[provider])]
 
+    return build_prompt(repo, question, context)
+
+
+def build_prompt(repo: str, question: str, context) -> str:
+    """
+    The per-question part of the prompt: the retrieved context, then the question. Only the
+    system prompt before it is the same across questions and can be served from the
+    provider's prefix cache.
+    """
     context_count = len(context)
     if context_count == 0:
         return f"Answer the question about the {repo} repo: {question}"
@@ -109,41 +285,312 @@ def get_prompt(provider: str, repo: str, question: str, context_types) -> str:
         map(lambda i: f"**CONTEXT {i + 1} / {context_count}**\n" +
             context[i], range(context_count))
     )
-    prompt = '\n'.join([f"Answer the question about the {repo} repo using the provided context. Cite specific portions of the given context if they were relevant to answering the question.",
+    prompt = '\n'.join([context_string,
                         '-------------------------------',
+                        f"Answer the question about the {repo} repo using the provided context. Cite specific portions of the given context if they were relevant to answering the question.",
                         '**QUESTION**: ' + question,
-                        '-------------------------------',
-                        context_string,
                         ])
     return prompt
 
 
-def ask_question(provider: str, repo: str, question: str, context_types, return_prompt=False) -> str:
+def fetch_repo_names():
+    with get_cursor() as cur:
+        cur.execute("""SELECT "name" FROM repos ORDER BY "name" """)
+        return [row[0] for row in cur.fetchall()]
+
+
+def fetch_repo_overview(provider, repo):
+    with get_cursor() as cur:
+        cur.execute(
+            f"""SELECT overview_{provider} FROM repos WHERE "name" = %s""", (repo,))
+        row = cur.fetchone()
+        return row[0] if row else None
+
+
+def get_system_prompt(provider: str, repo: str, with_overview=True) -> str:
+    """
+    The stable, per-repo prefix shared by every question about the repo: fixed instructions
+    followed by the overview precomputed at ingestion time. Cached per process. Questions
+    asked without context get the instructions only, so they really have no repo context.
+    """
+    if not with_overview:
+        return format_system_prompt(repo, None)
+    key = (provider, repo)
+    cached = _system_prompts.get(key)
+    if cached and time.monotonic() - cached[1] < SYSTEM_PROMPT_TTL:
+        return cached[0]
+
+    system_prompt = format_system_prompt(
+        repo, fetch_repo_overview(provider, repo))
+    _system_prompts[key] = (system_prompt, time.monotonic())
+    return system_prompt
+
+
+def format_system_prompt(repo: str, overview) -> str:
+    system_prompt = SYSTEM_PROMPT.format(repo=repo)
+    if overview:
+        system_prompt += f"\n\n**OVERVIEW OF THE {repo} REPO**\n{overview}"
+    return system_prompt
+
+
+@traced("ask_question")
+def ask_question(provider: str, repo: str, question: str, context_types, return_prompt=False, commit_filters=None) -> str:
     if provider not in ["openai", "ubicloud"]:
         raise ValueError("Invalid provider. Must be 'openai' or 'ubicloud'.")
 
-    user_prompt = get_prompt(provider, repo, question, context_types)
-    system_prompt = f"You are a helpful agent who answers questions about the {repo} codebase. You will be given context about the codebase and asked questions about it. Please provide detailed answers to the best of your ability."
-    ask = ask_openai if provider == "openai" else ask_ubicloud
-    answer = ask(system_prompt, user_prompt)
+    fallback = fallback_provider(provider)
+    if fallback and not provider_health.allow(provider):
+        answer, user_prompt = answer_with_fallback(
+            provider, fallback, repo, question, context_types, commit_filters)
+    else:
+        try:
+            answer, user_prompt = answer_question(
+                provider, repo, question, context_types, commit_filters)
+            provider_health.record(provider, True)
+        except Exception as e:
+            provider_health.record(provider, False)
+            if not fallback:
+                raise
+            print(f"{provider} failed ({e}), falling back to {fallback}")
+            answer, user_prompt = answer_with_fallback(
+                provider, fallback, repo, question, context_types, commit_filters)
     if return_prompt:
         return answer, user_prompt
     return answer
 
 
+def answer_question(provider, repo, question, context_types, commit_filters=None):
+    user_prompt = get_prompt(provider, repo, question,
+                             context_types, commit_filters)
+    system_prompt = get_system_prompt(provider, repo, bool(context_types))
+    ask = ask_openai if provider == "openai" else ask_ubicloud
+    return ask(system_prompt, user_prompt), user_prompt
+
+
+def answer_with_fallback(provider, fallback, repo, question, context_types, commit_filters=None):
+    """
+    Answers with the other provider end to end: its embeddings live in their own vector
+    columns, so retrieval has to switch providers along with the LLM.
+    """
+    registry.inc("provider_fallbacks_total",
+                 provider=provider, fallback=fallback)
+    answer, user_prompt = answer_question(
+        fallback, repo, question, context_types, commit_filters)
+    return FALLBACK_NOTE.format(provider=provider, fallback=fallback) + answer, user_prompt
+
+
+def vector_literal(vector):
+    return '[' + ','.join(str(float(x)) for x in vector) + ']'
+
+
+@traced("query_context_batch")
+def query_context_batch(provider, repo, vectors, context_types, top_k=CANDIDATES_PER_TYPE):
+    """
+    Retrieves the nearest folders, files and commits for a whole batch of query vectors
+    in a single statement, running one index scan per query vector via LATERAL joins.
+    Returns a list of candidate lists, one per vector.
+    """
+    kinds = [kind for kind in ["folders", "files", "commits"]
+             if kind in context_types]
+    if not kinds:
+        return [[] for _ in vectors]
+    if RETRIEVAL_BACKEND == "snapshot":
+        return [query_context_snapshot(provider, repo, vector, kinds, top_k) for vector in vectors]
+
+    subqueries = {
+        "folders": f"""
+            SELECT q.idx, 'folder' AS kind, c."name", NULL AS folder, c.description, c.vector
+            FROM q CROSS JOIN LATERAL (
+                SELECT "name", llm_{provider} AS description, vector_{provider} AS vector
+                FROM folders WHERE repo = %(repo)s
+                ORDER BY vector_{provider} <-> q.vec LIMIT %(top_k)s
+            ) c""",
+        "files": f"""
+            SELECT q.idx, 'file' AS kind, c."name", c."folder", c.description, c.vector
+            FROM q CROSS JOIN LATERAL (
+                SELECT "name", "folder", llm_{provider} AS description, vector_{provider} AS vector
+                FROM files WHERE repo = %(repo)s
+                ORDER BY vector_{provider} <-> q.vec LIMIT %(top_k)s
+            ) c""",
+        "commits": f"""
+            SELECT q.idx, 'commit' AS kind, c."id", NULL AS folder, c.description, c.vector
+            FROM q CROSS JOIN LATERAL (
+                SELECT "id", llm_{provider} AS description, vector_{provider} AS vector
+                FROM commits WHERE repo = %(repo)s
+                ORDER BY vector_{provider} <-> q.vec LIMIT %(top_k)s
+            ) c""",
+    }
+    FETCH_CONTEXT_BATCH = f"""
+        WITH q AS (
+            SELECT vec::vector AS vec, idx
+            FROM unnest(%(vectors)s::text[]) WITH ORDINALITY AS u(vec, idx)
+        )
+        {" UNION ALL ".join(subqueries[kind] for kind in kinds)}
+    """
+
+    results = [[] for _ in vectors]
+    with get_cursor() as cur:
+        cur.execute(FETCH_CONTEXT_BATCH, {
+            "vectors": [vector_literal(vector) for vector in vectors],
+            "repo": repo,
+            "top_k": top_k,
+        })
+        for idx, kind, name, folder, description, vector in cur.fetchall():
+            results[idx - 1].append(make_candidate(
+                kind, name, description, vector, folder))
+    return results
+
+
+def query_context_snapshot(provider, repo, vector, kinds, top_k):
+    candidates = []
+    if "folders" in kinds:
+        for name, description, folder_vector in query_folders(provider, repo, vector, top_k):
+            candidates.append(make_candidate(
+                "folder", name, description, folder_vector))
+    if "files" in kinds:
+        for name, folder_name, description, file_vector in query_files(provider, repo, vector, top_k):
+            candidates.append(make_candidate(
+                "file", name, description, file_vector, folder_name))
+    if "commits" in kinds:
+        for _, commit_id, description, commit_vector in query_commits(provider, repo, vector, top_k):
+            candidates.append(make_candidate(
+                "commit", commit_id, description, commit_vector))
+    return candidates
+
+
+def read_questions(path):
+    """
+    Streams (id, question) pairs from a JSONL file. The question is taken from a
+    "question" field, falling back to "title"; the id from "id" or "request_id".
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            question = record.get("question") or record.get("title")
+            if question:
+                yield record.get("id") or record.get("request_id") or line_number, question
+
+
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def ask_questions_batch(provider, repo, questions_path, output_path, context_types,
+                        batch_size=BATCH_SIZE, max_concurrency=None):
+    """
+    Answers every question in a JSONL file. Questions are embedded and retrieved a batch at
+    a time while LLM calls for earlier batches are still running; each answer is appended
+    to the output file as soon as it arrives. At most 2 * max_concurrency answers are in
+    flight, so reading stops while the provider is saturated.
+    """
+    if provider not in ["openai", "ubicloud"]:
+        raise ValueError("Invalid provider. Must be 'openai' or 'ubicloud'.")
+
+    max_concurrency = max_concurrency or MAX_CONCURRENT_REQUESTS[provider]
+    embed = generate_openai_embeddings if provider == "openai" else generate_ubicloud_embeddings
+    ask = ask_openai if provider == "openai" else ask_ubicloud
+    system_prompt = get_system_prompt(provider, repo, bool(context_types))
+    budget = CONTEXT_TOKEN_BUDGETS[provider]
+
+    in_flight = threading.BoundedSemaphore(2 * max_concurrency)
+    output_lock = threading.Lock()
+    counts = {"answered": 0, "failed": 0}
+
+    with open(output_path, 'a', encoding='utf-8') as output, \
+            ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+
+        def write_result(record):
+            with output_lock:
+                output.write(json.dumps(record) + "\n")
+                output.flush()
+                counts["failed" if record["error"] else "answered"] += 1
+
+        def answer(question_id, question, user_prompt):
+            start = time.perf_counter()
+            record = {"id": question_id, "provider": provider, "repo": repo,
+                      "question": question, "answer": None, "error": None}
+            try:
+                record["answer"] = ask(system_prompt, user_prompt)
+            except Exception as e:
+                record["error"] = str(e)
+            finally:
+                record["latency"] = round(time.perf_counter() - start, 3)
+                write_result(record)
+                in_flight.release()
+
+        for batch in batched(read_questions(questions_path), batch_size):
+            try:
+                vectors = embed([question for _, question in batch])
+                candidates = query_context_batch(
+                    provider, repo, vectors, context_types)
+            except Exception as e:
+                for question_id, question in batch:
+                    write_result({"id": question_id, "provider": provider, "repo": repo,
+                                  "question": question, "answer": None, "error": str(e)})
+                continue
+
+            for (question_id, question), vector, question_candidates in zip(batch, vectors, candidates):
+                context = [c["text"] for c in assemble_context(
+                    vector, question_candidates, budget)]
+                user_prompt = build_prompt(repo, question, context)
+                in_flight.acquire()
+                executor.submit(answer, question_id, question, user_prompt)
+
+    print(f"Answered {counts['answered']} questions ({counts['failed']} failed), written to {output_path}.")
+    return counts
+
+
 if __name__ == '__main__':
-    if len(sys.argv) != 4:
-        print("Usage: python ask_question.py <provider> <repo> <question>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(
+        description="Ask a question about a repository, or answer a JSONL file of questions in bulk.")
+    parser.add_argument("provider", choices=['openai', 'ubicloud'],
+                        help="Specify the provider.")
+    parser.add_argument("repo", help="The repository to ask about.")
+    parser.add_argument("question", nargs='?',
+                        help="The question to ask (omit with --batch).")
+    parser.add_argument("--batch", help="JSONL file of questions to answer in bulk.")
+    parser.add_argument("--output", default="answers.jsonl",
+                        help="JSONL file the bulk answers are appended to.")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help="Questions embedded and retrieved per round trip.")
+    parser.add_argument("--concurrency", type=int,
+                        help="Concurrent LLM calls (default: the provider limit).")
+    parser.add_argument("--backend", choices=['postgres', 'snapshot'], default=RETRIEVAL_BACKEND,
+                        help="Where to search for context (default: $RETRIEVAL_BACKEND or postgres).")
+    parser.add_argument("--mode", choices=['flat', 'hierarchical'], default=RETRIEVAL_MODE,
+                        help="Search files repo-wide, or within the nearest folders first (default: $RETRIEVAL_MODE or flat).")
+    parser.add_argument("--since", help="Only use commits made at or after this time (e.g. 2024-10-01).")
+    parser.add_argument("--until", help="Only use commits made before this time.")
+    parser.add_argument("--author", help="Only use commits by this author name or email.")
+    parser.add_argument("--path", action="append", dest="paths",
+                        help="Only use commits touching this file or folder (repeatable).")
 
-    provider = sys.argv[1]
-    repo_name = sys.argv[2]
-    question = sys.argv[3]
+    args = parser.parse_args()
+    set_retrieval_backend(args.backend)
+    RETRIEVAL_MODE = args.mode
     context_types = ["folders", "files", "commits"]
 
-    prompt = get_prompt(provider, repo_name, question, context_types)
-    print(prompt)
-
-    answer = ask_question(provider, repo_name, question)
-    print("Answer:")
-    print(answer)
+    if args.batch:
+        ask_questions_batch(args.provider, args.repo, args.batch, args.output,
+                            context_types, args.batch_size, args.concurrency)
+    elif args.question:
+        commit_filters = {"since": args.since, "until": args.until,
+                          "author": args.author, "paths": args.paths}
+        answer, prompt = ask_question(args.provider, args.repo, args.question, context_types,
+                                      return_prompt=True, commit_filters=commit_filters)
+        print(prompt)
+        print("Answer:")
+        print(answer)
+    else:
+        parser.error("either a question or --batch is required")
+    print_summary()
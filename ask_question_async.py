@@ -0,0 +1,253 @@
+import os
+import time
+import asyncio
+import asyncpg
+import numpy as np
+from pgvector.asyncpg import register_vector
+from dotenv import load_dotenv
+from pgconf_utils import generate_openai_embedding_async, generate_ubicloud_embedding_async, ask_openai_async, ask_ubicloud_async, fallback_provider, provider_health, CONTEXT_TOKEN_BUDGETS
+from context_assembler import assemble_context
+import ask_question
+from ask_question import make_candidate, build_prompt, format_system_prompt, snapshot_store, like_escape, coarse_scope, commit_filter_clauses, CANDIDATES_PER_TYPE, SYSTEM_PROMPT_TTL, FALLBACK_NOTE, COARSE_FOLDERS
+from metrics import span, traced, statement_name, registry
+from ann_tuning import run_retrieval_async
+
+# Load environment variables
+load_dotenv()
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+# Connections opened when the pool is created and kept open while idle
+MIN_CONNECTIONS = 8
+MAX_CONNECTIONS = 20
+
+_pool = None
+_pool_lock = asyncio.Lock()
+_system_prompts = {}
+
+
+async def get_pool():
+    """
+    Returns the process-wide asyncpg pool, creating it on first use. It belongs to the
+    event loop that first awaited it (Gradio's), like every other async resource here.
+    """
+    global _pool
+    if _pool is None:
+        async with _pool_lock:
+            if _pool is None:
+                _pool = await asyncpg.create_pool(
+                    DATABASE_URL, min_size=MIN_CONNECTIONS, max_size=MAX_CONNECTIONS, init=register_vector)
+    return _pool
+
+
+async def fetch(query, *args):
+    pool = await get_pool()
+    with span("sql", statement=statement_name(query)):
+        async with pool.acquire() as conn:
+            return await conn.fetch(query, *args)
+
+
+async def fetch_retrieval(kind, provider, repo, query, *args):
+    """
+    Runs a vector search with the repo's tuned index settings (see ann_tuning.py).
+    """
+    pool = await get_pool()
+    with span("sql", statement=statement_name(query)):
+        async with pool.acquire() as conn:
+            return await run_retrieval_async(conn, repo, kind, provider, query, *args)
+
+
+async def search_snapshot(kind, provider, repo, vector, top_k, folders=None):
+    """
+    Searches the snapshot backend off the event loop, since the first search of a repo
+    loads (or exports) its snapshot synchronously.
+    """
+    return await asyncio.to_thread(snapshot_store().search, kind, provider, repo, vector, top_k, folders)
+
+
+@traced("query_files")
+async def query_files_async(provider, repo, vector, top_k=5, folders=None):
+    if ask_question.RETRIEVAL_BACKEND == "snapshot":
+        return await search_snapshot("files", provider, repo, vector, top_k, folders)
+    if folders is None:
+        FETCH_FILES = f"""
+            SELECT "name", "folder", llm_{provider}, vector_{provider}
+            FROM files 
+            WHERE repo = $1
+            ORDER BY vector_{provider} <-> $2
+            LIMIT $3
+        """
+        return await fetch_retrieval("files", provider, repo, FETCH_FILES, repo, np.asarray(vector), top_k)
+    FETCH_FILES = f"""
+        WITH scope AS (
+            SELECT "name" FROM folders
+            WHERE repo = $1 AND ("name" = ANY($4::text[]) OR "name" LIKE ANY($5::text[]))
+        )
+        SELECT "name", "folder", llm_{provider}, vector_{provider}
+        FROM files
+        WHERE repo = $1 AND "folder" IN (SELECT "name" FROM scope)
+        ORDER BY vector_{provider} <-> $2
+        LIMIT $3
+    """
+    prefixes = [like_escape(folder) + '/%' for folder in folders]
+    return await fetch_retrieval("files", provider, repo, FETCH_FILES, repo, np.asarray(vector), top_k, list(folders), prefixes)
+
+
+async def query_files_hierarchical_async(provider, repo, vector, top_k=5, folders_task=None):
+    """
+    Async form of `ask_question.query_files_hierarchical`; `folders_task` is the folder
+    search already running for the folders context, if any.
+    """
+    folders = await folders_task if folders_task else await query_folders_async(
+        provider, repo, vector, COARSE_FOLDERS)
+    scope = coarse_scope(vector, folders)
+    if scope is None:
+        registry.inc("hierarchical_fallbacks_total", reason="low_confidence")
+        return await query_files_async(provider, repo, vector, top_k)
+    files = await query_files_async(provider, repo, vector, top_k, scope)
+    if len(files) < top_k:
+        registry.inc("hierarchical_fallbacks_total", reason="too_few_files")
+        return await query_files_async(provider, repo, vector, top_k)
+    return files
+
+
+@traced("query_folders")
+async def query_folders_async(provider, repo, vector, top_k=5):
+    if ask_question.RETRIEVAL_BACKEND == "snapshot":
+        return await search_snapshot("folders", provider, repo, vector, top_k)
+    FETCH_FOLDERS = f"""
+        SELECT "name", llm_{provider}, vector_{provider}
+        FROM folders 
+        WHERE repo = $1
+        ORDER BY vector_{provider} <-> $2
+        LIMIT $3
+    """
+    return await fetch_retrieval("folders", provider, repo, FETCH_FOLDERS, repo, np.asarray(vector), top_k)
+
+
+@traced("query_commits")
+async def query_commits_async(provider, repo, vector, top_k=5, since=None, until=None, author=None, paths=None):
+    clauses = commit_filter_clauses(since, until, author, paths)
+    if ask_question.RETRIEVAL_BACKEND == "snapshot" and not clauses:
+        return await search_snapshot("commits", provider, repo, vector, top_k)
+    args = [repo, np.asarray(vector), top_k]
+    filters = ""
+    for clause, values in clauses:
+        placeholders = [f"${len(args) + i + 1}" for i in range(len(values))]
+        filters += " AND " + clause.format(*placeholders)
+        args.extend(values)
+    FETCH_COMMITS = f"""
+        SELECT "repo", "id", llm_{provider}, vector_{provider}
+        FROM commits 
+        WHERE repo = $1{filters}
+        ORDER BY vector_{provider} <-> $2
+        LIMIT $3
+    """
+    return await fetch_retrieval("commits", provider, repo, FETCH_COMMITS, *args)
+
+
+async def no_rows():
+    return []
+
+
+@traced("get_prompt")
+async def get_prompt_async(provider: str, repo: str, question: str, context_types, commit_filters=None) -> str:
+    if provider not in ["openai", "ubicloud"]:
+        raise ValueError("Invalid provider. Must be 'openai' or 'ubicloud'.")
+
+    vector = await (generate_openai_embedding_async(question) if provider == "openai"
+                    else generate_ubicloud_embedding_async(question))
+
+    # The three retrieval queries run concurrently on separate pooled connections; in
+    # hierarchical mode the files search waits for the folders it narrows down to
+    folders_task = asyncio.ensure_future(query_folders_async(
+        provider, repo, vector, CANDIDATES_PER_TYPE)) if "folders" in context_types else None
+    if "files" not in context_types:
+        files_search = no_rows()
+    elif ask_question.RETRIEVAL_MODE == "hierarchical":
+        files_search = query_files_hierarchical_async(
+            provider, repo, vector, CANDIDATES_PER_TYPE, folders_task)
+    else:
+        files_search = query_files_async(
+            provider, repo, vector, CANDIDATES_PER_TYPE)
+    folders, files, commits = await asyncio.gather(
+        folders_task or no_rows(),
+        files_search,
+        query_commits_async(provider, repo, vector,
+                            CANDIDATES_PER_TYPE, **(commit_filters or {}))
+        if "commits" in context_types else no_rows(),
+    )
+
+    candidates = []
+    for name, description, folder_vector in folders:
+        candidates.append(make_candidate(
+            "folder", name, description, folder_vector))
+    for name, folder_name, description, file_vector in files:
+        candidates.append(make_candidate(
+            "file", name, description, file_vector, folder_name))
+    for _, commit_id, description, commit_vector in commits:
+        candidates.append(make_candidate(
+            "commit", commit_id, description, commit_vector))
+
+    # Pick a diverse subset of the candidates that fits the provider's token budget
+    context = [c["text"] for c in assemble_context(
+        vector, candidates, CONTEXT_TOKEN_BUDGETS[provider])]
+
+    return build_prompt(repo, question, context)
+
+
+async def get_system_prompt_async(provider: str, repo: str, with_overview=True) -> str:
+    if not with_overview:
+        return format_system_prompt(repo, None)
+    key = (provider, repo)
+    cached = _system_prompts.get(key)
+    if cached and time.monotonic() - cached[1] < SYSTEM_PROMPT_TTL:
+        return cached[0]
+
+    rows = await fetch(f"""SELECT overview_{provider} FROM repos WHERE "name" = $1""", repo)
+    system_prompt = format_system_prompt(repo, rows[0][0] if rows else None)
+    _system_prompts[key] = (system_prompt, time.monotonic())
+    return system_prompt
+
+
+@traced("ask_question")
+async def ask_question_async(provider: str, repo: str, question: str, context_types, return_prompt=False, commit_filters=None) -> str:
+    if provider not in ["openai", "ubicloud"]:
+        raise ValueError("Invalid provider. Must be 'openai' or 'ubicloud'.")
+
+    fallback = fallback_provider(provider)
+    if fallback and not provider_health.allow(provider):
+        answer, user_prompt = await answer_with_fallback_async(
+            provider, fallback, repo, question, context_types, commit_filters)
+    else:
+        try:
+            answer, user_prompt = await answer_question_async(
+                provider, repo, question, context_types, commit_filters)
+            provider_health.record(provider, True)
+        except Exception as e:
+            provider_health.record(provider, False)
+            if not fallback:
+                raise
+            print(f"{provider} failed ({e}), falling back to {fallback}")
+            answer, user_prompt = await answer_with_fallback_async(
+                provider, fallback, repo, question, context_types, commit_filters)
+    if return_prompt:
+        return answer, user_prompt
+    return answer
+
+
+async def answer_question_async(provider, repo, question, context_types, commit_filters=None):
+    user_prompt, system_prompt = await asyncio.gather(
+        get_prompt_async(provider, repo, question,
+                         context_types, commit_filters),
+        get_system_prompt_async(provider, repo, bool(context_types)),
+    )
+    ask = ask_openai_async if provider == "openai" else ask_ubicloud_async
+    return await ask(system_prompt, user_prompt), user_prompt
+
+
+async def answer_with_fallback_async(provider, fallback, repo, question, context_types, commit_filters=None):
+    registry.inc("provider_fallbacks_total",
+                 provider=provider, fallback=fallback)
+    answer, user_prompt = await answer_question_async(
+        fallback, repo, question, context_types, commit_filters)
+    return FALLBACK_NOTE.format(provider=provider, fallback=fallback) + answer, user_prompt
@@ -1,31 +1,37 @@
 import os
 import json
+import threading
 import argparse
 from psycopg2.pool import ThreadedConnectionPool
 from pgconf_utils import generate_openai_embedding, generate_ubicloud_embedding
 from dotenv import load_dotenv
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
+from metrics import TracedCursor, traced, print_summary
+from journal import Journal, track, print_progress, FAILED
 
 load_dotenv()
 
 MAX_WORKERS = 10
+# Rows read per keyset page, and rows allowed to wait for a worker at once
+PAGE_SIZE = 500
+MAX_PENDING = MAX_WORKERS * 4
 MAX_CONNECTIONS = 50
 MIN_CONNECTIONS = 10
 
 # DB connection
 DATABASE_URL = os.getenv("DATABASE_URL")
 connection_pool = ThreadedConnectionPool(
-    MIN_CONNECTIONS, MAX_CONNECTIONS, DATABASE_URL)
+    MIN_CONNECTIONS, MAX_CONNECTIONS, DATABASE_URL, cursor_factory=TracedCursor)
 
-# SQL queries to fetch repos, folders, and files missing embeddings
-FETCH_FOLDERS = """SELECT "name", "llm_openai", "llm_ubicloud" FROM folders WHERE "vector_openai" IS NULL AND "repo" = %s"""
-FETCH_FILES = """SELECT "name", "folder", "llm_openai", "llm_ubicloud" FROM files WHERE "vector_openai" IS NULL AND "repo" = %s"""
-FETCH_COMMITS = """SELECT "repo", "id", "llm_openai", "llm_ubicloud" FROM commits WHERE "vector_openai" IS NULL AND "repo" = %s"""
+# SQL queries to fetch repos, folders, and files missing embeddings; see missing_vectors
+FETCH_FOLDERS = """SELECT {summaries}, "name" FROM folders WHERE {missing} AND "repo" = %s"""
+FETCH_FILES = """SELECT {summaries}, "folder", "name" FROM files WHERE {missing} AND "repo" = %s"""
+FETCH_COMMITS = """SELECT {summaries}, "repo", "id" FROM commits WHERE {missing} AND "repo" = %s"""
 
 # SQL queries to fetch repos, folders, and files missing embeddings -- override
-FETCH_OVERRIDE_FOLDERS = """SELECT "name", "llm_openai", "llm_ubicloud" FROM folders WHERE "repo" = %s"""
-FETCH_OVERRIDE_FILES = """SELECT "name", "folder", "llm_openai", "llm_ubicloud" FROM files WHERE "repo" = %s"""
-FETCH_OVERRIDE_COMMITS = """SELECT "repo", "id", "llm_openai", "llm_ubicloud" FROM commits WHERE "repo" = %s"""
+FETCH_OVERRIDE_FOLDERS = """SELECT "llm_openai", "llm_ubicloud", "name" FROM folders WHERE "repo" = %s"""
+FETCH_OVERRIDE_FILES = """SELECT "llm_openai", "llm_ubicloud", "folder", "name" FROM files WHERE "repo" = %s"""
+FETCH_OVERRIDE_COMMITS = """SELECT "llm_openai", "llm_ubicloud", "repo", "id" FROM commits WHERE "repo" = %s"""
 
 # SQL query to update embedding
 UPDATE_EMBEDDING_FOLDER = """UPDATE folders SET vector_openai = %s, vector_ubicloud = %s, updated_at = now() WHERE "name" = %s AND repo = %s"""
@@ -42,6 +48,9 @@ UPDATE_EMBEDDING_FOLDER_UBICLOUD = """UPDATE folders SET vector_ubicloud = %s, u
 UPDATE_EMBEDDING_FILE_UBICLOUD = """UPDATE files SET vector_ubicloud = %s, updated_at = now() WHERE "name" = %s AND folder = %s AND repo = %s"""
 UPDATE_EMBEDDING_COMMIT_UBICLOUD = """UPDATE commits SET vector_ubicloud = %s, updated_at = now() WHERE "repo" = %s AND "id" = %s"""
 
+# Marks the repo as changed once its embeddings are in, so snapshots of it get refreshed
+TOUCH_REPO = """UPDATE repos SET updated_at = now() WHERE "name" = %s"""
+
 
 def get_db_connection():
     return connection_pool.getconn()
@@ -51,157 +60,272 @@ def release_db_connection(conn):
     connection_pool.putconn(conn)
 
 
-def update_folder_embedding(repo, folder, provider):
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            name, llm_openai, llm_ubicloud = folder
-            vector_openai = vector_ubicloud = None
-
-            if llm_openai and (not provider or provider == 'openai'):
-                vector_openai = generate_openai_embedding(llm_openai)
-            if llm_ubicloud and (not provider or provider == 'ubicloud'):
-                vector_ubicloud = generate_ubicloud_embedding(llm_ubicloud)
-
-            if vector_openai and vector_ubicloud:
-                cur.execute(UPDATE_EMBEDDING_FOLDER,
-                            (json.dumps(vector_openai), json.dumps(vector_ubicloud), name, repo))
-            elif vector_openai:
-                cur.execute(UPDATE_EMBEDDING_FOLDER_OPENAI,
-                            (json.dumps(vector_openai), name, repo))
-            elif vector_ubicloud:
-                cur.execute(UPDATE_EMBEDDING_FOLDER_UBICLOUD,
-                            (json.dumps(vector_ubicloud), name, repo))
-            conn.commit()
-    finally:
-        release_db_connection(conn)
-
-
-def update_file_embedding(repo, file, provider):
+@traced("update_folder_embedding")
+def update_folder_embedding(repo, folder, provider, journal=None):
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
-            name, folder, llm_openai, llm_ubicloud = file
-            vector_openai = vector_ubicloud = None
-
-            if llm_openai and (not provider or provider == 'openai'):
-                vector_openai = generate_openai_embedding(llm_openai)
-            if llm_ubicloud and (not provider or provider == 'ubicloud'):
-                vector_ubicloud = generate_ubicloud_embedding(llm_ubicloud)
-
-            if vector_openai and vector_ubicloud:
-                cur.execute(UPDATE_EMBEDDING_FILE,
-                            (json.dumps(vector_openai), json.dumps(vector_ubicloud), name, folder, repo))
-            elif vector_openai:
-                cur.execute(UPDATE_EMBEDDING_FILE_OPENAI,
-                            (json.dumps(vector_openai), name, folder, repo))
-            elif vector_ubicloud:
-                cur.execute(UPDATE_EMBEDDING_FILE_UBICLOUD,
-                            (json.dumps(vector_ubicloud), name, folder, repo))
-            conn.commit()
+            llm_openai, llm_ubicloud, name = folder
+            with track(journal, "folder_embedding", name):
+                vector_openai = vector_ubicloud = None
+
+                if llm_openai and (not provider or provider == 'openai'):
+                    vector_openai = generate_openai_embedding(llm_openai)
+                if llm_ubicloud and (not provider or provider == 'ubicloud'):
+                    vector_ubicloud = generate_ubicloud_embedding(llm_ubicloud)
+
+                if vector_openai and vector_ubicloud:
+                    cur.execute(UPDATE_EMBEDDING_FOLDER,
+                                (json.dumps(vector_openai), json.dumps(vector_ubicloud), name, repo))
+                elif vector_openai:
+                    cur.execute(UPDATE_EMBEDDING_FOLDER_OPENAI,
+                                (json.dumps(vector_openai), name, repo))
+                elif vector_ubicloud:
+                    cur.execute(UPDATE_EMBEDDING_FOLDER_UBICLOUD,
+                                (json.dumps(vector_ubicloud), name, repo))
+                conn.commit()
     finally:
         release_db_connection(conn)
 
 
-def update_commit_embedding(repo, commit, provider):
+@traced("update_file_embedding")
+def update_file_embedding(repo, file, provider, journal=None):
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
-            repo, commit_id, llm_openai, llm_ubicloud = commit
-            vector_openai = vector_ubicloud = None
-
-            if llm_openai and (not provider or provider == 'openai'):
-                vector_openai = generate_openai_embedding(llm_openai)
-            if llm_ubicloud and (not provider or provider == 'ubicloud'):
-                vector_ubicloud = generate_ubicloud_embedding(llm_ubicloud)
-
-            if vector_openai and vector_ubicloud:
-                cur.execute(UPDATE_EMBEDDING_COMMIT,
-                            (json.dumps(vector_openai), json.dumps(vector_ubicloud), repo, commit_id))
-            elif vector_openai:
-                cur.execute(UPDATE_EMBEDDING_COMMIT_OPENAI,
-                            (json.dumps(vector_openai), repo, commit_id))
-            elif vector_ubicloud:
-                cur.execute(UPDATE_EMBEDDING_COMMIT_UBICLOUD,
-                            (json.dumps(vector_ubicloud), repo, commit_id))
-            conn.commit()
+            llm_openai, llm_ubicloud, folder, name = file
+            with track(journal, "file_embedding", f"{folder}/{name}"):
+                vector_openai = vector_ubicloud = None
+
+                if llm_openai and (not provider or provider == 'openai'):
+                    vector_openai = generate_openai_embedding(llm_openai)
+                if llm_ubicloud and (not provider or provider == 'ubicloud'):
+                    vector_ubicloud = generate_ubicloud_embedding(llm_ubicloud)
+
+                if vector_openai and vector_ubicloud:
+                    cur.execute(UPDATE_EMBEDDING_FILE,
+                                (json.dumps(vector_openai), json.dumps(vector_ubicloud), name, folder, repo))
+                elif vector_openai:
+                    cur.execute(UPDATE_EMBEDDING_FILE_OPENAI,
+                                (json.dumps(vector_openai), name, folder, repo))
+                elif vector_ubicloud:
+                    cur.execute(UPDATE_EMBEDDING_FILE_UBICLOUD,
+                                (json.dumps(vector_ubicloud), name, folder, repo))
+                conn.commit()
     finally:
         release_db_connection(conn)
 
 
-def backfill_folders(repo, provider=None, override=None):
+@traced("update_commit_embedding")
+def update_commit_embedding(repo, commit, provider, journal=None):
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
-            query = FETCH_OVERRIDE_FOLDERS if override else FETCH_FOLDERS
-            if override:
-                query += " AND updated_at < %s"
-                cur.execute(query, (repo, override))
-            else:
-                cur.execute(query, (repo,))
-            folders = cur.fetchall()
-        print(f"Backfilling {len(folders)} folders...")
-
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            futures = [executor.submit(
-                update_folder_embedding, repo, folder, provider) for folder in folders]
-            for future in as_completed(futures):
-                future.result()
-        print("Backfilling for folders complete.")
+            llm_openai, llm_ubicloud, repo, commit_id = commit
+            with track(journal, "commit_embedding", commit_id):
+                vector_openai = vector_ubicloud = None
+
+                if llm_openai and (not provider or provider == 'openai'):
+                    vector_openai = generate_openai_embedding(llm_openai)
+                if llm_ubicloud and (not provider or provider == 'ubicloud'):
+                    vector_ubicloud = generate_ubicloud_embedding(llm_ubicloud)
+
+                if vector_openai and vector_ubicloud:
+                    cur.execute(UPDATE_EMBEDDING_COMMIT,
+                                (json.dumps(vector_openai), json.dumps(vector_ubicloud), repo, commit_id))
+                elif vector_openai:
+                    cur.execute(UPDATE_EMBEDDING_COMMIT_OPENAI,
+                                (json.dumps(vector_openai), repo, commit_id))
+                elif vector_ubicloud:
+                    cur.execute(UPDATE_EMBEDDING_COMMIT_UBICLOUD,
+                                (json.dumps(vector_ubicloud), repo, commit_id))
+                conn.commit()
     finally:
         release_db_connection(conn)
 
 
-def backfill_files(repo, provider=None, override=None):
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            query = FETCH_OVERRIDE_FILES if override else FETCH_FILES
-            if override:
-                query += " AND updated_at < %s"
-                cur.execute(query, (repo, override))
-            else:
-                cur.execute(query, (repo,))
-            files = cur.fetchall()
-        print(f"Backfilling {len(files)} files...")
-
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            futures = [executor.submit(
-                update_file_embedding, repo, file, provider) for file in files]
-            for future in as_completed(futures):
-                future.result()
-        print("Backfilling for files complete.")
-    finally:
-        release_db_connection(conn)
-
-
-def backfill_commits(repo, provider=None, override=None):
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            query = FETCH_OVERRIDE_COMMITS if override else FETCH_COMMITS
-            if override:
-                query += " AND updated_at < %s"
-                cur.execute(query, (repo, override))
-            else:
-                cur.execute(query, (repo,))
-            commits = cur.fetchall()
-        print(f"Backfilling {len(commits)} commits...")
-
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            futures = [executor.submit(
-                update_commit_embedding, repo, commit, provider) for commit in commits]
-            for future in as_completed(futures):
-                future.result()
-        print("Backfilling for commits complete.")
-    finally:
-        release_db_connection(conn)
-
-
-def backfill(repo, provider=None, override=None):
-    backfill_folders(repo, provider, override)
-    backfill_files(repo, provider, override)
-    backfill_commits(repo, provider, override)
+def missing_vectors(query, provider=None):
+    """
+    Fills in a FETCH_* query to select the rows that have a summary but no vector for the
+    provider (or for either one). A summary whose vector is already there is selected as
+    NULL, so it isn't embedded again.
+    """
+    providers = [provider] if provider else ["openai", "ubicloud"]
+    summaries = ", ".join(f'CASE WHEN "vector_{p}" IS NULL THEN "llm_{p}" END'
+                          for p in ("openai", "ubicloud"))
+    missing = " OR ".join(f'("vector_{p}" IS NULL AND "llm_{p}" IS NOT NULL)'
+                          for p in providers)
+    return query.format(summaries=summaries, missing=f"({missing})")
+
+
+def fetch_keys(query, repo, keys, key_columns):
+    """
+    Yields the rows of a FETCH_OVERRIDE_* query for the given keys (tuples of the key
+    columns' values), PAGE_SIZE keys per round trip.
+    """
+    keys = sorted(keys)
+    arrays = ", ".join(["%s::text[]"] * len(key_columns))
+    query += f" AND ({', '.join(key_columns)}) IN (SELECT * FROM unnest({arrays}))"
+    for start in range(0, len(keys), PAGE_SIZE):
+        page = keys[start:start + PAGE_SIZE]
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(query, [repo] + [list(column)
+                            for column in zip(*page)])
+                rows = cur.fetchall()
+            conn.rollback()
+        finally:
+            release_db_connection(conn)
+        yield from rows
+
+
+def fetch_pages(query, params, key_columns):
+    """
+    Yields the rows of `query` one keyset-paginated page at a time, ordered by the given
+    key columns, which must be the last columns selected. The connection is only held
+    while a page is being read, so rows can be updated while the scan continues.
+    """
+    last_key = None
+    while True:
+        page_query = query
+        page_params = list(params)
+        if last_key is not None:
+            page_query += f" AND ({', '.join(key_columns)}) > ({', '.join(['%s'] * len(key_columns))})"
+            page_params += list(last_key)
+        page_query += f" ORDER BY {', '.join(key_columns)} LIMIT %s"
+        page_params.append(PAGE_SIZE)
+
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(page_query, page_params)
+                rows = cur.fetchall()
+            conn.rollback()
+        finally:
+            release_db_connection(conn)
+
+        yield from rows
+        if len(rows) < PAGE_SIZE:
+            return
+        last_key = rows[-1][-len(key_columns):]
+
+
+def run_bounded(rows, task, kind):
+    """
+    Runs `task` over the rows on the worker pool while the rows are still being read. At
+    most MAX_PENDING rows are queued or in progress at once, so memory stays flat no
+    matter how many rows there are. Returns the number of rows submitted and failed.
+    """
+    pending = threading.BoundedSemaphore(MAX_PENDING)
+    lock = threading.Lock()
+    counts = {"submitted": 0, "failed": 0}
+
+    def done(future):
+        pending.release()
+        error = future.exception()
+        if error is not None:
+            with lock:
+                counts["failed"] += 1
+            print(f"Error backfilling a {kind}: {error}")
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for row in rows:
+            pending.acquire()
+            counts["submitted"] += 1
+            executor.submit(task, row).add_done_callback(done)
+    return counts["submitted"], counts["failed"]
+
+
+# Per kind: the query for every row, the query for rows missing vectors, the key columns,
+# and how journal keys map to key column values and back
+EMBEDDING_KINDS = {
+    "folder": (FETCH_OVERRIDE_FOLDERS, FETCH_FOLDERS, ['"name"'],
+               lambda key: (key,), lambda row: row[2]),
+    "file": (FETCH_OVERRIDE_FILES, FETCH_FILES, ['"folder"', '"name"'],
+             lambda key: tuple(key.rsplit("/", 1)), lambda row: f"{row[2]}/{row[3]}"),
+    "commit": (FETCH_OVERRIDE_COMMITS, FETCH_COMMITS, ['"id"'],
+               lambda key: (key,), lambda row: row[3]),
+}
+
+
+def rows_to_embed(kind, repo, provider=None, override=None, journal=None, rewritten=()):
+    """
+    Yields the rows of one kind to (re-)embed, each once: the `rewritten` keys (items whose
+    summaries were just regenerated, so their vectors are stale) and, on a --retry-failed
+    run, the embeddings the journal recorded as failed, then every row missing a vector
+    (every row with --override, unless retrying). The journal only filters the latter.
+    """
+    fetch_all, fetch_missing, key_columns, split_key, row_key = EMBEDDING_KINDS[kind]
+    retry = journal is not None and journal.retry_failed
+    keys = set(rewritten)
+    if retry:
+        keys |= journal.keys(f"{kind}_embedding", FAILED)
+    query = fetch_all if override and not retry else missing_vectors(
+        fetch_missing, provider)
+
+    yield from fetch_keys(fetch_all, repo, {split_key(key) for key in keys}, key_columns)
+    for row in fetch_pages(query, (repo,), key_columns):
+        key = row_key(row)
+        if key not in keys and (journal is None or journal.should_process(f"{kind}_embedding", key)):
+            yield row
+
+
+@traced("backfill_folders")
+def backfill_folders(repo, provider=None, override=None, journal=None, rewritten=()):
+    folders = rows_to_embed("folder", repo, provider,
+                            override, journal, rewritten)
+    print("Backfilling folders...")
+
+    submitted, failed = run_bounded(
+        folders, lambda folder: update_folder_embedding(repo, folder, provider, journal), "folder")
+    print(
+        f"Backfilling for folders complete ({submitted} backfilled, {failed} failed).")
+
+
+@traced("backfill_files")
+def backfill_files(repo, provider=None, override=None, journal=None, rewritten=()):
+    files = rows_to_embed("file", repo, provider, override, journal, rewritten)
+    print("Backfilling files...")
+
+    submitted, failed = run_bounded(
+        files, lambda file: update_file_embedding(repo, file, provider, journal), "file")
+    print(
+        f"Backfilling for files complete ({submitted} backfilled, {failed} failed).")
+
+
+@traced("backfill_commits")
+def backfill_commits(repo, provider=None, override=None, journal=None, rewritten=()):
+    commits = rows_to_embed("commit", repo, provider,
+                            override, journal, rewritten)
+    print("Backfilling commits...")
+
+    submitted, failed = run_bounded(
+        commits, lambda commit: update_commit_embedding(repo, commit, provider, journal), "commit")
+    print(
+        f"Backfilling for commits complete ({submitted} backfilled, {failed} failed).")
+
+
+def backfill(repo, provider=None, override=None, retry_failed=False, rewritten=()):
+    """
+    Embeds what is missing or failed; `rewritten` holds the (kind, key) items whose
+    summaries the calling ingest run regenerated, which are re-embedded too.
+    """
+    journal = Journal(repo, since=override, retry_failed=retry_failed)
+    backfill_folders(repo, provider, override, journal,
+                     {key for kind, key in rewritten if kind == "folder"})
+    backfill_files(repo, provider, override, journal,
+                   {key for kind, key in rewritten if kind == "file"})
+    backfill_commits(repo, provider, override, journal,
+                     {key for kind, key in rewritten if kind == "commit"})
+    if repo:
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(TOUCH_REPO, (repo,))
+            conn.commit()
+        finally:
+            release_db_connection(conn)
     print("Backfilling complete.")
 
 
@@ -214,10 +338,14 @@ if __name__ == '__main__':
         "--provider", choices=['openai', 'ubicloud'], help="Specify the provider.")
     parser.add_argument(
         "--override", help="Enable override mode, which accepts a timestamp for updated_at")
+    parser.add_argument(
+        "--retry-failed", action="store_true", help="Redo the embeddings the journal recorded as failed, along with any that are missing.")
 
     args = parser.parse_args()
 
-    backfill(args.repo, args.provider, args.override)
+    backfill(args.repo, args.provider, args.override, args.retry_failed)
+    print_progress(args.repo)
 
     # Close the connection pool after all work is done
     connection_pool.closeall()
+    print_summary()
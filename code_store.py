@@ -0,0 +1,87 @@
+import os
+import sys
+import hashlib
+import subprocess
+import psycopg2
+from dotenv import load_dotenv
+
+load_dotenv()
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+# How files.code is stored:
+#   "inline" keeps the source in the row (lz4-compressed by the column setting)
+#   "git" keeps only the blob id when the repo's object store has that blob; other files
+#   are stored inline
+# Either way, read the source back with `load_code`
+CODE_STORAGE = os.getenv("CODE_STORAGE", "inline")
+
+FETCH_FILE_CODE = """SELECT "code", "code_sha" FROM files WHERE "repo" = %s AND "folder" = %s AND "name" = %s"""
+
+
+def git_blob_sha(data: bytes) -> str:
+    """
+    Computes the id git gives a blob with this content, as `git hash-object` would.
+    """
+    header = f"blob {len(data)}\0".encode('utf-8')
+    return hashlib.sha1(header + data).hexdigest()
+
+
+def has_blob(repo_path, code_sha):
+    """
+    Returns whether the git repo containing repo_path has the blob, which untracked and
+    locally modified files don't.
+    """
+    try:
+        result = subprocess.run(["git", "-C", repo_path, "cat-file", "-e", code_sha],
+                                capture_output=True)
+    except OSError:
+        return False
+    return result.returncode == 0
+
+
+def stored_code(file_path, file_content):
+    """
+    Returns the (code, code_sha) pair to write for a file under the configured storage mode.
+    """
+    with open(file_path, 'rb') as f:
+        code_sha = git_blob_sha(f.read())
+    if CODE_STORAGE == "git" and has_blob(os.path.dirname(file_path), code_sha):
+        return None, code_sha
+    return file_content, code_sha
+
+
+def load_code(repo, row):
+    """
+    Returns a file's source from its ("code", "code_sha") columns: the inline code (which
+    Postgres decompresses), or else the blob read from the repo's checkout under repos/.
+    """
+    code, code_sha = row
+    if code is not None or not code_sha:
+        return code
+    result = subprocess.run(["git", "-C", os.path.join("repos", repo), "cat-file", "-p", code_sha],
+                            capture_output=True, check=True)
+    return result.stdout.decode('utf-8', errors='ignore')
+
+
+def fetch_file_code(cur, repo, folder, name):
+    cur.execute(FETCH_FILE_CODE, (repo, folder, name))
+    row = cur.fetchone()
+    return load_code(repo, row) if row else None
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4:
+        print("Usage: python code_store.py <repo> <folder> <file>")
+        sys.exit(1)
+
+    repo, folder, name = sys.argv[1:]
+    conn = psycopg2.connect(DATABASE_URL)
+    try:
+        with conn.cursor() as cur:
+            code = fetch_file_code(cur, repo, folder, name)
+    finally:
+        conn.close()
+    if code is None:
+        print(f"No code stored for '{folder}/{name}' in '{repo}'.")
+        sys.exit(1)
+    print(code, end="")
@@ -0,0 +1,180 @@
+import numpy as np
+
+# Trade-off between relevance to the question (1.0) and diversity among the picks (0.0)
+MMR_LAMBDA = 0.5
+# Rough characters-per-token ratio for English prose and code summaries
+CHARS_PER_TOKEN = 4
+# A candidate at least this similar (cosine) to a more relevant one restates it and is dropped
+DUPLICATE_SIMILARITY = 0.92
+# File hits fold into their folder's candidate when there are at least this many of them and
+# their centroid is this similar to the folder summary, i.e. the folder already covers them
+ROLLUP_MIN_FILES = 2
+ROLLUP_SIMILARITY = 0.85
+# Candidates less similar to the question than this fraction of the best candidate's
+# similarity are left out even when the budget has room; the budget is only an upper bound.
+# Relative, since each embedding model has its own range of cosine similarities
+RELEVANCE_FLOOR = 0.8
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def mmr(query_vector, vectors, lambda_=MMR_LAMBDA, k=None):
+    """
+    Orders candidates by maximal marginal relevance: each pick maximizes
+    lambda * sim(query, c) - (1 - lambda) * max(sim(c, already picked)).
+    Returns candidate indices in pick order.
+    """
+    count = len(vectors)
+    k = count if k is None else min(k, count)
+    if k == 0:
+        return []
+
+    candidates = normalize(vectors)
+    relevance = candidates @ normalize(query_vector)
+    similarity = candidates @ candidates.T
+
+    selected = []
+    redundancy = np.full(count, -np.inf, dtype=np.float32)
+    available = np.ones(count, dtype=bool)
+    for _ in range(k):
+        penalty = np.where(np.isfinite(redundancy), redundancy, 0)
+        scores = lambda_ * relevance - (1 - lambda_) * penalty
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        redundancy = np.maximum(redundancy, similarity[best])
+    return selected
+
+
+def roll_up(query_vector, candidates, vectors, selected):
+    """
+    Folds selected file candidates into their folder's candidate, when the folder was
+    selected too and most of what matched in it is covered by its summary. The most
+    relevant file is kept, and the others are only absorbed when the folder is at least as
+    relevant to the question as each of them. Returns the folders' new texts (listing the
+    files they absorbed, so their names stay in the prompt) by index, and the indices of
+    the absorbed files.
+    """
+    folders = {candidates[i]["name"]: i for i in selected
+               if candidates[i]["kind"] == "folder"}
+    files = {}
+    for i in selected:
+        c = candidates[i]
+        if c["kind"] == "file" and c["folder"] in folders:
+            files.setdefault(c["folder"], []).append(i)
+
+    relevance = vectors @ normalize(query_vector)
+    texts = {}
+    dropped = set()
+    for folder, indices in files.items():
+        if len(indices) < ROLLUP_MIN_FILES:
+            continue
+        centroid = normalize(vectors[indices].mean(axis=0))
+        if centroid @ vectors[folders[folder]] < ROLLUP_SIMILARITY:
+            continue
+        best = max(indices, key=lambda i: relevance[i])
+        absorbed = [i for i in indices if i != best and
+                    relevance[i] <= relevance[folders[folder]]]
+        if not absorbed:
+            continue
+        dropped.update(absorbed)
+        names = ", ".join(candidates[i]["name"] for i in absorbed)
+        texts[folders[folder]] = f"{candidates[folders[folder]]['text']}\nFILES: {names}"
+    return texts, dropped
+
+
+def relevant(query_vector, candidates, floor=RELEVANCE_FLOOR):
+    """
+    Returns the candidates (in their original order) whose similarity to the question is at
+    least `floor` times the best candidate's.
+    """
+    relevance = normalize([c["vector"] for c in candidates]) @ normalize(query_vector)
+    best = relevance.max()
+    if best <= 0:
+        return candidates
+    return [c for c, r in zip(candidates, relevance) if r >= floor * best]
+
+
+def collapse_duplicates(query_vector, vectors, threshold=DUPLICATE_SIMILARITY):
+    """
+    Returns the indices of the candidates to keep, in their original order: going from the
+    most relevant down, a candidate is dropped when it is a near-duplicate of one already
+    kept, whatever their kinds (a folder and a file summary, a file and a commit, ...).
+    """
+    relevance = vectors @ normalize(query_vector)
+    similarity = vectors @ vectors.T
+    kept = []
+    for i in np.argsort(-relevance):
+        if kept and similarity[i, kept].max() >= threshold:
+            continue
+        kept.append(int(i))
+    return sorted(kept)
+
+
+def deduplicate(query_vector, candidates):
+    """
+    Removes near-duplicate candidates using their stored vectors.
+    """
+    if len(candidates) < 2:
+        return candidates
+    vectors = normalize([c["vector"] for c in candidates])
+    return [candidates[i] for i in collapse_duplicates(query_vector, vectors)]
+
+
+def fill(candidates, order, remaining, texts=None, skip=()):
+    """
+    Goes through `order` picking the candidates that still fit in the `remaining` tokens.
+    Returns the picked indices and the tokens left.
+    """
+    picked = []
+    for index in order:
+        if index in skip:
+            continue
+        tokens = estimate_tokens((texts or {}).get(index, candidates[index]["text"]))
+        if tokens <= remaining:
+            picked.append(index)
+            remaining -= tokens
+    return picked, remaining
+
+
+def assemble_context(query_vector, candidates, token_budget):
+    """
+    Picks a diverse, relevant subset of candidates that fits in the token budget.
+
+    Each candidate is a dict with "kind", "name", "folder", "text" and "vector".
+    Near-duplicates are removed first (see `deduplicate`), then ones far less relevant
+    than the best (see `relevant`). The rest are considered in MMR order; one that doesn't
+    fit is skipped so smaller ones further down can still use the remaining budget. File
+    picks covered by a picked folder are then rolled up into it (see `roll_up`), and the
+    budget that frees is filled the same way. The result keeps MMR order, most relevant
+    first.
+    """
+    candidates = [c for c in candidates if c["vector"] is not None]
+    if not candidates:
+        return []
+    candidates = relevant(query_vector, deduplicate(query_vector, candidates))
+    vectors = normalize([c["vector"] for c in candidates])
+
+    order = mmr(query_vector, vectors)
+    picked, _ = fill(candidates, order, token_budget)
+    texts, absorbed = roll_up(query_vector, candidates, vectors, picked)
+    if absorbed:
+        picked = [i for i in picked if i not in absorbed]
+        used = sum(estimate_tokens(texts.get(i, candidates[i]["text"])) for i in picked)
+        more, _ = fill(candidates, order, token_budget - used,
+                       skip=set(picked) | absorbed)
+        picked += more
+
+    picked = set(picked)
+    return [dict(candidates[i], text=texts[i]) if i in texts else candidates[i]
+            for i in order if i in picked]
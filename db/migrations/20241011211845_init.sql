@@ -3,7 +3,7 @@ create extension if not exists vector;
 
 create table if not exists repos (
     "name" text primary key,
-    "updated_at" timestamp with time zone default current_timestamp,
+    "updated_at" timestamp with time zone default current_timestamp
 );
 
 create table if not exists folders (
@@ -0,0 +1,17 @@
+-- migrate:up
+create table if not exists journal (
+    "repo" text,
+    "kind" text,
+    "key" text,
+    "status" text not null,
+    "attempts" integer not null default 0,
+    "error" text,
+    "updated_at" timestamp with time zone default current_timestamp,
+    primary key ("repo", "kind", "key")
+);
+
+create index if not exists journal_repo_status_idx on journal ("repo", "status");
+
+-- migrate:down
+
+drop table journal;
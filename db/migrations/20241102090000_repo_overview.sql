@@ -0,0 +1,8 @@
+-- migrate:up
+alter table repos add column if not exists "overview_openai" text;
+alter table repos add column if not exists "overview_ubicloud" text;
+
+-- migrate:down
+
+alter table repos drop column if exists "overview_openai";
+alter table repos drop column if exists "overview_ubicloud";
@@ -0,0 +1,8 @@
+-- migrate:up
+create index if not exists folders_repo_name_idx on folders ("repo", "name");
+create index if not exists files_repo_folder_name_idx on files ("repo", "folder", "name");
+
+-- migrate:down
+
+drop index if exists folders_repo_name_idx;
+drop index if exists files_repo_folder_name_idx;
@@ -0,0 +1,10 @@
+-- migrate:up
+-- Compress newly written source with lz4 (existing values keep their compression until rewritten)
+alter table files alter column "code" set compression lz4;
+-- Git blob id of the source; with CODE_STORAGE=git only this is stored and "code" stays null
+alter table files add column if not exists "code_sha" text;
+
+-- migrate:down
+
+alter table files drop column if exists "code_sha";
+alter table files alter column "code" set compression default;
@@ -0,0 +1,25 @@
+-- migrate:up
+create table if not exists jobs (
+    "id" bigserial primary key,
+    "repo" text not null,
+    "kind" text not null,
+    "path" text not null default '',
+    "parent" text,
+    "provider" text,
+    "override" text,
+    "status" text not null default 'queued',
+    "attempts" integer not null default 0,
+    "worker" text,
+    "lease_expires_at" timestamp with time zone,
+    "error" text,
+    "created_at" timestamp with time zone default current_timestamp,
+    "updated_at" timestamp with time zone default current_timestamp,
+    unique ("repo", "kind", "path")
+);
+
+create index if not exists jobs_status_id_idx on jobs ("status", "id");
+create index if not exists jobs_repo_parent_idx on jobs ("repo", "parent");
+
+-- migrate:down
+
+drop table jobs;
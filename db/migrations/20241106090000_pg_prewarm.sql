@@ -0,0 +1,7 @@
+-- migrate:up
+-- Lets the app load the retrieval tables and their indexes into shared buffers at startup
+create extension if not exists pg_prewarm;
+
+-- migrate:down
+
+drop extension if exists pg_prewarm;
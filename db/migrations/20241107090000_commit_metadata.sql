@@ -0,0 +1,61 @@
+-- migrate:up
+-- Typed commit metadata, so retrieval can narrow commits by time, author and path before vector ordering
+alter table commits add column if not exists "committed_at" timestamp with time zone;
+alter table commits add column if not exists "author_name" text;
+alter table commits add column if not exists "author_email" text;
+-- Paths from the diff, and every folder above one of them
+alter table commits add column if not exists "files_changed" text[];
+alter table commits add column if not exists "folders_changed" text[];
+
+-- The old git log parser stored the whole header line as the id ("<sha>|AUTHOR_NAME:…|DATE:…"),
+-- leaving "author" as ' <>' and "date" empty. Drop such rows where the commit was stored again
+-- under its real sha, and recover the header fields from the id for the rest
+delete from commits c
+where c."id" ~ '^[0-9a-f]{40}\|AUTHOR_NAME:' and exists (
+    select 1 from commits d where d."repo" = c."repo" and d."id" = split_part(c."id", '|', 1)
+);
+update commits set
+    "author" = substring("id" from '\|AUTHOR_NAME:(.*?)\|AUTHOR_EMAIL:') || ' <'
+               || substring("id" from '\|AUTHOR_EMAIL:(.*?)\|DATE:') || '>',
+    "date" = substring("id" from '\|DATE:(.*?)\|TITLE:'),
+    "title" = coalesce(nullif("title", ''), substring("id" from '\|TITLE:(.*?)\|MESSAGE:')),
+    "message" = coalesce(nullif("message", ''), substring("id" from '\|MESSAGE:(.*)$')),
+    "id" = split_part("id", '|', 1)
+where "id" ~ '^[0-9a-f]{40}\|AUTHOR_NAME:.*\|AUTHOR_EMAIL:.*\|DATE:.*\|TITLE:.*\|MESSAGE:';
+-- Anything else in the old format can't be parsed back; it is re-ingested on the next run
+delete from commits where "id" ~ '^[0-9a-f]{40}\|';
+
+-- Fill in what can be recovered from rows written before these columns existed
+update commits set "committed_at" = "date"::timestamp with time zone
+where "committed_at" is null and "date" ~ '^\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}( ?[+-]\d{2}:?\d{2}|Z)?$';
+update commits set "author_name" = substring("author" from '^(.*) <[^<>]*>$'),
+                   "author_email" = substring("author" from '<([^<>]*)>$')
+where "author_name" is null and "author" ~ '<[^<>]*>$';
+update commits c set "files_changed" = coalesce((
+    select array_agg(distinct m[1]) from regexp_matches(c."changes", '^diff --git a/\S+ b/(\S+)$', 'gn') m
+), '{}')
+where "files_changed" is null and "changes" is not null;
+update commits c set "folders_changed" = coalesce((
+    select array_agg(distinct array_to_string(parts[1:n], '/'))
+    from unnest(c."files_changed") f, string_to_array(f, '/') parts, generate_series(1, cardinality(parts) - 1) n
+), '{}')
+where "folders_changed" is null and "files_changed" is not null;
+
+create index if not exists commits_repo_committed_at_idx on commits ("repo", "committed_at");
+create index if not exists commits_repo_author_name_idx on commits ("repo", "author_name");
+create index if not exists commits_repo_author_email_idx on commits ("repo", "author_email");
+create index if not exists commits_files_changed_idx on commits using gin ("files_changed");
+create index if not exists commits_folders_changed_idx on commits using gin ("folders_changed");
+
+-- migrate:down
+
+drop index if exists commits_folders_changed_idx;
+drop index if exists commits_files_changed_idx;
+drop index if exists commits_repo_author_email_idx;
+drop index if exists commits_repo_author_name_idx;
+drop index if exists commits_repo_committed_at_idx;
+alter table commits drop column if exists "folders_changed";
+alter table commits drop column if exists "files_changed";
+alter table commits drop column if exists "author_email";
+alter table commits drop column if exists "author_name";
+alter table commits drop column if exists "committed_at";
@@ -0,0 +1,20 @@
+-- migrate:up
+-- Per-repo vector index query settings chosen by ann_tuning.py, applied by the query path
+create table if not exists retrieval_settings (
+    "repo" text,
+    "kind" text,
+    "provider" text,
+    -- Planner settings to SET LOCAL before each search, e.g. {"hnsw.ef_search": "80"}
+    "settings" jsonb not null default '{}',
+    -- Index build options the sweep found best, e.g. {"lists": 200}; informational
+    "index_options" jsonb not null default '{}',
+    "recall" real,
+    "p50_ms" real,
+    "p95_ms" real,
+    "tuned_at" timestamp with time zone default current_timestamp,
+    primary key ("repo", "kind", "provider")
+);
+
+-- migrate:down
+
+drop table if exists retrieval_settings;
@@ -0,0 +1,123 @@
+import queue
+import threading
+from pgconf_utils import generate_openai_embeddings, generate_ubicloud_embeddings
+from metrics import registry, span
+
+# Summaries allowed to wait for embedding; when it's full, summarizing threads block
+QUEUE_SIZE = 64
+EMBEDDING_WORKERS = 4
+# Summaries embedded per request, taken from whatever is already waiting
+EMBEDDING_BATCH_SIZE = 32
+
+EMBEDDERS = {
+    "openai": generate_openai_embeddings,
+    "ubicloud": generate_ubicloud_embeddings,
+}
+
+_STOP = object()
+
+
+class EmbeddingPipeline:
+    """
+    The embedding stage of ingestion. Summaries are submitted as soon as they're generated,
+    embedded in batches by a few worker threads and then written together with their
+    vectors, so embedding overlaps summarization instead of following it.
+
+    An item's journal entry is marked done once its row is queued on the `writer`. If the
+    embedding fails, the row is still written with that provider's vector set to NULL (so
+    a vector of an older summary isn't kept), and a failed "<kind>_embedding" entry is
+    recorded for backfill_embeddings.py to repair.
+    """
+
+    def __init__(self, writer, journal=None, workers=EMBEDDING_WORKERS):
+        self.writer = writer
+        self.journal = journal
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.threads = [threading.Thread(target=self.run, daemon=True)
+                        for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, kind, key, texts, write):
+        """
+        Queues one item. `texts` maps providers to summaries and `write(vectors=...)` writes
+        the row with a {provider: vector} dict, where a provider that failed maps to None.
+        """
+        texts = {provider: text.strip()
+                 for provider, text in texts.items() if text}
+        with span("pipeline_backpressure", kind=kind):
+            self.queue.put((kind, key, texts, write))
+
+    def close(self):
+        """
+        Waits for everything submitted to be embedded and queued for writing.
+        """
+        for _ in self.threads:
+            self.queue.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                return
+            batch = [item]
+            stopped = False
+            while len(batch) < EMBEDDING_BATCH_SIZE:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopped = True
+                    break
+                batch.append(item)
+            self.process(batch)
+            if stopped:
+                return
+
+    def embed(self, batch):
+        vectors = [{} for _ in batch]
+        errors = [None] * len(batch)
+        for provider, embed in EMBEDDERS.items():
+            indexes = [i for i, (_, _, texts, _) in enumerate(batch)
+                       if provider in texts]
+            if not indexes:
+                continue
+            try:
+                embeddings = embed([batch[i][2][provider] for i in indexes])
+                for i, embedding in zip(indexes, embeddings):
+                    vectors[i][provider] = embedding
+            except Exception as e:
+                for i in indexes:
+                    vectors[i][provider] = None
+                    errors[i] = e
+        return vectors, errors
+
+    def process(self, batch):
+        # Batch sizes go into counters (items / batches is the average), not a span label,
+        # which would start a new histogram series for every distinct size
+        registry.inc("pipeline_embedding_batches_total")
+        registry.inc("pipeline_embedding_batch_items_total", len(batch))
+        with span("pipeline_embedding"):
+            vectors, errors = self.embed(batch)
+        for (kind, key, _, write), item_vectors, error in zip(batch, vectors, errors):
+            try:
+                write(vectors=item_vectors)
+                if self.journal:
+                    self.journal.finish(kind, key, self.writer)
+            except Exception as e:
+                registry.inc("pipeline_items_total", kind=kind, status="failed")
+                print(f"Error writing {kind} '{key}': {e}")
+                if self.journal:
+                    self.journal.fail(kind, key, e)
+                continue
+            if error is not None:
+                registry.inc("pipeline_items_total", kind=kind,
+                             status="embedding_failed")
+                print(f"Error embedding {kind} '{key}': {error}")
+                if self.journal:
+                    self.journal.fail(f"{kind}_embedding", key, error)
+            else:
+                registry.inc("pipeline_items_total", kind=kind, status="done")
@@ -0,0 +1,195 @@
+import os
+import sys
+import threading
+from contextlib import contextmanager, nullcontext
+from psycopg2.pool import ThreadedConnectionPool
+from dotenv import load_dotenv
+from metrics import TracedCursor
+
+load_dotenv()
+
+MIN_CONNECTIONS = 1
+MAX_CONNECTIONS = 10
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# Database connection pool
+DATABASE_URL = os.getenv("DATABASE_URL")
+connection_pool = ThreadedConnectionPool(
+    MIN_CONNECTIONS, MAX_CONNECTIONS, DATABASE_URL, cursor_factory=TracedCursor)
+
+# Queries
+FETCH_JOURNAL = """SELECT "kind", "key", "status" FROM journal WHERE "repo" = %s"""
+FETCH_PROGRESS = """SELECT "kind", "status", count(*) FROM journal WHERE "repo" = %s GROUP BY "kind", "status" ORDER BY "kind", "status" """
+FETCH_FAILURES = """SELECT "kind", "key", "attempts", "error" FROM journal WHERE "repo" = %s AND "status" = 'failed' ORDER BY "kind", "key" """
+UPSERT_ENTRY = """
+    INSERT INTO journal ("repo", "kind", "key", "status", "attempts", "error")
+    VALUES (%s, %s, %s, %s, %s, %s)
+    ON CONFLICT ("repo", "kind", "key") DO UPDATE SET "status" = EXCLUDED."status", "attempts" = journal."attempts" + EXCLUDED."attempts", "error" = EXCLUDED."error", "updated_at" = now();
+"""
+# For a WriteBehind batch, so an item's row and its "done" entry commit together
+UPSERT_ENTRIES = """
+    INSERT INTO journal ("repo", "kind", "key", "status", "attempts", "error")
+    VALUES %s
+    ON CONFLICT ("repo", "kind", "key") DO UPDATE SET "status" = EXCLUDED."status", "attempts" = journal."attempts" + EXCLUDED."attempts", "error" = EXCLUDED."error", "updated_at" = now();
+"""
+
+
+@contextmanager
+def pool_connection():
+    conn = connection_pool.getconn()
+    try:
+        yield conn
+    finally:
+        connection_pool.putconn(conn)
+
+
+class Journal:
+    """
+    Persistent per-item status for one repo's ingestion and backfill runs.
+
+    Items are identified by a kind ("folder", "file", "commit", "folder_embedding", ...)
+    and a key (folder path, "folder/file" path or commit id). The state is loaded once per
+    run, so resuming doesn't need a SELECT per item to find out what is already done.
+    With `since`, entries older than that timestamp are ignored, matching --override.
+
+    Every item not recorded as done is processed, whether it failed, was interrupted or
+    was never reached. `retry_failed` marks a run that re-enters a repo that was already
+    processed (so backfill also redoes the embeddings recorded as failed).
+    """
+
+    def __init__(self, repo, since=None, retry_failed=False):
+        self.repo = repo
+        self.retry_failed = retry_failed
+        self.lock = threading.Lock()
+        self.state = {}
+        # (kind, key) of the items finished by this run
+        self.finished = set()
+
+        with pool_connection() as conn:
+            with conn.cursor() as cur:
+                if since:
+                    cur.execute(FETCH_JOURNAL + """ AND updated_at > %s""",
+                                (repo, since))
+                else:
+                    cur.execute(FETCH_JOURNAL, (repo,))
+                for kind, key, status in cur.fetchall():
+                    self.state[(kind, key)] = status
+
+    def status(self, kind, key):
+        with self.lock:
+            return self.state.get((kind, key), PENDING)
+
+    def should_process(self, kind, key):
+        return self.status(kind, key) != DONE
+
+    def keys(self, kind, status):
+        with self.lock:
+            return {key for (k, key), s in self.state.items() if k == kind and s == status}
+
+    def has_failures_under(self, kind, prefix):
+        """
+        Returns whether any item of this kind strictly below the given folder path has failed.
+        """
+        with self.lock:
+            return any(
+                k == kind and s == FAILED and key != prefix and (
+                    prefix == "." or key.startswith(prefix + "/"))
+                for (k, key), s in self.state.items()
+            )
+
+    def _write(self, kind, key, status, attempts, error=None):
+        with pool_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(UPSERT_ENTRY, (self.repo, kind, key,
+                            status, attempts, error))
+            conn.commit()
+        with self.lock:
+            self.state[(kind, key)] = status
+
+    def start(self, kind, key):
+        # Kept in memory only: an unfinished item is resumed the same way whether it was
+        # recorded as running or not at all, so a commit per item would buy nothing
+        with self.lock:
+            self.state[(kind, key)] = RUNNING
+
+    def finish(self, kind, key, writer=None):
+        with self.lock:
+            self.finished.add((kind, key))
+        if writer is None:
+            self._write(kind, key, DONE, 1)
+            return
+        writer.add(UPSERT_ENTRIES, ("journal", kind, key),
+                   (self.repo, kind, key, DONE, 1, None), (kind, key))
+        with self.lock:
+            self.state[(kind, key)] = DONE
+
+    def fail(self, kind, key, error):
+        self._write(kind, key, FAILED, 1, str(error)[:2000])
+
+    @contextmanager
+    def track(self, kind, key, writer=None, finish=True):
+        """
+        Marks the item running (in memory), then done or failed. With a WriteBehind `writer` the
+        "done" entry is queued with the item's own rows instead of written right away;
+        with finish=False it is left to whoever writes the rows later.
+        """
+        self.start(kind, key)
+        try:
+            yield
+        except Exception as e:
+            self.fail(kind, key, e)
+            raise
+        if finish:
+            self.finish(kind, key, writer)
+
+
+def track(journal, kind, key, writer=None, finish=True):
+    """
+    Like `Journal.track`, but a no-op when running without a journal.
+    """
+    return journal.track(kind, key, writer, finish) if journal else nullcontext()
+
+
+def fetch_progress(repo):
+    with pool_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(FETCH_PROGRESS, (repo,))
+            return cur.fetchall()
+
+
+def print_progress(repo, show_failures=False):
+    rows = fetch_progress(repo)
+    if not rows:
+        print(f"No journal entries for '{repo}'.")
+        return
+
+    print(f"Journal for '{repo}':")
+    counts = {}
+    for kind, status, count in rows:
+        counts.setdefault(kind, {})[status] = count
+    for kind, statuses in counts.items():
+        total = sum(statuses.values())
+        summary = ", ".join(f"{status}: {count}" for status,
+                            count in sorted(statuses.items()))
+        print(f"  {kind:<20} {statuses.get(DONE, 0)}/{total} done ({summary})")
+
+    if show_failures:
+        with pool_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(FETCH_FAILURES, (repo,))
+                failures = cur.fetchall()
+        for kind, key, attempts, error in failures:
+            print(f"  FAILED {kind} {key} after {attempts} attempt(s): {error}")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: python journal.py <repo> [--failures]")
+        sys.exit(1)
+
+    print_progress(sys.argv[1], "--failures" in sys.argv[2:])
+    connection_pool.closeall()
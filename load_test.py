@@ -0,0 +1,377 @@
+import json
+import time
+import zlib
+import random
+import asyncio
+import argparse
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from dotenv import load_dotenv
+import ask_question
+import ask_question_async
+
+load_dotenv()
+
+OPENAI_VECTOR_DIMENSIONS = 1536
+UBICLOUD_VECTOR_DIMENSIONS = 4096
+
+# Stand-in latencies (seconds), roughly what we observe from the real providers
+STUB_EMBEDDING_LATENCY = 0.15
+STUB_LLM_FIRST_TOKEN_LATENCY = 0.5
+STUB_LLM_SECONDS_PER_1K_PROMPT_CHARS = 0.02
+STUB_LLM_OUTPUT_TOKENS = 300
+STUB_LLM_SECONDS_PER_OUTPUT_TOKEN = 0.01
+
+# A level is saturated when throughput grows less than this compared to the previous level
+SATURATION_THROUGHPUT_GAIN = 1.1
+
+STAGES = ["embedding", "query_folders", "query_files", "query_commits", "llm"]
+
+# Stage timings of the request being run; a context variable, so it follows a request
+# across the tasks ask_question_async spawns as well as within a worker thread
+_timings = contextvars.ContextVar("timings", default=None)
+
+
+def _jitter(seconds):
+    return random.lognormvariate(0, 0.35) * seconds
+
+
+def stub_vector(text, dimensions):
+    rng = np.random.default_rng(zlib.crc32(text.encode('utf-8')))
+    vector = rng.standard_normal(dimensions)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def stub_embedding(dimensions):
+    def generate_embedding(text: str) -> list:
+        time.sleep(_jitter(STUB_EMBEDDING_LATENCY))
+        return stub_vector(text, dimensions)
+    return generate_embedding
+
+
+def stub_ask(system_prompt: str, user_prompt: str) -> str:
+    prompt_chars = len(system_prompt) + len(user_prompt)
+    time.sleep(_jitter(STUB_LLM_FIRST_TOKEN_LATENCY) +
+               prompt_chars / 1000 * STUB_LLM_SECONDS_PER_1K_PROMPT_CHARS +
+               STUB_LLM_OUTPUT_TOKENS * STUB_LLM_SECONDS_PER_OUTPUT_TOKEN)
+    return "stub answer"
+
+
+def stub_embedding_async(dimensions):
+    async def generate_embedding_async(text: str) -> list:
+        await asyncio.sleep(_jitter(STUB_EMBEDDING_LATENCY))
+        return stub_vector(text, dimensions)
+    return generate_embedding_async
+
+
+async def stub_ask_async(system_prompt: str, user_prompt: str) -> str:
+    prompt_chars = len(system_prompt) + len(user_prompt)
+    await asyncio.sleep(_jitter(STUB_LLM_FIRST_TOKEN_LATENCY) +
+                        prompt_chars / 1000 * STUB_LLM_SECONDS_PER_1K_PROMPT_CHARS +
+                        STUB_LLM_OUTPUT_TOKENS * STUB_LLM_SECONDS_PER_OUTPUT_TOKEN)
+    return "stub answer"
+
+
+def record_timing(stage, start):
+    timings = _timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0) + time.perf_counter() - start
+
+
+def timed(stage, fn):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            record_timing(stage, start)
+    return wrapper
+
+
+def timed_async(stage, fn):
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            record_timing(stage, start)
+    return wrapper
+
+
+def install_hooks(use_stubs):
+    """
+    Replaces the provider calls used by ask_question with local stand-ins (unless real
+    providers were requested) and wraps every stage of the query path with a timer.
+    """
+    if use_stubs:
+        ask_question.generate_openai_embedding = stub_embedding(
+            OPENAI_VECTOR_DIMENSIONS)
+        ask_question.generate_ubicloud_embedding = stub_embedding(
+            UBICLOUD_VECTOR_DIMENSIONS)
+        ask_question.ask_openai = stub_ask
+        ask_question.ask_ubicloud = stub_ask
+
+    ask_question.generate_openai_embedding = timed(
+        "embedding", ask_question.generate_openai_embedding)
+    ask_question.generate_ubicloud_embedding = timed(
+        "embedding", ask_question.generate_ubicloud_embedding)
+    ask_question.query_folders = timed(
+        "query_folders", ask_question.query_folders)
+    ask_question.query_files = timed("query_files", ask_question.query_files)
+    ask_question.query_commits = timed(
+        "query_commits", ask_question.query_commits)
+    ask_question.ask_openai = timed("llm", ask_question.ask_openai)
+    ask_question.ask_ubicloud = timed("llm", ask_question.ask_ubicloud)
+
+
+def install_async_hooks(use_stubs):
+    """
+    Like `install_hooks`, for the provider calls and stages of ask_question_async.
+    """
+    module = ask_question_async
+    if use_stubs:
+        module.generate_openai_embedding_async = stub_embedding_async(
+            OPENAI_VECTOR_DIMENSIONS)
+        module.generate_ubicloud_embedding_async = stub_embedding_async(
+            UBICLOUD_VECTOR_DIMENSIONS)
+        module.ask_openai_async = stub_ask_async
+        module.ask_ubicloud_async = stub_ask_async
+
+    module.generate_openai_embedding_async = timed_async(
+        "embedding", module.generate_openai_embedding_async)
+    module.generate_ubicloud_embedding_async = timed_async(
+        "embedding", module.generate_ubicloud_embedding_async)
+    module.query_folders_async = timed_async(
+        "query_folders", module.query_folders_async)
+    module.query_files_async = timed_async(
+        "query_files", module.query_files_async)
+    module.query_commits_async = timed_async(
+        "query_commits", module.query_commits_async)
+    module.ask_openai_async = timed_async("llm", module.ask_openai_async)
+    module.ask_ubicloud_async = timed_async("llm", module.ask_ubicloud_async)
+
+
+def load_corpus(path, field=None):
+    questions = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if field:
+                question = record.get(field)
+            else:
+                question = record.get("question") or record.get("title")
+            if question:
+                questions.append(question)
+    if not questions:
+        raise ValueError(f"No questions found in {path}")
+    return questions
+
+
+def run_request(provider, repo, question, context_types):
+    timings = {}
+    token = _timings.set(timings)
+    start = time.perf_counter()
+    error = None
+    try:
+        ask_question.ask_question(provider, repo, question, context_types)
+    except Exception as e:
+        error = e
+    timings["total"] = time.perf_counter() - start
+    _timings.reset(token)
+    return timings, error
+
+
+async def run_request_async(provider, repo, question, context_types):
+    timings = {}
+    token = _timings.set(timings)
+    start = time.perf_counter()
+    error = None
+    try:
+        await ask_question_async.ask_question_async(provider, repo, question, context_types)
+    except Exception as e:
+        error = e
+    timings["total"] = time.perf_counter() - start
+    _timings.reset(token)
+    return timings, error
+
+
+def run_level(providers, repo, questions, context_types, concurrency, requests_per_level, rate):
+    """
+    Replays the corpus at the given concurrency. With a rate, requests arrive as a Poisson
+    process (open loop) and queueing delay counts toward latency; without one, each worker
+    issues its next request as soon as the previous one completes (closed loop).
+    """
+    results = []
+    lock = threading.Lock()
+
+    def task(index, scheduled_at):
+        provider = providers[index % len(providers)]
+        question = questions[index % len(questions)]
+        timings, error = run_request(provider, repo, question, context_types)
+        if scheduled_at is not None:
+            timings["total"] = time.perf_counter() - scheduled_at
+        with lock:
+            results.append((timings, error))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        next_arrival = start
+        for index in range(requests_per_level):
+            if rate:
+                next_arrival += random.expovariate(rate)
+                delay = next_arrival - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(task, index, next_arrival)
+            else:
+                executor.submit(task, index, None)
+    elapsed = time.perf_counter() - start
+    return results, elapsed
+
+
+async def run_level_async(providers, repo, questions, context_types, concurrency, requests_per_level, rate):
+    """
+    Like `run_level`, but drives ask_question_async on one event loop, with at most
+    `concurrency` requests in flight.
+    """
+    results = []
+    in_flight = asyncio.Semaphore(concurrency)
+
+    async def task(index, scheduled_at):
+        provider = providers[index % len(providers)]
+        question = questions[index % len(questions)]
+        async with in_flight:
+            timings, error = await run_request_async(provider, repo, question, context_types)
+        if scheduled_at is not None:
+            timings["total"] = time.perf_counter() - scheduled_at
+        results.append((timings, error))
+
+    start = time.perf_counter()
+    tasks = []
+    next_arrival = start
+    for index in range(requests_per_level):
+        if rate:
+            next_arrival += random.expovariate(rate)
+            delay = next_arrival - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(task(index, next_arrival)))
+        else:
+            tasks.append(asyncio.ensure_future(task(index, None)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    return results, elapsed
+
+
+def percentiles(values):
+    if not values:
+        return None
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return p50, p95, p99
+
+
+def summarize_level(concurrency, results, elapsed):
+    errors = sum(1 for _, error in results if error is not None)
+    ok = [timings for timings, error in results if error is None]
+    summary = {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "errors": errors,
+        "throughput": len(ok) / elapsed if elapsed > 0 else 0,
+        "stages": {},
+    }
+    for stage in STAGES + ["total"]:
+        stats = percentiles([t[stage] for t in ok if stage in t])
+        if stats:
+            summary["stages"][stage] = stats
+    return summary
+
+
+def print_level(summary):
+    print(f"\nConcurrency {summary['concurrency']}: {summary['requests']} requests, "
+          f"{summary['errors']} errors, {summary['throughput']:.2f} req/s")
+    print(f"  {'stage':<15}{'p50 (ms)':>10}{'p95 (ms)':>10}{'p99 (ms)':>10}")
+    for stage, (p50, p95, p99) in summary["stages"].items():
+        print(
+            f"  {stage:<15}{p50 * 1000:>10.0f}{p95 * 1000:>10.0f}{p99 * 1000:>10.0f}")
+
+
+def find_saturation(summaries):
+    for previous, current in zip(summaries, summaries[1:]):
+        if current["throughput"] < previous["throughput"] * SATURATION_THROUGHPUT_GAIN:
+            return previous
+    return None
+
+
+def main(repo, corpus, providers, context_types, concurrency_levels, requests_per_level, rate, use_stubs, field,
+         use_async=False):
+    questions = load_corpus(corpus, field)
+    if use_async:
+        install_async_hooks(use_stubs)
+        # One loop for the whole sweep: the asyncpg pool belongs to the loop that created it
+        loop = asyncio.new_event_loop()
+    else:
+        install_hooks(use_stubs)
+
+    print(f"Replaying {len(questions)} questions against '{repo}' "
+          f"({'stand-in' if use_stubs else 'real'} providers, "
+          f"{'async' if use_async else 'sync'} query path)...")
+    summaries = []
+    try:
+        for concurrency in concurrency_levels:
+            if use_async:
+                results, elapsed = loop.run_until_complete(run_level_async(
+                    providers, repo, questions, context_types, concurrency, requests_per_level, rate))
+            else:
+                results, elapsed = run_level(providers, repo, questions, context_types,
+                                             concurrency, requests_per_level, rate)
+            summary = summarize_level(concurrency, results, elapsed)
+            print_level(summary)
+            summaries.append(summary)
+    finally:
+        if use_async:
+            loop.close()
+
+    saturated = find_saturation(summaries)
+    print()
+    if saturated:
+        print(f"Throughput saturates at concurrency {saturated['concurrency']} "
+              f"({saturated['throughput']:.2f} req/s).")
+    else:
+        print("No saturation point reached; try higher concurrency levels.")
+    return summaries
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Replay a question corpus against the query path at increasing concurrency.")
+    parser.add_argument("repo", help="The repository to ask questions about.")
+    parser.add_argument("corpus", help="JSONL file with one question per line.")
+    parser.add_argument("--field", help="JSON field holding the question (default: 'question' or 'title').")
+    parser.add_argument("--provider", choices=['openai', 'ubicloud'],
+                        help="Only exercise one provider (default: alternate between both).")
+    parser.add_argument("--context-types", default="folders,files,commits",
+                        help="Comma-separated context types to retrieve.")
+    parser.add_argument("--concurrency", default="1,2,4,8,16,32",
+                        help="Comma-separated concurrency levels to sweep.")
+    parser.add_argument("--requests", type=int, default=100,
+                        help="Number of requests per concurrency level.")
+    parser.add_argument("--rate", type=float,
+                        help="Arrival rate in requests per second (default: closed loop).")
+    parser.add_argument("--real-providers", action="store_true",
+                        help="Call the real LLM and embedding providers instead of local stand-ins.")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="Drive the asyncio query path (ask_question_async, as the app does) instead of the sync one.")
+
+    args = parser.parse_args()
+    providers = [args.provider] if args.provider else ["openai", "ubicloud"]
+    context_types = [c for c in args.context_types.split(",") if c]
+    concurrency_levels = [int(c) for c in args.concurrency.split(",")]
+
+    main(args.repo, args.corpus, providers, context_types, concurrency_levels,
+         args.requests, args.rate, not args.real_providers, args.field, args.use_async)
@@ -0,0 +1,290 @@
+import os
+import re
+import json
+import time
+import uuid
+import inspect
+import functools
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import psycopg2.extensions
+from dotenv import load_dotenv
+
+load_dotenv()
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+# When set, every finished span is appended to this file as a JSON line
+TRACE_FILE = os.getenv("TRACE_FILE")
+
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                     0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class Registry:
+    """
+    Thread-safe store for counters and duration histograms, keyed by metric name and labels.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {
+                    "buckets": [0] * len(HISTOGRAM_BUCKETS), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(HISTOGRAM_BUCKETS):
+                if value <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def render(self):
+        """
+        Renders all metrics in the Prometheus text exposition format.
+        """
+        def format_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                       for k, v in pairs]
+            return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+        lines = []
+        with self.lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE {name} counter")
+                for (n, labels), value in sorted(self.counters.items()):
+                    if n == name:
+                        lines.append(f"{name}{format_labels(labels)} {value}")
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (n, labels), histogram in sorted(self.histograms.items()):
+                    if n != name:
+                        continue
+                    for bound, count in zip(HISTOGRAM_BUCKETS, histogram["buckets"]):
+                        lines.append(
+                            f"{name}_bucket{format_labels(labels, [('le', bound)])} {count}")
+                    lines.append(
+                        f"{name}_bucket{format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+                    lines.append(
+                        f"{name}_sum{format_labels(labels)} {histogram['sum']}")
+                    lines.append(
+                        f"{name}_count{format_labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        Renders a per-stage table of call counts, errors, total and mean duration, tokens and bytes.
+        """
+        rows = {}
+        with self.lock:
+            for (name, labels), histogram in self.histograms.items():
+                if name != "stage_duration_seconds":
+                    continue
+                stage = _stage_label(labels)
+                row = rows.setdefault(stage, _empty_row())
+                row["calls"] += histogram["count"]
+                row["seconds"] += histogram["sum"]
+            for (name, labels), value in self.counters.items():
+                column = {
+                    "stage_errors_total": "errors",
+                    "stage_tokens_in_total": "tokens_in",
+                    "stage_tokens_out_total": "tokens_out",
+                    "stage_bytes_in_total": "bytes_in",
+                    "stage_bytes_out_total": "bytes_out",
+                }.get(name)
+                if column:
+                    row = rows.setdefault(_stage_label(labels), _empty_row())
+                    row[column] += value
+
+        header = f"{'stage':<40}{'calls':>8}{'errors':>8}{'total s':>10}{'mean ms':>10}" \
+            f"{'tok in':>10}{'tok out':>10}{'KB in':>10}{'KB out':>10}"
+        lines = [header, "-" * len(header)]
+        for stage, row in sorted(rows.items(), key=lambda item: -item[1]["seconds"]):
+            mean_ms = row["seconds"] / row["calls"] * 1000 if row["calls"] else 0
+            lines.append(
+                f"{stage:<40}{row['calls']:>8}{row['errors']:>8}{row['seconds']:>10.1f}{mean_ms:>10.0f}"
+                f"{row['tokens_in']:>10}{row['tokens_out']:>10}"
+                f"{row['bytes_in'] / 1024:>10.0f}{row['bytes_out'] / 1024:>10.0f}")
+        return "\n".join(lines)
+
+
+def _empty_row():
+    return {"calls": 0, "errors": 0, "seconds": 0.0, "tokens_in": 0,
+            "tokens_out": 0, "bytes_in": 0, "bytes_out": 0}
+
+
+def _stage_label(labels):
+    labels = dict(labels)
+    stage = labels.pop("stage", "")
+    if labels:
+        stage += "[" + ",".join(str(v) for _, v in sorted(labels.items())) + "]"
+    return stage
+
+
+registry = Registry()
+_current_span = ContextVar("current_span", default=None)
+_trace_lock = threading.Lock()
+
+
+def _write_trace(record):
+    with _trace_lock:
+        with open(TRACE_FILE, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + "\n")
+
+
+@contextmanager
+def span(stage, **labels):
+    """
+    Times a stage and records its duration and any error. Spans nest per thread and per
+    asyncio task, so the trace file (if enabled) links each span to its parent and root trace.
+    """
+    parent = _current_span.get()
+    span_id = uuid.uuid4().hex[:16]
+    trace_id = parent["trace_id"] if parent else uuid.uuid4().hex
+    current = {"trace_id": trace_id, "span_id": span_id}
+    token = _current_span.set(current)
+
+    start = time.perf_counter()
+    error = None
+    try:
+        yield current
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        _current_span.reset(token)
+        duration = time.perf_counter() - start
+        registry.observe("stage_duration_seconds",
+                         duration, stage=stage, **labels)
+        if error is not None:
+            registry.inc("stage_errors_total", stage=stage, **labels)
+        if TRACE_FILE:
+            _write_trace({
+                "trace_id": trace_id,
+                "span_id": span_id,
+                "parent_id": parent["span_id"] if parent else None,
+                "stage": stage,
+                "labels": labels,
+                "start": time.time() - duration,
+                "duration": duration,
+                "error": repr(error) if error is not None else None,
+            })
+
+
+def traced(stage, **labels):
+    """
+    Decorator form of `span`, for both plain and async functions.
+    """
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(stage, **labels):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage, **labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_tokens(stage, tokens_in=None, tokens_out=None, **labels):
+    if tokens_in:
+        registry.inc("stage_tokens_in_total", tokens_in, stage=stage, **labels)
+    if tokens_out:
+        registry.inc("stage_tokens_out_total",
+                     tokens_out, stage=stage, **labels)
+
+
+def record_bytes(stage, bytes_in=None, bytes_out=None, **labels):
+    if bytes_in:
+        registry.inc("stage_bytes_in_total", bytes_in, stage=stage, **labels)
+    if bytes_out:
+        registry.inc("stage_bytes_out_total", bytes_out, stage=stage, **labels)
+
+
+STATEMENT_PATTERN = re.compile(
+    r'^\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b.*?\b(?:FROM|INTO|UPDATE)\s+"?(\w+)"?', re.IGNORECASE | re.DOTALL)
+
+
+def statement_name(query):
+    """
+    Reduces a SQL statement to a low-cardinality label such as "SELECT files".
+    """
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', errors='ignore')
+    match = STATEMENT_PATTERN.match(str(query))
+    if match:
+        verb, table = match.groups()
+        return f"{verb.upper()} {table}"
+    words = str(query).split()
+    return words[0].upper() if words else "unknown"
+
+
+class TracedCursor(psycopg2.extensions.cursor):
+    """
+    Cursor that records a span for every statement. Pass it as `cursor_factory` when
+    connecting or creating a pool.
+    """
+
+    def execute(self, query, vars=None):
+        with span("sql", statement=statement_name(query)):
+            return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        with span("sql", statement=statement_name(query)):
+            return super().executemany(query, vars_list)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port=METRICS_PORT):
+    """
+    Serves /metrics from a daemon thread so it can run next to the Gradio app.
+    """
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    print(f"Serving metrics on http://0.0.0.0:{port}/metrics")
+    return server
+
+
+def print_summary():
+    print("\nRun summary:")
+    print(registry.summary())
@@ -1,12 +1,35 @@
 import os
+import json
+import time
+import asyncio
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import httpx
 import requests
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from dotenv import load_dotenv
+from metrics import span, record_tokens, record_bytes, registry
 load_dotenv()
 
 
+# Per-call deadlines in seconds. A call that hasn't succeeded by its deadline raises
+# TimeoutError, however many attempts (including hedges) were made.
+CONNECT_TIMEOUT = 5
+DEADLINES = {
+    "embedding": float(os.getenv("EMBEDDING_DEADLINE", "30")),
+    "embedding_batch": float(os.getenv("EMBEDDING_BATCH_DEADLINE", "120")),
+    "llm": float(os.getenv("LLM_DEADLINE", "120")),
+}
+
 OPENAI_KEY = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=OPENAI_KEY)
+# Deadlines are enforced around each call, so the SDK's own retries are left off
+client = OpenAI(api_key=OPENAI_KEY, max_retries=0,
+                timeout=httpx.Timeout(DEADLINES["llm"], connect=CONNECT_TIMEOUT))
+async_client = AsyncOpenAI(api_key=OPENAI_KEY, max_retries=0,
+                           timeout=httpx.Timeout(DEADLINES["llm"], connect=CONNECT_TIMEOUT))
 OPENAI_LLM_MODEL = "gpt-4o-mini"
 OPENAI_VECTOR_MODEL = "text-embedding-3-small"
 OPENAI_CONTEXT_WINDOW = 128000
@@ -17,13 +40,415 @@ UBICLOUD_API_KEY = os.getenv("UBICLOUD_API_KEY")
 UBICLOUD_CONTEXT_WINDOW = 90000
 UBICLOUD_LLM_MODEL = "llama-3-2-3b-it"
 UBICLOUD_VECTOR_MODEL = "e5-mistral-7b-it"
+# Chat completion endpoint of each Ubicloud model; others are added as a JSON object in
+# UBICLOUD_LLM_ENDPOINTS, e.g. '{"<model>": "https://.../v1/chat/completions"}'
+UBICLOUD_LLM_ENDPOINTS = {UBICLOUD_LLM_MODEL: UBICLOUD_LLM_API_URL,
+                          **json.loads(os.getenv("UBICLOUD_LLM_ENDPOINTS") or "{}")}
+# Shared HTTP clients, so requests reuse keep-alive connections instead of a TLS handshake each
+HTTP_POOL_SIZE = 32
+http_session = requests.Session()
+http_session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE))
+async_http_client = httpx.AsyncClient(
+    timeout=httpx.Timeout(DEADLINES["llm"], connect=CONNECT_TIMEOUT))
 
 CONTEXT_WINDOW = min(OPENAI_CONTEXT_WINDOW, UBICLOUD_CONTEXT_WINDOW)
 
+# Token budgets for the retrieved context in question prompts
+OPENAI_CONTEXT_TOKEN_BUDGET = 6000
+UBICLOUD_CONTEXT_TOKEN_BUDGET = 3000
+CONTEXT_TOKEN_BUDGETS = {
+    "openai": OPENAI_CONTEXT_TOKEN_BUDGET,
+    "ubicloud": UBICLOUD_CONTEXT_TOKEN_BUDGET,
+}
+
+# Concurrent requests allowed per provider in bulk modes
+OPENAI_MAX_CONCURRENT_REQUESTS = 16
+UBICLOUD_MAX_CONCURRENT_REQUESTS = 4
+MAX_CONCURRENT_REQUESTS = {
+    "openai": OPENAI_MAX_CONCURRENT_REQUESTS,
+    "ubicloud": UBICLOUD_MAX_CONCURRENT_REQUESTS,
+}
+
+# Summarization routing. Inputs are sorted into tiers by size; each tier has a model per
+# provider and each kind of summary an output cap per tier. Trivial inputs go to a cheaper
+# model where the provider has one (Ubicloud's default is already its smallest), large ones
+# to a stronger model with a larger context window (gpt-4.1-mini: 1M tokens). Ubicloud has
+# no large model unless UBICLOUD_LARGE_LLM_MODEL names one with a configured endpoint; a
+# tier without a usable model falls back to the standard one, which is logged (see
+# `route_model`). Every tier can be changed through the environment.
+ROUTE_TIERS = [
+    ("trivial", 2000),
+    ("small", 24000),
+    ("large", float("inf")),
+]
+ROUTE_MODELS = {
+    "openai": {
+        "trivial": os.getenv("OPENAI_TRIVIAL_LLM_MODEL", "gpt-4.1-nano"),
+        "small": OPENAI_LLM_MODEL,
+        "large": os.getenv("OPENAI_LARGE_LLM_MODEL", "gpt-4.1-mini"),
+    },
+    "ubicloud": {
+        "trivial": os.getenv("UBICLOUD_TRIVIAL_LLM_MODEL", UBICLOUD_LLM_MODEL),
+        "small": UBICLOUD_LLM_MODEL,
+        "large": os.getenv("UBICLOUD_LARGE_LLM_MODEL"),
+    },
+}
+ROUTE_MAX_TOKENS = {
+    "file": {"trivial": 150, "small": 500, "large": 1000},
+    "folder": {"trivial": 250, "small": 500, "large": 800},
+    "commit": {"trivial": 150, "small": 300, "large": 500},
+}
+# Data and docs rarely need the large tier, however big they are
+DATA_SUFFIXES = ('.json', '.yaml', '.yml', '.xml', '.txt', '.md', '.out')
+# Appended to routed system prompts, so the model aims below the cap instead of being cut
+# off by it (at roughly 1.3 tokens per word, half the cap in words leaves some headroom)
+LENGTH_HINT = "Keep the summary under {words} words."
+# A summary that still hits its cap is retried once with this many times the room
+TRUNCATED_RETRY_FACTOR = 2
+
+
+class TruncatedResponse(Exception):
+    """
+    Raised by ask_openai and ask_ubicloud when a response was cut off by max_tokens; `text`
+    is what came back.
+    """
+
+    def __init__(self, text):
+        super().__init__("Response cut off by max_tokens")
+        self.text = text
+
+
+def route(provider, kind, text, file_name=None):
+    """
+    Picks the model and output cap for summarizing `text`. Returns (model, max_tokens).
+    """
+    tier = next(name for name, max_chars in ROUTE_TIERS if len(text) < max_chars)
+    if tier == "large" and file_name and file_name.endswith(DATA_SUFFIXES):
+        tier = "small"
+    return route_model(provider, tier), ROUTE_MAX_TOKENS[kind][tier]
+
+
+_route_fallbacks = set()
+
+
+def route_model(provider, tier):
+    """
+    Returns the tier's model, or the provider's standard model when the tier has none or
+    (for Ubicloud) its model has no endpoint in UBICLOUD_LLM_ENDPOINTS. Each fallback is
+    logged once per process.
+    """
+    model = ROUTE_MODELS[provider][tier]
+    if not model:
+        reason = "no model configured"
+    elif provider == "ubicloud" and model not in UBICLOUD_LLM_ENDPOINTS:
+        reason = f"no endpoint configured for {model} in UBICLOUD_LLM_ENDPOINTS"
+    else:
+        return model
+    default = OPENAI_LLM_MODEL if provider == "openai" else UBICLOUD_LLM_MODEL
+    if (provider, tier) not in _route_fallbacks:
+        _route_fallbacks.add((provider, tier))
+        registry.inc("llm_route_fallbacks_total", provider=provider, tier=tier)
+        print(f"The {tier} {provider} tier has {reason}; using {default} instead")
+    return default
+
+
+def routed_ask(provider, kind, file_name=None):
+    """
+    Returns an ask(system_prompt, user_prompt) function that routes every call through `route`.
+    """
+    ask = ask_openai if provider == "openai" else ask_ubicloud
+
+    def routed(system_prompt, user_prompt):
+        model, max_tokens = route(provider, kind, user_prompt, file_name)
+        registry.inc("llm_routed_calls_total",
+                     provider=provider, kind=kind, model=model, max_tokens=max_tokens)
+        system_prompt += "\n\n" + LENGTH_HINT.format(words=max_tokens // 2)
+        try:
+            return ask(system_prompt, user_prompt, model=model, max_tokens=max_tokens)
+        except TruncatedResponse:
+            registry.inc("llm_truncated_total",
+                         provider=provider, kind=kind, model=model)
+        try:
+            return ask(system_prompt, user_prompt, model=model,
+                       max_tokens=max_tokens * TRUNCATED_RETRY_FACTOR)
+        except TruncatedResponse as e:
+            # Still too long: a summary missing its end beats none
+            return e.text.strip()
+    return routed
+
+
+# Hedging: once a call has taken longer than the recent p95 for its provider and stage, a
+# duplicate is sent and whichever finishes first wins. At most HEDGE_BUDGET of calls are
+# hedged, so a provider that is slow across the board doesn't get twice the load.
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MIN_SECONDS = 0.2
+HEDGE_BUDGET = 0.05
+LATENCY_WINDOW = 200
+# Sync attempts run on a shared pool of this many threads; when all are busy, new calls fail
+# fast instead of queueing behind stalled ones, and no hedges are sent
+HEDGE_WORKERS = 64
+
+# A provider counts as degraded when this share of its questions in the last
+# DEGRADED_WINDOW_SECONDS failed; with PROVIDER_FALLBACK=1 the query path then answers with
+# the other provider, letting one question through every DEGRADED_PROBE_SECONDS to see
+# whether it recovered
+DEGRADED_ERROR_RATE = 0.5
+DEGRADED_MIN_SAMPLES = 10
+DEGRADED_WINDOW_SECONDS = 120
+DEGRADED_PROBE_SECONDS = 15
+PROVIDER_FALLBACK = os.getenv("PROVIDER_FALLBACK") == "1"
+FALLBACK_PROVIDERS = {"openai": "ubicloud", "ubicloud": "openai"}
+
+
+class CallStats:
+    """
+    Recent latencies and outcomes per (provider, stage), shared by threads and asyncio tasks.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.calls = {}
+        self.hedges = {}
+
+    def observe(self, key, seconds, ok):
+        if not ok:
+            return
+        with self.lock:
+            self.latencies.setdefault(key, deque(
+                maxlen=LATENCY_WINDOW)).append(seconds)
+
+    def start_call(self, key):
+        """
+        Counts a call and returns how long to wait before hedging it, or None to not hedge.
+        """
+        with self.lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+            latencies = self.latencies.get(key)
+            if not latencies or len(latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            return max(float(np.percentile(latencies, HEDGE_PERCENTILE)), HEDGE_MIN_SECONDS)
+
+    def take_hedge(self, key):
+        with self.lock:
+            if self.hedges.get(key, 0) >= HEDGE_BUDGET * self.calls.get(key, 0):
+                return False
+            self.hedges[key] = self.hedges.get(key, 0) + 1
+            return True
+
+
+class ProviderHealth:
+    """
+    Outcomes of recent questions answered by each provider (the query path only; ingestion
+    calls don't count), acting as a circuit breaker for the fallback.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.outcomes = {}
+        self.probed_at = {}
+
+    def record(self, provider, ok):
+        with self.lock:
+            self.outcomes.setdefault(provider, deque()).append(
+                (time.monotonic(), ok))
+
+    def error_rate(self, provider):
+        cutoff = time.monotonic() - DEGRADED_WINDOW_SECONDS
+        with self.lock:
+            outcomes = self.outcomes.get(provider, deque())
+            while outcomes and outcomes[0][0] < cutoff:
+                outcomes.popleft()
+            failures = sum(1 for _, ok in outcomes if not ok)
+            count = len(outcomes)
+        if count < DEGRADED_MIN_SAMPLES:
+            return 0.0
+        return failures / count
+
+    def is_degraded(self, provider):
+        return self.error_rate(provider) >= DEGRADED_ERROR_RATE
+
+    def allow(self, provider):
+        """
+        Whether a question should go to the provider: always while it's healthy, and once
+        per DEGRADED_PROBE_SECONDS while it's degraded.
+        """
+        if not self.is_degraded(provider):
+            return True
+        now = time.monotonic()
+        with self.lock:
+            if now - self.probed_at.get(provider, 0) < DEGRADED_PROBE_SECONDS:
+                return False
+            self.probed_at[provider] = now
+        registry.inc("provider_probes_total", provider=provider)
+        return True
+
+
+call_stats = CallStats()
+provider_health = ProviderHealth()
+_hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS)
+_hedge_slots = threading.BoundedSemaphore(HEDGE_WORKERS)
+
+
+def fallback_provider(provider):
+    """
+    The provider to answer with instead, or None when fallback is off.
+    """
+    return FALLBACK_PROVIDERS.get(provider) if PROVIDER_FALLBACK else None
+
+
+def hedged_call(provider, stage, fn):
+    """
+    Calls fn(timeout) under the stage's deadline, sending one duplicate if it runs past the
+    hedge delay. Each attempt gets the time left until the deadline as its request timeout,
+    so attempts abandoned at the deadline end shortly after instead of holding a thread.
+    Returns the first successful result; raises the last error if every attempt failed,
+    TimeoutError at the deadline, or RuntimeError right away when the pool is saturated.
+    """
+    key = (provider, stage)
+    deadline = DEADLINES[stage]
+    hedge_delay = call_stats.start_call(key)
+    start = time.monotonic()
+
+    def attempt():
+        attempt_start = time.perf_counter()
+        try:
+            result = fn(max(deadline - (time.monotonic() - start), 0.1))
+        except Exception:
+            call_stats.observe(
+                key, time.perf_counter() - attempt_start, False)
+            raise
+        finally:
+            _hedge_slots.release()
+        call_stats.observe(key, time.perf_counter() - attempt_start, True)
+        return result
+
+    def submit():
+        if not _hedge_slots.acquire(blocking=False):
+            return None
+        return _hedge_executor.submit(contextvars.copy_context().run, attempt)
+
+    primary = submit()
+    if primary is None:
+        registry.inc("call_pool_saturated_total",
+                     provider=provider, stage=stage)
+        raise RuntimeError(
+            f"{provider} {stage} call rejected: all {HEDGE_WORKERS} call threads are busy")
+    pending = {primary}
+    error = None
+    while pending:
+        elapsed = time.monotonic() - start
+        if elapsed >= deadline:
+            break
+        hedging = hedge_delay is not None and len(pending) == 1 and primary in pending
+        timeout = min(deadline, hedge_delay) - elapsed if hedging else deadline - elapsed
+        done, pending = wait(pending, timeout=max(timeout, 0),
+                             return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is not primary:
+                    registry.inc("hedge_wins_total",
+                                 provider=provider, stage=stage)
+                return future.result()
+            error = future.exception()
+        if not done and hedging:
+            hedge_delay = None
+            if call_stats.take_hedge(key):
+                hedge = submit()
+                if hedge is not None:
+                    registry.inc("hedged_requests_total",
+                                 provider=provider, stage=stage)
+                    pending.add(hedge)
+    if error is not None and not pending:
+        raise error
+    registry.inc("deadline_exceeded_total", provider=provider, stage=stage)
+    raise TimeoutError(
+        f"{provider} {stage} call exceeded its {deadline:.0f}s deadline")
+
+
+async def hedged_call_async(provider, stage, make_coroutine):
+    """
+    Async form of `hedged_call`; make_coroutine() starts one attempt. Losing attempts are cancelled.
+    """
+    key = (provider, stage)
+    deadline = DEADLINES[stage]
+    hedge_delay = call_stats.start_call(key)
+    start = time.monotonic()
+
+    async def attempt():
+        attempt_start = time.perf_counter()
+        try:
+            result = await make_coroutine()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            call_stats.observe(
+                key, time.perf_counter() - attempt_start, False)
+            raise
+        call_stats.observe(key, time.perf_counter() - attempt_start, True)
+        return result
+
+    primary = asyncio.ensure_future(attempt())
+    pending = {primary}
+    error = None
+    try:
+        while pending:
+            elapsed = time.monotonic() - start
+            if elapsed >= deadline:
+                break
+            hedging = hedge_delay is not None and len(pending) == 1 and primary in pending
+            timeout = min(deadline, hedge_delay) - elapsed if hedging else deadline - elapsed
+            done, pending = await asyncio.wait(pending, timeout=max(timeout, 0),
+                                               return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is not primary:
+                        registry.inc("hedge_wins_total",
+                                     provider=provider, stage=stage)
+                    return task.result()
+                error = task.exception()
+            if not done and hedging:
+                hedge_delay = None
+                if call_stats.take_hedge(key):
+                    registry.inc("hedged_requests_total",
+                                 provider=provider, stage=stage)
+                    pending.add(asyncio.ensure_future(attempt()))
+    finally:
+        for task in pending:
+            task.cancel()
+    if error is not None and not pending:
+        raise error
+    registry.inc("deadline_exceeded_total", provider=provider, stage=stage)
+    raise TimeoutError(
+        f"{provider} {stage} call exceeded its {deadline:.0f}s deadline")
+
+
+def post_ubicloud(url, headers, data, timeout):
+    response = http_session.post(url, headers=headers, json=data,
+                                 timeout=(min(CONNECT_TIMEOUT, timeout), timeout))
+    if response.status_code != 200:
+        raise Exception(
+            f"Error: {response.status_code} - {response.text}")
+    return response
+
+
+async def post_ubicloud_async(url, data):
+    response = await async_http_client.post(url, headers=ubicloud_headers(), json=data)
+    if response.status_code != 200:
+        raise Exception(
+            f"Error: {response.status_code} - {response.text}")
+    return response
+
 
 def generate_openai_embedding(text: str) -> list:
-    response = client.embeddings.create(model=OPENAI_VECTOR_MODEL, input=text)
-    embedding = response.data[0].embedding
+    with span("embedding", provider="openai"):
+        response = hedged_call("openai", "embedding", lambda timeout: client.embeddings.create(
+            model=OPENAI_VECTOR_MODEL, input=text, timeout=timeout))
+        embedding = response.data[0].embedding
+    record_tokens("embedding", response.usage.prompt_tokens,
+                  provider="openai")
+    record_bytes("embedding", len(text.encode('utf-8')), provider="openai")
     return embedding
 
 
@@ -38,35 +463,170 @@ def generate_ubicloud_embedding(text: str) -> list:
         "input": text
     }
 
-    response = requests.post(UBICLOUD_VECTOR_API_URL,
-                             headers=headers, json=data)
-
-    if response.status_code != 200:
-        raise Exception(f"Error: {response.status_code} - {response.text}")
+    with span("embedding", provider="ubicloud"):
+        response = hedged_call("ubicloud", "embedding", lambda timeout: post_ubicloud(
+            UBICLOUD_VECTOR_API_URL, headers, data, timeout))
 
+    record_bytes("embedding", len(text.encode('utf-8')),
+                 len(response.content), provider="ubicloud")
     response = response.json()
+    record_tokens("embedding", response.get("usage", {}).get(
+        "prompt_tokens"), provider="ubicloud")
     return response['data'][0]['embedding']
 
 
-def ask_openai(system_prompt: str, user_prompt: str) -> str:
-    chat_completion = client.chat.completions.create(
-        messages=[
+def generate_openai_embeddings(texts: list) -> list:
+    with span("embedding_batch", provider="openai"):
+        response = hedged_call("openai", "embedding_batch", lambda timeout: client.embeddings.create(
+            model=OPENAI_VECTOR_MODEL, input=texts, timeout=timeout))
+    record_tokens("embedding_batch", response.usage.prompt_tokens,
+                  provider="openai")
+    record_bytes("embedding_batch", sum(len(text.encode('utf-8'))
+                 for text in texts), provider="openai")
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+def generate_ubicloud_embeddings(texts: list) -> list:
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {UBICLOUD_API_KEY}"
+    }
+
+    data = {
+        "model": UBICLOUD_VECTOR_MODEL,
+        "input": texts
+    }
+
+    with span("embedding_batch", provider="ubicloud"):
+        response = hedged_call("ubicloud", "embedding_batch", lambda timeout: post_ubicloud(
+            UBICLOUD_VECTOR_API_URL, headers, data, timeout))
+
+    record_bytes("embedding_batch", sum(len(text.encode('utf-8')) for text in texts),
+                 len(response.content), provider="ubicloud")
+    response = response.json()
+    record_tokens("embedding_batch", response.get("usage", {}).get(
+        "prompt_tokens"), provider="ubicloud")
+    return [item['embedding'] for item in sorted(response['data'], key=lambda item: item['index'])]
+
+
+def ask_openai(system_prompt: str, user_prompt: str, model=None, max_tokens=None) -> str:
+    model = model or OPENAI_LLM_MODEL
+    options = {"max_tokens": max_tokens} if max_tokens else {}
+    with span("llm", provider="openai"):
+        chat_completion = hedged_call("openai", "llm", lambda timeout: client.chat.completions.create(
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            model=model,
+            timeout=timeout,
+            **options,
+        ))
+        response = chat_completion.choices[0].message.content
+        if not response:
+            raise Exception("No response from OpenAI")
+    if chat_completion.usage:
+        record_tokens("llm", chat_completion.usage.prompt_tokens,
+                      chat_completion.usage.completion_tokens, provider="openai")
+    record_bytes("llm", len(system_prompt.encode('utf-8')) + len(user_prompt.encode('utf-8')),
+                 len(response.encode('utf-8')), provider="openai")
+    if max_tokens and chat_completion.choices[0].finish_reason == "length":
+        raise TruncatedResponse(response)
+    return response.strip()
+
+
+def ask_ubicloud(system_prompt: str, user_prompt: str, model=None, max_tokens=None) -> str:
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {UBICLOUD_API_KEY}"
+    }
+    model = model or UBICLOUD_LLM_MODEL
+    data = {
+        "model": model,
+        "messages": [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_prompt}
         ],
-        model=OPENAI_LLM_MODEL,
-    )
-    response = chat_completion.choices[0].message.content
-    if not response:
-        raise Exception("No response from OpenAI")
-    return response.strip()
+        "stream": False
+    }
+    if max_tokens:
+        data["max_tokens"] = max_tokens
+    api_url = UBICLOUD_LLM_ENDPOINTS.get(model)
+    if api_url is None:
+        raise ValueError(
+            f"No endpoint configured for Ubicloud model '{model}'; add it to UBICLOUD_LLM_ENDPOINTS")
+    with span("llm", provider="ubicloud"):
+        response = hedged_call("ubicloud", "llm", lambda timeout: post_ubicloud(
+            api_url, headers, data, timeout))
+    response_data = response.json()
+    usage = response_data.get("usage", {})
+    record_tokens("llm", usage.get("prompt_tokens"),
+                  usage.get("completion_tokens"), provider="ubicloud")
+    record_bytes("llm", len(system_prompt.encode('utf-8')) + len(user_prompt.encode('utf-8')),
+                 len(response.content), provider="ubicloud")
+    choice = response_data["choices"][0]
+    if max_tokens and choice.get("finish_reason") == "length":
+        raise TruncatedResponse(choice["message"]["content"])
+    return choice["message"]["content"].strip()
 
 
-def ask_ubicloud(system_prompt: str, user_prompt: str) -> str:
-    headers = {
+def ubicloud_headers():
+    return {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {UBICLOUD_API_KEY}"
     }
+
+
+async def generate_openai_embedding_async(text: str) -> list:
+    with span("embedding", provider="openai"):
+        response = await hedged_call_async("openai", "embedding", lambda: async_client.embeddings.create(
+            model=OPENAI_VECTOR_MODEL, input=text, timeout=DEADLINES["embedding"]))
+        embedding = response.data[0].embedding
+    record_tokens("embedding", response.usage.prompt_tokens,
+                  provider="openai")
+    record_bytes("embedding", len(text.encode('utf-8')), provider="openai")
+    return embedding
+
+
+async def generate_ubicloud_embedding_async(text: str) -> list:
+    data = {
+        "model": UBICLOUD_VECTOR_MODEL,
+        "input": text
+    }
+
+    with span("embedding", provider="ubicloud"):
+        response = await hedged_call_async("ubicloud", "embedding", lambda: post_ubicloud_async(
+            UBICLOUD_VECTOR_API_URL, data))
+
+    record_bytes("embedding", len(text.encode('utf-8')),
+                 len(response.content), provider="ubicloud")
+    response = response.json()
+    record_tokens("embedding", response.get("usage", {}).get(
+        "prompt_tokens"), provider="ubicloud")
+    return response['data'][0]['embedding']
+
+
+async def ask_openai_async(system_prompt: str, user_prompt: str) -> str:
+    with span("llm", provider="openai"):
+        chat_completion = await hedged_call_async("openai", "llm", lambda: async_client.chat.completions.create(
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            model=OPENAI_LLM_MODEL,
+        ))
+        response = chat_completion.choices[0].message.content
+        if not response:
+            raise Exception("No response from OpenAI")
+    if chat_completion.usage:
+        record_tokens("llm", chat_completion.usage.prompt_tokens,
+                      chat_completion.usage.completion_tokens, provider="openai")
+    record_bytes("llm", len(system_prompt.encode('utf-8')) + len(user_prompt.encode('utf-8')),
+                 len(response.encode('utf-8')), provider="openai")
+    return response.strip()
+
+
+async def ask_ubicloud_async(system_prompt: str, user_prompt: str) -> str:
     data = {
         "model": UBICLOUD_LLM_MODEL,
         "messages": [
@@ -75,8 +635,23 @@ def ask_ubicloud(system_prompt: str, user_prompt: str) -> str:
         ],
         "stream": False
     }
-    response = requests.post(UBICLOUD_LLM_API_URL, headers=headers, json=data)
-    if response.status_code != 200:
-        raise Exception(f"Error: {response.status_code} - {response.text}")
+    with span("llm", provider="ubicloud"):
+        response = await hedged_call_async("ubicloud", "llm", lambda: post_ubicloud_async(
+            UBICLOUD_LLM_API_URL, data))
     response_data = response.json()
+    usage = response_data.get("usage", {})
+    record_tokens("llm", usage.get("prompt_tokens"),
+                  usage.get("completion_tokens"), provider="ubicloud")
+    record_bytes("llm", len(system_prompt.encode('utf-8')) + len(user_prompt.encode('utf-8')),
+                 len(response.content), provider="ubicloud")
     return response_data["choices"][0]["message"]["content"].strip()
+
+
+async def warm_up_http_async():
+    """
+    Opens keep-alive connections to every provider host ahead of the first question. Any
+    response will do, so the Ubicloud hosts just get a cheap GET on their base URL.
+    """
+    await async_client.models.retrieve(OPENAI_LLM_MODEL)
+    for url in {UBICLOUD_LLM_API_URL, UBICLOUD_VECTOR_API_URL}:
+        await async_http_client.get(url.split("/v1/")[0] + "/v1/models", headers=ubicloud_headers())
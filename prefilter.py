@@ -0,0 +1,181 @@
+import os
+import sys
+import json
+import fnmatch
+import subprocess
+import threading
+import numpy as np
+
+# Per-repo rules live in this file, keyed by repo name, with "default" applying to every repo:
+# {"default": {"max_bytes": 200000}, "citus": {"exclude": ["src/test/regress/expected/*"]}}
+PREFILTER_CONFIG = "prefilter.json"
+
+DEFAULT_RULES = {
+    # Files larger than this are skipped outright
+    "max_bytes": 200_000,
+    # Files larger than this multiple of the repo's 95th percentile file size are skipped
+    "outlier_factor": 10,
+    # Files whose lines average more than this many characters are treated as minified
+    "max_average_line_length": 200,
+    # Glob patterns (on the path relative to the repo root) to always skip or always keep
+    "exclude": [],
+    "include": [],
+    # Directories (one or more whole path components) that mark vendored or generated code
+    # when .gitattributes says nothing
+    "vendored_paths": ["vendor/", "third_party/", "thirdparty/", "node_modules/", "dist/", "build/"],
+    "generated_suffixes": [".min.js", ".min.css", ".map", ".pb.go", "_pb2.py", ".lock"],
+    "generated_markers": ["@generated", "DO NOT EDIT", "Code generated by", "auto-generated"],
+}
+
+# Bytes read from the start of each file for the binary, minified and generated checks
+SNIFF_BYTES = 8192
+
+
+def load_rules(repo_name, config_path=PREFILTER_CONFIG):
+    rules = dict(DEFAULT_RULES)
+    if os.path.exists(config_path):
+        with open(config_path, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        rules.update(config.get("default", {}))
+        rules.update(config.get(repo_name, {}))
+    return rules
+
+
+def under_directory(relative_path, fragment):
+    """
+    Returns whether a directory of the path, as whole components, matches the fragment
+    ("vendor/" matches "vendor/x.go" and "a/vendor/x.go" but not "myvendor/x.go").
+    """
+    directories = relative_path.split(os.sep)[:-1]
+    parts = [part for part in fragment.split("/") if part]
+    return bool(parts) and any(directories[i:i + len(parts)] == parts
+                               for i in range(len(directories) - len(parts) + 1))
+
+
+def git_lines(repo_path, args, paths):
+    """
+    Runs a git command that reads paths from stdin and returns its output lines, or an
+    empty list when the checkout isn't a git repository.
+    """
+    if not paths:
+        return []
+    result = subprocess.run(["git", "-C", repo_path] + args, input="\n".join(paths),
+                            capture_output=True, text=True)
+    # check-ignore exits with 1 when nothing is ignored
+    if result.returncode not in (0, 1):
+        return []
+    return result.stdout.splitlines()
+
+
+class Prefilter:
+    """
+    Decides which files in a repo checkout are worth summarizing. All git lookups
+    (.gitignore, linguist-generated / linguist-vendored attributes) and the size
+    distribution are computed once up front from the list of candidate files.
+    """
+
+    def __init__(self, repo_name, repo_path, candidates, rules=None):
+        self.repo_name = repo_name
+        self.repo_path = repo_path
+        self.rules = rules or load_rules(repo_name)
+        self.candidates = candidates
+        self.lock = threading.Lock()
+        self.skipped = {}
+
+        relative_paths = [os.path.relpath(path, repo_path)
+                          for path in candidates]
+        self.ignored = set(git_lines(
+            repo_path, ["check-ignore", "--stdin"], relative_paths))
+        self.attributed = {}
+        for line in git_lines(repo_path, ["check-attr", "--stdin", "linguist-generated", "linguist-vendored"], relative_paths):
+            path, attribute, value = line.rsplit(": ", 2)
+            if value in ("set", "true"):
+                self.attributed.setdefault(path, attribute)
+
+        sizes = [os.path.getsize(path)
+                 for path in candidates if os.path.isfile(path)]
+        self.outlier_bytes = float(np.percentile(
+            sizes, 95)) * self.rules["outlier_factor"] if sizes else None
+
+    @classmethod
+    def for_repo(cls, repo_name, repo_path, is_acceptable_folder, is_acceptable_file):
+        candidates = []
+        for root, dirs, files in os.walk(repo_path):
+            dirs[:] = [d for d in dirs if is_acceptable_folder(d)]
+            candidates.extend(os.path.join(root, f)
+                              for f in files if is_acceptable_file(f))
+        return cls(repo_name, repo_path, candidates)
+
+    def reason(self, file_path):
+        """
+        Returns why the file should be skipped, or None to keep it.
+        """
+        rules = self.rules
+        relative_path = os.path.relpath(file_path, self.repo_path)
+        if any(fnmatch.fnmatch(relative_path, pattern) for pattern in rules["include"]):
+            return None
+        if any(fnmatch.fnmatch(relative_path, pattern) for pattern in rules["exclude"]):
+            return "excluded"
+        if relative_path in self.ignored:
+            return "gitignored"
+        if relative_path in self.attributed:
+            return self.attributed[relative_path]
+        if any(under_directory(relative_path, fragment) for fragment in rules["vendored_paths"]):
+            return "vendored"
+        if relative_path.endswith(tuple(rules["generated_suffixes"])):
+            return "generated"
+
+        size = os.path.getsize(file_path)
+        if size > rules["max_bytes"]:
+            return "too large"
+        if self.outlier_bytes and size > self.outlier_bytes:
+            return "size outlier"
+
+        with open(file_path, 'rb') as f:
+            head = f.read(SNIFF_BYTES)
+        if b"\0" in head:
+            return "binary"
+        text = head.decode('utf-8', errors='ignore')
+        lines = text.splitlines() or [""]
+        if len(head) > 1024 and len(text) / len(lines) > rules["max_average_line_length"]:
+            return "minified"
+        first_lines = "\n".join(lines[:5])
+        if any(marker in first_lines for marker in rules["generated_markers"]):
+            return "generated"
+        return None
+
+    def accept(self, file_path):
+        """
+        Returns whether to summarize the file, recording the reason when it is skipped.
+        """
+        reason = self.reason(file_path)
+        if reason:
+            with self.lock:
+                self.skipped.setdefault(reason, []).append(
+                    os.path.relpath(file_path, self.repo_path))
+            return False
+        return True
+
+    def report(self, verbose=False):
+        total = sum(len(paths) for paths in self.skipped.values())
+        print(f"Prefilter skipped {total} of {len(self.candidates)} files in '{self.repo_name}':")
+        for reason, paths in sorted(self.skipped.items()):
+            print(f"  {reason:<20} {len(paths)}")
+            for path in sorted(paths)[:None if verbose else 3]:
+                print(f"      {path}")
+
+
+if __name__ == '__main__':
+    from process_repo import is_acceptable_file, is_acceptable_folder
+
+    if len(sys.argv) < 2:
+        print("Usage: python prefilter.py <repo> [--verbose]")
+        sys.exit(1)
+
+    repo_name = sys.argv[1]
+    repo_path = f"repos/{repo_name}"
+    prefilter = Prefilter.for_repo(
+        repo_name, repo_path, is_acceptable_folder, is_acceptable_file)
+    for file_path in prefilter.candidates:
+        prefilter.accept(file_path)
+    prefilter.report("--verbose" in sys.argv[2:])
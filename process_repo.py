@@ -2,12 +2,24 @@ import os
 import re
 import sys
 import argparse
+import json
+import bisect
+import functools
+import tempfile
+import threading
 from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.extras import execute_values
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from pgconf_utils import ask_openai, ask_ubicloud, OPENAI_CONTEXT_WINDOW, UBICLOUD_CONTEXT_WINDOW, CONTEXT_WINDOW
+from pgconf_utils import routed_ask, OPENAI_CONTEXT_WINDOW, UBICLOUD_CONTEXT_WINDOW, CONTEXT_WINDOW
 from dotenv import load_dotenv
 from backfill_embeddings import backfill
 from contextlib import contextmanager
+from metrics import TracedCursor, traced, print_summary, registry
+from journal import Journal, track, print_progress
+from code_store import stored_code
+from prefilter import Prefilter
+from write_behind import WriteBehind
+from embedding_pipeline import EmbeddingPipeline
 load_dotenv()
 
 MAX_WORKERS = 2
@@ -17,7 +29,7 @@ MAX_CONNECTIONS = 40
 # Database connection pool
 DATABASE_URL = os.getenv("DATABASE_URL")
 connection_pool = ThreadedConnectionPool(
-    MIN_CONNECTIONS, MAX_CONNECTIONS, DATABASE_URL)
+    MIN_CONNECTIONS, MAX_CONNECTIONS, DATABASE_URL, cursor_factory=TracedCursor)
 
 
 @contextmanager
@@ -36,53 +48,71 @@ FOLDER_PROMPT = """You are a helpful code assistant. You will receive summaries
 FOLDER_SUMMARIES_PROMPT = """You are a helpful code assistant. You will receive summaries of the files and subfolders in this folder. You will summarize what the folder does."""
 COMMIT_PROMPT = """You are a helpful code assistant. You will receive a commit, including the commit message, and the changes made in the commit. You will summarize the commit."""
 
-# Queries
+# Queries; the upserts take a list of rows through execute_values
 INSERT_COMMIT = """
-    INSERT INTO commits ("repo", "id", "author", "date", "changes", "title", "message", "llm_openai", "llm_ubicloud")
-    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-    ON CONFLICT ("repo", "id") DO UPDATE SET "llm_openai" = EXCLUDED."llm_openai", "llm_ubicloud" = EXCLUDED."llm_ubicloud", "updated_at" = now();
+    INSERT INTO commits ("repo", "id", "author", "author_name", "author_email", "date", "committed_at", "files_changed", "folders_changed", "changes", "title", "message", "llm_openai", "llm_ubicloud")
+    VALUES %s
+    ON CONFLICT ("repo", "id") DO UPDATE SET "author_name" = EXCLUDED."author_name", "author_email" = EXCLUDED."author_email", "committed_at" = EXCLUDED."committed_at", "files_changed" = EXCLUDED."files_changed", "folders_changed" = EXCLUDED."folders_changed", "llm_openai" = EXCLUDED."llm_openai", "llm_ubicloud" = EXCLUDED."llm_ubicloud", "updated_at" = now();
 """
 INSERT_COMMIT_OPENAI = """
-    INSERT INTO commits ("repo", "id", "author", "date", "changes", "title", "message", "llm_openai")
-    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-    ON CONFLICT ("repo", "id") DO UPDATE SET "llm_openai" = EXCLUDED."llm_openai", "updated_at" = now();
+    INSERT INTO commits ("repo", "id", "author", "author_name", "author_email", "date", "committed_at", "files_changed", "folders_changed", "changes", "title", "message", "llm_openai")
+    VALUES %s
+    ON CONFLICT ("repo", "id") DO UPDATE SET "author_name" = EXCLUDED."author_name", "author_email" = EXCLUDED."author_email", "committed_at" = EXCLUDED."committed_at", "files_changed" = EXCLUDED."files_changed", "folders_changed" = EXCLUDED."folders_changed", "llm_openai" = EXCLUDED."llm_openai", "updated_at" = now();
 """
 INSERT_COMMIT_UBICLOUD = """
-    INSERT INTO commits ("repo", "id", "author", "date", "changes", "title", "message", "llm_ubicloud")
-    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-    ON CONFLICT ("repo", "id") DO UPDATE SET "llm_ubicloud" = EXCLUDED."llm_ubicloud", "updated_at" = now();
+    INSERT INTO commits ("repo", "id", "author", "author_name", "author_email", "date", "committed_at", "files_changed", "folders_changed", "changes", "title", "message", "llm_ubicloud")
+    VALUES %s
+    ON CONFLICT ("repo", "id") DO UPDATE SET "author_name" = EXCLUDED."author_name", "author_email" = EXCLUDED."author_email", "committed_at" = EXCLUDED."committed_at", "files_changed" = EXCLUDED."files_changed", "folders_changed" = EXCLUDED."folders_changed", "llm_ubicloud" = EXCLUDED."llm_ubicloud", "updated_at" = now();
 """
 INSERT_FOLDER = """
     INSERT INTO folders ("name", "repo", "llm_openai", "llm_ubicloud")
-    VALUES (%s, %s, %s, %s)
+    VALUES %s
     ON CONFLICT ("name", "repo") DO UPDATE SET "llm_openai" = EXCLUDED."llm_openai", "llm_ubicloud" = EXCLUDED."llm_ubicloud", "updated_at" = now();
 """
 INSERT_FOLDER_OPENAI = """
     INSERT INTO folders ("name", "repo", "llm_openai")
-    VALUES (%s, %s, %s)
+    VALUES %s
     ON CONFLICT ("name", "repo") DO UPDATE SET "llm_openai" = EXCLUDED."llm_openai", "updated_at" = now();
 """
 INSERT_FOLDER_UBICLOUD = """
     INSERT INTO folders ("name", "repo", "llm_ubicloud")
-    VALUES (%s, %s, %s)
+    VALUES %s
     ON CONFLICT ("name", "repo") DO UPDATE SET "llm_ubicloud" = EXCLUDED."llm_ubicloud", "updated_at" = now();
 """
 INSERT_FILE = """
-    INSERT INTO files ("name", "folder", "repo", "code", "llm_openai", "llm_ubicloud")
-    VALUES (%s, %s, %s, %s, %s, %s)
-    ON CONFLICT ("name", "folder", "repo") DO UPDATE SET "code" = EXCLUDED."code", "llm_openai" = EXCLUDED."llm_openai", "llm_ubicloud" = EXCLUDED."llm_ubicloud", "updated_at" = now();
+    INSERT INTO files ("name", "folder", "repo", "code", "code_sha", "llm_openai", "llm_ubicloud")
+    VALUES %s
+    ON CONFLICT ("name", "folder", "repo") DO UPDATE SET "code" = EXCLUDED."code", "code_sha" = EXCLUDED."code_sha", "llm_openai" = EXCLUDED."llm_openai", "llm_ubicloud" = EXCLUDED."llm_ubicloud", "updated_at" = now();
 """
 INSERT_FILE_OPENAI = """
-    INSERT INTO files ("name", "folder", "repo", "code", "llm_openai")
-    VALUES (%s, %s, %s, %s, %s)
-    ON CONFLICT ("name", "folder", "repo") DO UPDATE SET "code" = EXCLUDED."code", "llm_openai" = EXCLUDED."llm_openai", "updated_at" = now();
+    INSERT INTO files ("name", "folder", "repo", "code", "code_sha", "llm_openai")
+    VALUES %s
+    ON CONFLICT ("name", "folder", "repo") DO UPDATE SET "code" = EXCLUDED."code", "code_sha" = EXCLUDED."code_sha", "llm_openai" = EXCLUDED."llm_openai", "updated_at" = now();
 """
 INSERT_FILE_UBICLOUD = """
-    INSERT INTO files ("name", "folder", "repo", "code", "llm_ubicloud")
-    VALUES (%s, %s, %s, %s, %s)
-    ON CONFLICT ("name", "folder", "repo") DO UPDATE SET "code" = EXCLUDED."code", "llm_ubicloud" = EXCLUDED."llm_ubicloud", "updated_at" = now();
+    INSERT INTO files ("name", "folder", "repo", "code", "code_sha", "llm_ubicloud")
+    VALUES %s
+    ON CONFLICT ("name", "folder", "repo") DO UPDATE SET "code" = EXCLUDED."code", "code_sha" = EXCLUDED."code_sha", "llm_ubicloud" = EXCLUDED."llm_ubicloud", "updated_at" = now();
 """
 
+FETCH_TOP_LEVEL_FOLDERS = """SELECT "name", "llm_openai", "llm_ubicloud" FROM folders WHERE "repo" = %s AND "name" NOT LIKE '%%/%%' ORDER BY "name" """
+# Every stored file and folder summary of a repo (or of one folder's files and subtree), and
+# whether it is newer than the override timestamp
+FETCH_SUMMARY_STATE = """
+    SELECT 'file', "folder", "name", "llm_openai", "llm_ubicloud", coalesce("updated_at" > %(override)s::timestamptz, true)
+    FROM files
+    WHERE "repo" = %(repo)s AND (%(folder)s::text IS NULL OR "folder" = %(folder)s)
+    UNION ALL
+    SELECT 'folder', NULL, "name", "llm_openai", "llm_ubicloud", coalesce("updated_at" > %(override)s::timestamptz, true)
+    FROM folders
+    WHERE "repo" = %(repo)s AND (%(folder)s::text IS NULL OR "name" = %(folder)s OR "name" LIKE %(subfolders)s)
+"""
+UPDATE_REPO_OVERVIEW = """UPDATE repos SET "overview_openai" = %s, "overview_ubicloud" = %s, "updated_at" = now() WHERE "name" = %s"""
+
+# Repo overview, the stable prefix of every question prompt
+OVERVIEW_MAX_CHARS = 8000
+OVERVIEW_FOLDER_CHARS = 600
+
 
 def is_acceptable_file(file_name):
     ACCEPTABLE_SUFFIXES = [
@@ -111,53 +141,186 @@ def insert_repo(repo_name):
             INSERT_REPO = """INSERT INTO repos ("name") VALUES (%s) ON CONFLICT DO NOTHING;"""
             cur.execute(INSERT_REPO, (repo_name,))
         conn.commit()
+    update_repo_overview(repo_name)
 
 
-def insert_folder(folder_name, repo_name, llm_openai, llm_ubicloud):
+def build_overview(folders):
+    """
+    Builds a compact overview of a repo from (name, summary) pairs for its root and
+    top-level folders: the root summary followed by the first paragraph of each folder.
+    """
+    root = next((summary for name, summary in folders if name == '.'), None)
+    parts = [root.strip()] if root else []
+    subfolders = [(name, summary)
+                  for name, summary in folders if name != '.' and summary]
+    if subfolders:
+        parts.append("Top-level folders:")
+        for name, summary in subfolders:
+            paragraph = summary.strip().split("\n\n")[0]
+            parts.append(f"- {name}/: {paragraph[:OVERVIEW_FOLDER_CHARS]}")
+    return "\n".join(parts)[:OVERVIEW_MAX_CHARS] or None
+
+
+def update_repo_overview(repo_name):
     with pool_connection() as conn:
         with conn.cursor() as cur:
-            if llm_openai and llm_ubicloud:
-                cur.execute(INSERT_FOLDER, (folder_name, repo_name,
-                            llm_openai.strip(), llm_ubicloud.strip()))
-            elif llm_openai:
-                cur.execute(INSERT_FOLDER_OPENAI,
-                            (folder_name, repo_name, llm_openai.strip()))
-            elif llm_ubicloud:
-                cur.execute(INSERT_FOLDER_UBICLOUD,
-                            (folder_name, repo_name, llm_ubicloud.strip()))
+            cur.execute(FETCH_TOP_LEVEL_FOLDERS, (repo_name,))
+            folders = cur.fetchall()
+            overview_openai = build_overview(
+                [(name, llm_openai) for name, llm_openai, _ in folders])
+            overview_ubicloud = build_overview(
+                [(name, llm_ubicloud) for name, _, llm_ubicloud in folders])
+            cur.execute(UPDATE_REPO_OVERVIEW,
+                        (overview_openai, overview_ubicloud, repo_name))
         conn.commit()
 
 
-def insert_file(file_name, folder_name, repo_name, file_content, llm_openai, llm_ubicloud):
-    with pool_connection() as conn:
-        with conn.cursor() as cur:
-            if llm_openai and llm_ubicloud:
-                cur.execute(INSERT_FILE, (file_name, folder_name, repo_name,
-                            file_content, llm_openai.strip(), llm_ubicloud.strip()))
-            elif llm_openai:
-                cur.execute(INSERT_FILE_OPENAI, (file_name, folder_name,
-                            repo_name, file_content, llm_openai.strip()))
-            elif llm_ubicloud:
-                cur.execute(INSERT_FILE_UBICLOUD, (file_name, folder_name,
-                            repo_name, file_content, llm_ubicloud.strip()))
-        conn.commit()
+@functools.lru_cache(maxsize=None)
+def with_vectors(statement, providers):
+    """
+    The upsert with the providers' vector columns added, for rows written together with
+    their embeddings.
+    """
+    columns = "".join(f', "vector_{provider}"' for provider in providers)
+    updates = "".join(
+        f'"vector_{provider}" = EXCLUDED."vector_{provider}", ' for provider in providers)
+    return statement.replace(")\n    VALUES", columns + ")\n    VALUES", 1).replace(
+        '"updated_at" = now()', updates + '"updated_at" = now()', 1)
 
 
-def insert_commit(repo_name, commit_id, author, date, changes, title, message, llm_openai, llm_ubicloud):
+def write(statement, key, row, writer=None, vectors=None):
+    """
+    Queues an upsert on the write-behind batcher or, without one, writes it right away.
+    `vectors` maps providers to embeddings to store in the same row; a provider mapped to
+    None has its vector cleared.
+    """
+    if vectors:
+        providers = tuple(p for p in ("openai", "ubicloud") if p in vectors)
+        statement = with_vectors(statement, providers)
+        row = row + tuple(None if vectors[p] is None else json.dumps(vectors[p])
+                          for p in providers)
+    if writer is not None:
+        # Keys are (kind, repo, *path); the journal knows the item as (kind, "path/...")
+        writer.add(statement, key, row, (key[0], "/".join(key[2:])))
+        return
     with pool_connection() as conn:
         with conn.cursor() as cur:
-            if llm_openai and llm_ubicloud:
-                cur.execute(INSERT_COMMIT, (repo_name, commit_id, author, date,
-                            changes, title, message, llm_openai.strip(), llm_ubicloud.strip()))
-            elif llm_openai:
-                cur.execute(INSERT_COMMIT_OPENAI, (repo_name, commit_id,
-                            author, date, changes, title, message, llm_openai.strip()))
-            elif llm_ubicloud:
-                cur.execute(INSERT_COMMIT_UBICLOUD, (repo_name, commit_id,
-                            author, date, changes, title, message, llm_ubicloud.strip()))
+            execute_values(cur, statement, [row])
         conn.commit()
 
 
+def insert_folder(folder_name, repo_name, llm_openai, llm_ubicloud, writer=None, vectors=None):
+    key = ("folder", repo_name, folder_name)
+    if llm_openai and llm_ubicloud:
+        write(INSERT_FOLDER, key, (folder_name, repo_name,
+              llm_openai.strip(), llm_ubicloud.strip()), writer, vectors)
+    elif llm_openai:
+        write(INSERT_FOLDER_OPENAI, key,
+              (folder_name, repo_name, llm_openai.strip()), writer, vectors)
+    elif llm_ubicloud:
+        write(INSERT_FOLDER_UBICLOUD, key,
+              (folder_name, repo_name, llm_ubicloud.strip()), writer, vectors)
+
+
+def insert_file(file_name, folder_name, repo_name, file_content, llm_openai, llm_ubicloud, code_sha=None, writer=None,
+                vectors=None):
+    key = ("file", repo_name, folder_name, file_name)
+    if llm_openai and llm_ubicloud:
+        write(INSERT_FILE, key, (file_name, folder_name, repo_name,
+              file_content, code_sha, llm_openai.strip(), llm_ubicloud.strip()), writer, vectors)
+    elif llm_openai:
+        write(INSERT_FILE_OPENAI, key, (file_name, folder_name,
+              repo_name, file_content, code_sha, llm_openai.strip()), writer, vectors)
+    elif llm_ubicloud:
+        write(INSERT_FILE_UBICLOUD, key, (file_name, folder_name,
+              repo_name, file_content, code_sha, llm_ubicloud.strip()), writer, vectors)
+
+
+def insert_commit(repo_name, commit, llm_openai, llm_ubicloud, writer=None, vectors=None):
+    author = f"{commit['author_name']} <{commit['author_email']}>"
+    metadata = (repo_name, commit["id"], author, commit["author_name"], commit["author_email"],
+                commit["date"], commit["date"], commit["files_changed"], commit["folders_changed"],
+                commit["changes"], commit["title"], commit["message"])
+    key = ("commit", repo_name, commit["id"])
+    if llm_openai and llm_ubicloud:
+        write(INSERT_COMMIT, key, metadata +
+              (llm_openai.strip(), llm_ubicloud.strip()), writer, vectors)
+    elif llm_openai:
+        write(INSERT_COMMIT_OPENAI, key,
+              metadata + (llm_openai.strip(),), writer, vectors)
+    elif llm_ubicloud:
+        write(INSERT_COMMIT_UBICLOUD, key,
+              metadata + (llm_ubicloud.strip(),), writer, vectors)
+
+
+class SummaryState:
+    """
+    The stored summaries of a repo's files and folders (or, with `folder`, of that folder's
+    files and subtree), loaded in one query and updated as new summaries are written, so
+    processing needs no SELECT per file or folder. With `override`, older entries still
+    feed their parent folder's summary but don't count as processed.
+    """
+
+    def __init__(self, repo_name, override=None, folder=None):
+        self.lock = threading.Lock()
+        self.files = {}
+        self.folders = {}
+        with pool_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(FETCH_SUMMARY_STATE, {
+                    "repo": repo_name, "override": override, "folder": folder,
+                    "subfolders": f"{folder}/%" if folder else None})
+                rows = cur.fetchall()
+            conn.commit()
+        for kind, folder_name, name, llm_openai, llm_ubicloud, fresh in rows:
+            if kind == "file":
+                self.files[(folder_name, name)] = (
+                    llm_openai, llm_ubicloud, fresh)
+            else:
+                self.folders[name] = (llm_openai, llm_ubicloud, fresh)
+        # Sorted, so a folder's subtree is one contiguous range
+        self.folder_names = sorted(self.folders)
+
+    def file_summary(self, folder_name, file_name):
+        with self.lock:
+            entry = self.files.get((folder_name, file_name))
+        return entry[:2] if entry and entry[2] else None
+
+    def has_folder(self, folder_name):
+        with self.lock:
+            entry = self.folders.get(folder_name)
+        return bool(entry and entry[2])
+
+    def subfolder_summaries(self, folder_name):
+        prefix = folder_name + "/"
+        with self.lock:
+            start = bisect.bisect_left(self.folder_names, prefix)
+            summaries = []
+            for name in self.folder_names[start:]:
+                if not name.startswith(prefix):
+                    break
+                summaries.append(self.folders[name][:2])
+            return summaries
+
+    @staticmethod
+    def _merge(entries, key, llm_openai, llm_ubicloud):
+        # Like the single-provider upserts, a missing summary keeps the stored one
+        old = entries.get(key, (None, None, True))
+        entries[key] = (llm_openai.strip() if llm_openai else old[0],
+                        llm_ubicloud.strip() if llm_ubicloud else old[1], True)
+
+    def set_file(self, folder_name, file_name, llm_openai, llm_ubicloud):
+        with self.lock:
+            self._merge(self.files, (folder_name, file_name),
+                        llm_openai, llm_ubicloud)
+
+    def set_folder(self, folder_name, llm_openai, llm_ubicloud):
+        with self.lock:
+            if folder_name not in self.folders:
+                bisect.insort(self.folder_names, folder_name)
+            self._merge(self.folders, folder_name, llm_openai, llm_ubicloud)
+
+
 def chunk_file(file_content, context_window):
     """
     Splits the file content into chunks, ensuring that each chunk ends at a function boundary.
@@ -194,76 +357,92 @@ def chunk_file(file_content, context_window):
     return chunks
 
 
-def process_file(file_path, folder_name, repo_name, provider, override):
-    with pool_connection() as conn:
-        with conn.cursor() as cur:
-            file_name = os.path.basename(file_path)
-
-            if not override:
-                cur.execute(
-                    """SELECT "llm_openai", "llm_ubicloud" FROM files WHERE "name" = %s AND "folder" = %s AND "repo" = %s""",
-                    (file_name, folder_name, repo_name)
-                )
-            else:
-                cur.execute(
-                    """SELECT "llm_openai", "llm_ubicloud" FROM files WHERE "name" = %s AND "folder" = %s AND "repo" = %s AND updated_at > %s""",
-                    (file_name, folder_name, repo_name, override)
-                )
-            row = cur.fetchone()
-            if row:
-                return row
-
-            def get_description(chunks, ask):
-                if len(chunks) == 1:
-                    return ask(FILE_PROMPT, "File: " + file_name + "\n\n" + chunks[0])
-                else:
-                    descriptions = []
-                    for chunk in chunks:
-                        descriptions.append(
-                            ask(FILE_PROMPT, "File: " + file_name + "\n\n" + chunk))
-                    return ask(FILE_SUMMARIES_PROMPT, "File: " + file_name + "\n\n" + "\n".join(descriptions[:10]))
-
-            print("File:", file_path)
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                file_content = f.read()
-
-            llm_openai, llm_ubicloud = None, None
-
-            if provider is None or provider == 'openai':
-                chunks_openai = chunk_file(file_content, OPENAI_CONTEXT_WINDOW)
-                llm_openai = get_description(chunks_openai, ask_openai)
-            if provider is None or provider == 'ubicloud':
-                chunks_ubicloud = chunk_file(
-                    file_content, UBICLOUD_CONTEXT_WINDOW)
-                llm_ubicloud = get_description(chunks_ubicloud, ask_ubicloud)
+def store_summary(kind, key, llm_openai, llm_ubicloud, write, pipeline=None):
+    """
+    Writes a summary right away or, with a pipeline, once it has been embedded; `write`
+    takes the vectors to store with it. Returns whether it went to the pipeline, which
+    then also marks the journal entry done.
+    """
+    if pipeline is None:
+        write()
+        return False
+    pipeline.submit(kind, key, {"openai": llm_openai, "ubicloud": llm_ubicloud}, write)
+    return True
+
+
+@traced("process_file")
+def process_file(file_path, folder_name, repo_name, provider, override, journal=None, state=None, writer=None,
+                 pipeline=None):
+    file_name = os.path.basename(file_path)
+    if state is None:
+        state = SummaryState(repo_name, override, folder_name)
+    row = state.file_summary(folder_name, file_name)
+    if row:
+        return row
+
+    def get_description(chunks, ask):
+        if len(chunks) == 1:
+            return ask(FILE_PROMPT, "File: " + file_name + "\n\n" + chunks[0])
+        else:
+            descriptions = []
+            for chunk in chunks:
+                descriptions.append(
+                    ask(FILE_PROMPT, "File: " + file_name + "\n\n" + chunk))
+            return ask(FILE_SUMMARIES_PROMPT, "File: " + file_name + "\n\n" + "\n".join(descriptions[:10]))
+
+    print("File:", file_path)
+    key = f"{folder_name}/{file_name}"
+    with track(journal, "file", key, writer, finish=pipeline is None):
+        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+            file_content = f.read()
+
+        llm_openai, llm_ubicloud = None, None
+
+        if provider is None or provider == 'openai':
+            chunks_openai = chunk_file(
+                file_content, OPENAI_CONTEXT_WINDOW)
+            llm_openai = get_description(
+                chunks_openai, routed_ask('openai', 'file', file_name))
+        if provider is None or provider == 'ubicloud':
+            chunks_ubicloud = chunk_file(
+                file_content, UBICLOUD_CONTEXT_WINDOW)
+            llm_ubicloud = get_description(
+                chunks_ubicloud, routed_ask('ubicloud', 'file', file_name))
 
-            # Insert the file and its components into the database
-            insert_file(file_name, folder_name, repo_name,
-                        file_content, llm_openai, llm_ubicloud)
+        # Insert the file and its components into the database
+        code, code_sha = stored_code(file_path, file_content)
+        store_summary("file", key, llm_openai, llm_ubicloud, functools.partial(
+            insert_file, file_name, folder_name, repo_name, code, llm_openai, llm_ubicloud, code_sha, writer), pipeline)
+        state.set_file(folder_name, file_name, llm_openai, llm_ubicloud)
 
-            return llm_openai, llm_ubicloud
+    return llm_openai, llm_ubicloud
 
 
-def process_files_in_folder(folder_path, repo_path, repo_name, provider, override):
+def process_files_in_folder(folder_path, repo_path, repo_name, provider, override, journal=None, prefilter=None,
+                            state=None, writer=None, pipeline=None):
     file_futures = []
     folder_name = os.path.relpath(folder_path, repo_path)
     with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
         for item in os.listdir(folder_path):
             item_path = os.path.join(folder_path, item)
-            if os.path.isfile(item_path) and is_acceptable_file(item):
+            if not (os.path.isfile(item_path) and is_acceptable_file(item)):
+                continue
+            if prefilter is None or prefilter.accept(item_path):
                 file_futures.append(executor.submit(
-                    process_file, item_path, folder_name, repo_name, provider, override
+                    process_file, item_path, folder_name, repo_name, provider, override, journal, state, writer, pipeline
                 ))
 
         summaries = []
+        errors = 0
         for future in as_completed(file_futures):
             try:
                 llm_openai, llm_ubicloud = future.result()
                 summaries.append((llm_openai, llm_ubicloud))
             except Exception as e:
+                errors += 1
                 print(f"Error processing file in folder '{folder_name}': {e}")
 
-    return summaries
+    return summaries, errors
 
 
 def get_description(descriptions, ask, context_window):
@@ -279,56 +458,65 @@ def get_description(descriptions, ask, context_window):
         return ask(FOLDER_SUMMARIES_PROMPT, "\n".join(combined_descriptions))
 
 
-def process_folder(folder_path, repo_path, repo_name, provider, override):
+@traced("process_folder")
+def process_folder(folder_path, repo_path, repo_name, provider, override, journal=None, prefilter=None,
+                   state=None, writer=None, pipeline=None):
     if not is_acceptable_folder(folder_path):
         return
 
     folder_name = os.path.relpath(folder_path, repo_path)
+    if journal and not journal.should_process("folder", folder_name):
+        return
     print(f"Processing folder: {folder_name}")
 
-    # If folder already has a summary, skip processing and just return it
-    with pool_connection() as conn:
-        with conn.cursor() as cur:
-            if not override:
-                cur.execute(
-                    """SELECT 1 FROM folders WHERE "name" = %s AND "repo" = %s""", (folder_name, repo_name))
-            else:
-                cur.execute(
-                    """SELECT 1 FROM folders WHERE "name" = %s AND "repo" = %s AND updated_at > %s""", (folder_name, repo_name, override))
-            row = cur.fetchone()
-            if row:
-                return
-
-            # Fetch summaries for subfolders from the database
-            cur.execute(
-                """SELECT "llm_openai", "llm_ubicloud" FROM folders WHERE "repo" = %s AND "name" LIKE %s""",
-                (repo_name, folder_name + '/%')
-            )
-            subfolder_summaries = cur.fetchall()
-
-    # Process all files in the current folder
-    file_summaries = process_files_in_folder(
-        folder_path, repo_path, repo_name, provider, override)
-
-    # Combine file summaries and subfolder summaries
-    combined_summaries = file_summaries + [
-        (llm_openai, llm_ubicloud) for llm_openai, llm_ubicloud in subfolder_summaries
-    ]
+    if state is None:
+        state = SummaryState(repo_name, override, folder_name)
+    # If folder already has a summary, skip processing and just return it,
+    # unless the journal says it was built while some of its files were failing
+    retrying = journal is not None and journal.status(
+        "folder", folder_name) == "failed"
+    if not retrying and state.has_folder(folder_name):
+        return
+    subfolder_summaries = state.subfolder_summaries(folder_name)
 
-    # Generate a folder summary from combined summaries
-    if len(combined_summaries) > 0:
-        llm_openai = llm_ubicloud = None
-        if provider == None or provider == 'openai':
-            llm_openai = get_description(
-                [summary[0] for summary in combined_summaries if summary[0]
-                 ], ask_openai, OPENAI_CONTEXT_WINDOW
-            )
-        if provider == None or provider == 'ubicloud':
-            llm_ubicloud = get_description(
-                [summary[1] for summary in combined_summaries if summary[1]
-                 ], ask_ubicloud, UBICLOUD_CONTEXT_WINDOW
-            )
-        insert_folder(folder_name, repo_name, llm_openai, llm_ubicloud)
+    with track(journal, "folder", folder_name, writer, finish=pipeline is None):
+        # Process all files in the current folder
+        file_summaries, errors = process_files_in_folder(
+            folder_path, repo_path, repo_name, provider, override, journal, prefilter, state, writer, pipeline)
+
+        # Combine file summaries and subfolder summaries
+        combined_summaries = file_summaries + [
+            (llm_openai, llm_ubicloud) for llm_openai, llm_ubicloud in subfolder_summaries
+        ]
+
+        # A folder that will be retried is written right away, so its failed journal entry stays
+        failing = errors or (
+            journal and journal.has_failures_under("folder", folder_name))
+        queued = False
+
+        # Generate a folder summary from combined summaries
+        if len(combined_summaries) > 0:
+            llm_openai = llm_ubicloud = None
+            if provider == None or provider == 'openai':
+                llm_openai = get_description(
+                    [summary[0] for summary in combined_summaries if summary[0]
+                     ], routed_ask('openai', 'folder'), OPENAI_CONTEXT_WINDOW
+                )
+            if provider == None or provider == 'ubicloud':
+                llm_ubicloud = get_description(
+                    [summary[1] for summary in combined_summaries if summary[1]
+                     ], routed_ask('ubicloud', 'folder'), UBICLOUD_CONTEXT_WINDOW
+                )
+            queued = store_summary("folder", folder_name, llm_openai, llm_ubicloud, functools.partial(
+                insert_folder, folder_name, repo_name, llm_openai, llm_ubicloud, writer), None if failing else pipeline)
+            state.set_folder(folder_name, llm_openai, llm_ubicloud)
+
+        # Keep the folder (and so its ancestors) pending a retry until everything below it succeeded
+        if failing:
+            raise Exception(
+                f"Folder '{folder_name}' summarized with {errors} failed file(s) or failed subfolders")
+        if pipeline is not None and not queued and journal:
+            journal.finish("folder", folder_name, writer)
 
 
 def extract_files_changed(diff_content):
@@ -340,39 +528,98 @@ def extract_files_changed(diff_content):
         if line.startswith('diff --git'):
             # Example line: diff --git a/file1.txt b/file1.txt
             parts = line.split()
-            if len(parts) >= 3:
-                # Extract the file path (removing the 'a/' or 'b/' prefix)
-                file_path = parts[2].replace('b/', '').replace('a/', '')
-                files_changed.add(file_path)
-    return list(files_changed)
+            if len(parts) >= 4 and parts[3].startswith('b/'):
+                # The path after the change, without its 'b/' prefix
+                files_changed.add(parts[3][2:])
+    return sorted(files_changed)
+
+
+def extract_folders_changed(files_changed):
+    """
+    Every folder above a changed file, so a folder filter can match the commit.
+    """
+    folders = set()
+    for file_path in files_changed:
+        parts = file_path.split('/')[:-1]
+        for i in range(1, len(parts) + 1):
+            folders.add('/'.join(parts[:i]))
+    return sorted(folders)
 
 
-def process_commit(repo_name, commit_id, author, date, changes, title, message, provider):
-    author_email = f"{author}"
+# Every commit starts with a record separator and its header fields are separated by unit
+# separators, so multi-line messages can't be confused with the diff that follows
+GIT_LOG_FORMAT = "%x1e%H%x1f%an%x1f%ae%x1f%aI%x1f%s%x1f%b%x1f"
+GIT_SHA = re.compile(r"[0-9a-f]{40}")
+
+
+def parse_git_log(log, journal=None):
+    """
+    Yields one dict per commit from `git log -p --pretty=format:GIT_LOG_FORMAT` output.
+    A record that doesn't parse (a truncated log, say) is skipped and, when its commit id
+    can be read, recorded as a failed commit.
+    """
+    for record in log.split("\x1e"):
+        if not record.strip():
+            continue
+        fields = record.split("\x1f", 6)
+        commit_id = fields[0].strip()
+        if len(fields) != 7 or not GIT_SHA.fullmatch(commit_id):
+            error = f"malformed git log record ({len(fields)} of 7 fields)"
+            registry.inc("commit_records_skipped_total")
+            print(f"Skipping commit '{commit_id[:40]}': {error}")
+            if journal and GIT_SHA.fullmatch(commit_id):
+                journal.fail("commit", commit_id, error)
+            continue
+        _, author_name, author_email, date, title, message, changes = fields
+        files_changed = extract_files_changed(changes)
+        yield {
+            "id": commit_id,
+            "author_name": author_name,
+            "author_email": author_email,
+            "date": date,
+            "title": title,
+            "message": message.strip(),
+            "changes": changes.strip("\n"),
+            "files_changed": files_changed,
+            "folders_changed": extract_folders_changed(files_changed),
+        }
+
+
+@traced("process_commit")
+def process_commit(repo_name, commit, provider, journal=None, writer=None, pipeline=None):
+    author = f"{commit['author_name']} <{commit['author_email']}>"
+    title, message, changes, date = commit["title"], commit["message"], commit["changes"], commit["date"]
     if len(changes) < CONTEXT_WINDOW:
-        input_text = f"Title: {title}\nMessage: {message}\nChanges: {changes}\nAuthor: {author_email}\nDate: {date}"
+        input_text = f"Title: {title}\nMessage: {message}\nChanges: {changes}\nAuthor: {author}\nDate: {date}"
     else:
-        files_changed = extract_files_changed(changes)
-        input_text = f"Title: {title}\nMessage: {message}\nFiles changed: {', '.join(files_changed)}\nAuthor: {author_email}\nDate: {date}"
+        input_text = f"Title: {title}\nMessage: {message}\nFiles changed: {', '.join(commit['files_changed'])}\nAuthor: {author}\nDate: {date}"
 
     llm_ubicloud = llm_openai = None
 
-    if provider is None or provider == 'openai':
-        llm_openai = ask_openai(COMMIT_PROMPT, input_text)
-    if provider is None or provider == 'ubicloud':
-        llm_ubicloud = ask_ubicloud(COMMIT_PROMPT, input_text)
+    with track(journal, "commit", commit["id"], writer, finish=pipeline is None):
+        if provider is None or provider == 'openai':
+            llm_openai = routed_ask('openai', 'commit')(
+                COMMIT_PROMPT, input_text)
+        if provider is None or provider == 'ubicloud':
+            llm_ubicloud = routed_ask('ubicloud', 'commit')(
+                COMMIT_PROMPT, input_text)
 
-    insert_commit(repo_name, commit_id, author, date, changes,
-                  title, message, llm_openai, llm_ubicloud)
+        store_summary("commit", commit["id"], llm_openai, llm_ubicloud, functools.partial(
+            insert_commit, repo_name, commit, llm_openai, llm_ubicloud, writer), pipeline)
 
 
-def process_commits(repo_path, repo_name, provider, override):
+@traced("process_commits")
+def process_commits(repo_path, repo_name, provider, override, journal=None, writer=None, pipeline=None):
+    # A per-run file, so several workers on one machine don't overwrite each other's log
+    fd, commit_data_path = tempfile.mkstemp(
+        prefix=f"commit_data_{os.path.basename(repo_name)}_", suffix=".txt")
+    os.close(fd)
     os.system(
-        f"git -C {repo_path} log -p -n 1000 --pretty=format:'COMMIT_HASH:%H|AUTHOR_NAME:%an|AUTHOR_EMAIL:%ae|DATE:%ad|TITLE:%s|MESSAGE:%b' --date=iso > commit_data.txt"
+        f"git -C {repo_path} log -p -n 1000 --pretty=format:'{GIT_LOG_FORMAT}' > {commit_data_path}"
     )
 
-    with open('commit_data.txt', 'r') as file:
-        lines = file.readlines()
+    with open(commit_data_path, 'r', encoding='utf-8', errors='replace') as file:
+        log = file.read()
 
     with pool_connection() as conn:
         with conn.cursor() as cur:
@@ -384,49 +631,18 @@ def process_commits(repo_path, repo_name, provider, override):
                     """SELECT "id" FROM commits WHERE "repo" = %s AND updated_at > %s""", (repo_name, override))
             processed_commit_ids = {row[0] for row in cur.fetchall()}
 
-    commit_data_list = []
-    commit_id = author_name = author_email = commit_date = title = message = ""
-    changes_list = []
-    in_diff_section = False
-
-    def maybe_save_commit():
-        if commit_id and commit_id not in processed_commit_ids:
-            changes = "\n".join(changes_list)
-            author = f"{author_name} <{author_email}>"
-            commit_data_list.append(
-                (repo_name, commit_id, author, commit_date,
-                 changes, title, message, provider)
-            )
-
-    for line in lines:
-        line = line.strip()
-        if line.startswith("COMMIT_HASH:"):
-            maybe_save_commit()
-            commit_id = line.split("COMMIT_HASH:")[1].strip()
-            in_diff_section = False
-            changes_list = []
-        elif line.startswith("AUTHOR_NAME:"):
-            author_name = line.split("AUTHOR_NAME:")[1].strip()
-        elif line.startswith("AUTHOR_EMAIL:"):
-            author_email = line.split("AUTHOR_EMAIL:")[1].strip()
-        elif line.startswith("DATE:"):
-            commit_date = line.split("DATE:")[1].strip()
-        elif line.startswith("TITLE:"):
-            title = line.split("TITLE:")[1].strip()
-        elif line.startswith("MESSAGE:"):
-            message = line.split("MESSAGE:")[1].strip()
-        elif line == "" and commit_id:
-            in_diff_section = True
-        elif in_diff_section:
-            changes_list.append(line)
-
-    maybe_save_commit()
+    commit_data_list = [
+        commit for commit in parse_git_log(log, journal)
+        if commit["id"] not in processed_commit_ids
+        and not (journal and not journal.should_process("commit", commit["id"]))
+    ]
 
     print(f"Processing {len(commit_data_list)} commits in parallel...")
     with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
         futures = [
-            executor.submit(process_commit, *commit_data)
-            for commit_data in commit_data_list
+            executor.submit(process_commit, repo_name,
+                            commit, provider, journal, writer, pipeline)
+            for commit in commit_data_list
         ]
         for future in as_completed(futures):
             try:
@@ -434,26 +650,28 @@ def process_commits(repo_path, repo_name, provider, override):
             except Exception as e:
                 print(f"Error processing a commit: {e}")
 
-    if os.path.exists('commit_data.txt'):
-        os.remove('commit_data.txt')
+    if os.path.exists(commit_data_path):
+        os.remove(commit_data_path)
 
     print("Commit processing complete.")
 
 
-def main(repo_name, provider=None, override=None):
-    with pool_connection() as conn:
-        with conn.cursor() as cur:
-            query = """SELECT 1 FROM repos WHERE "name" = %s"""
-            if not override:
-                cur.execute(query, (repo_name,))
-            else:
-                query += " AND updated_at > %s"
-                cur.execute(query, (repo_name, override))
-            row = cur.fetchone()
-            if row:
-                print(
-                    f"Repository '{repo_name}' already processed. Exiting...")
-                return
+def main(repo_name, provider=None, override=None, retry_failed=False, pipeline=False):
+    # Failed items are retried even though the repo row was already written
+    if not retry_failed:
+        with pool_connection() as conn:
+            with conn.cursor() as cur:
+                query = """SELECT 1 FROM repos WHERE "name" = %s"""
+                if not override:
+                    cur.execute(query, (repo_name,))
+                else:
+                    query += " AND updated_at > %s"
+                    cur.execute(query, (repo_name, override))
+                row = cur.fetchone()
+                if row:
+                    print(
+                        f"Repository '{repo_name}' already processed. Exiting...")
+                    return
 
     repo_path = f"repos/{repo_name}"
     if not os.path.exists(repo_path):
@@ -461,16 +679,51 @@ def main(repo_name, provider=None, override=None):
             f"Repository '{repo_name}' not found at expected path {repo_path}. Exiting...")
         return
 
+    journal = Journal(repo_name, since=override, retry_failed=retry_failed)
+    prefilter = Prefilter.for_repo(
+        repo_name, repo_path, is_acceptable_folder, is_acceptable_file)
+
+    # Existing summaries are read once up front; new ones are written in batches
+    state = SummaryState(repo_name, override)
+    # Rows that can't be written fail their item instead of the whole batch
+    writer = WriteBehind(pool_connection, on_error=lambda item, error: journal.fail(*item, error))
+    # With the pipeline, summaries are embedded while the rest are still being generated
+    embedding_pipeline = EmbeddingPipeline(writer, journal) if pipeline else None
+
     print(f"Processing repository '{repo_name}'...")
-    print("Processing folders and files...")
-    for root, dirs, files in os.walk(repo_path, topdown=False):
-        dirs[:] = [d for d in dirs if is_acceptable_folder(d)]
-        process_folder(root, repo_path, repo_name, provider, override)
+    try:
+        print("Processing folders and files...")
+        for root, dirs, files in os.walk(repo_path, topdown=False):
+            dirs[:] = [d for d in dirs if is_acceptable_folder(d)]
+            try:
+                process_folder(root, repo_path, repo_name, provider, override,
+                               journal, prefilter, state, writer, embedding_pipeline)
+            except Exception as e:
+                print(f"Error processing folder '{root}': {e}")
+        prefilter.report()
 
-    print("Processing commits...")
-    process_commits(repo_path, repo_name, provider, override)
+        print("Processing commits...")
+        process_commits(repo_path, repo_name, provider,
+                        override, journal, writer, embedding_pipeline)
+    finally:
+        # The overview and backfill read the rows back, and an interrupted run keeps what it finished
+        if embedding_pipeline:
+            embedding_pipeline.close()
+        writer.flush()
     insert_repo(repo_name)
-    backfill(repo_name, provider, override)
+    # The pipeline already stored the vectors; a retry still repairs the ones that failed.
+    # Without it, the items summarized by this run are re-embedded, since rows it rewrote
+    # still carry the vectors of their old summaries
+    if not pipeline or retry_failed:
+        backfill(repo_name, provider, override, retry_failed,
+                 () if pipeline else journal.finished)
+
+    print_progress(repo_name)
+    if journal.keys("file", "failed") or journal.keys("folder", "failed") or journal.keys("commit", "failed"):
+        print(
+            "Some items failed; run again with --retry-failed to redo them.")
+    elif pipeline and any(journal.keys(kind, "failed") for kind in ("file_embedding", "folder_embedding", "commit_embedding")):
+        print("Some embeddings failed; run backfill_embeddings.py --retry-failed to repair them.")
 
 
 if __name__ == '__main__':
@@ -481,8 +734,19 @@ if __name__ == '__main__':
         "--provider", choices=['openai', 'ubicloud'], help="Specify the provider.")
     parser.add_argument(
         "--override", help="Enable override mode, which accepts a timestamp for updated_at")
+    parser.add_argument(
+        "--retry-failed", action="store_true", help="Process an already processed repository again, redoing only the items the journal didn't record as done (failed or interrupted).")
+    parser.add_argument(
+        "--pipeline", action="store_true", help="Embed summaries as they are generated instead of backfilling afterwards.")
+    parser.add_argument(
+        "--refresh-overview", action="store_true", help="Only rebuild the repo overview from the stored folder summaries.")
 
     args = parser.parse_args()
-    main(args.repo, args.provider, args.override)
+    if args.refresh_overview:
+        update_repo_overview(args.repo)
+    else:
+        main(args.repo, args.provider, args.override,
+             args.retry_failed, args.pipeline)
 
     connection_pool.closeall()
+    print_summary()
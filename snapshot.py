@@ -0,0 +1,346 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import threading
+from datetime import datetime, timezone
+import numpy as np
+import psycopg2
+from pgvector.psycopg2 import register_vector
+from dotenv import load_dotenv
+from metrics import TracedCursor, traced
+
+load_dotenv()
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+# Snapshots are written to <SNAPSHOT_DIR>/<repo>/<provider>/<version>/, with a CURRENT file
+# naming the latest version, so readers never see a half-written snapshot
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "snapshots")
+SNAPSHOT_FORMAT = 1
+# Older versions kept next to the current one, for readers that still have them mapped
+KEEP_VERSIONS = 2
+# How often a loaded snapshot checks repos.updated_at to see whether it went stale
+SNAPSHOT_CHECK_SECONDS = 30
+# Rows fetched per round trip while exporting
+EXPORT_FETCH_SIZE = 1000
+
+VECTOR_DIMENSIONS = {"openai": 1536, "ubicloud": 4096}
+
+# Key columns of each kind, in the order the query_* functions return them
+KEY_COLUMNS = {
+    "folders": ["name"],
+    "files": ["name", "folder"],
+    "commits": ["repo", "id"],
+}
+
+FETCH_REPO_UPDATED_AT = """SELECT "updated_at" FROM repos WHERE "name" = %s"""
+
+
+def connect():
+    conn = psycopg2.connect(DATABASE_URL, cursor_factory=TracedCursor)
+    register_vector(conn)
+    return conn
+
+
+def fetch_repo_updated_at(conn, repo):
+    with conn.cursor() as cur:
+        cur.execute(FETCH_REPO_UPDATED_AT, (repo,))
+        row = cur.fetchone()
+        return row[0].isoformat() if row and row[0] else None
+
+
+def snapshot_path(repo, provider, version=None):
+    path = os.path.join(SNAPSHOT_DIR, repo, provider)
+    return os.path.join(path, version) if version else path
+
+
+def current_version(repo, provider):
+    try:
+        with open(os.path.join(snapshot_path(repo, provider), "CURRENT"), 'r') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def export_kind(conn, path, kind, provider, repo):
+    """
+    Streams one table's embedded rows into <kind>.npy (a float32 matrix, one row per item)
+    and <kind>.json (the key columns and summary of each row, in the same order).
+    """
+    columns = ", ".join(f'"{c}"' for c in KEY_COLUMNS[kind])
+    where = f'"repo" = %s AND vector_{provider} IS NOT NULL'
+    with conn.cursor() as cur:
+        cur.execute(f"""SELECT count(*) FROM {kind} WHERE {where}""", (repo,))
+        count = cur.fetchone()[0]
+
+    vectors = np.lib.format.open_memmap(os.path.join(path, f"{kind}.npy"), mode='w+',
+                                        dtype=np.float32, shape=(count, VECTOR_DIMENSIONS[provider]))
+    rows = []
+    # A named cursor streams the rows instead of materializing the whole table client-side
+    with conn.cursor(name=f"export_{kind}") as cur:
+        cur.itersize = EXPORT_FETCH_SIZE
+        cur.execute(f"""SELECT {columns}, llm_{provider}, vector_{provider} FROM {kind} WHERE {where} ORDER BY {columns}""",
+                    (repo,))
+        for i, row in enumerate(cur):
+            *keys, description, vector = row
+            vectors[i] = vector
+            rows.append(keys + [description])
+    vectors.flush()
+    del vectors
+
+    with open(os.path.join(path, f"{kind}.json"), 'w', encoding='utf-8') as f:
+        json.dump({"columns": KEY_COLUMNS[kind] + ["description"], "rows": rows}, f)
+    return len(rows)
+
+
+@traced("export_snapshot")
+def export_snapshot(repo, provider):
+    """
+    Writes a new snapshot version of a repo's folders, files and commits for one provider
+    and points CURRENT at it. Returns the version.
+    """
+    conn = connect()
+    # One repeatable-read transaction, so the counts match the rows streamed afterwards
+    conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    try:
+        # Read the repo's timestamp first: anything written after it makes the snapshot stale
+        repo_updated_at = fetch_repo_updated_at(conn, repo)
+        version = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+        path = snapshot_path(repo, provider, version)
+        os.makedirs(path)
+
+        counts = {kind: export_kind(conn, path, kind, provider, repo)
+                  for kind in KEY_COLUMNS}
+        conn.rollback()
+    finally:
+        conn.close()
+
+    manifest = {
+        "format": SNAPSHOT_FORMAT,
+        "repo": repo,
+        "provider": provider,
+        "version": version,
+        "repo_updated_at": repo_updated_at,
+        "dimensions": VECTOR_DIMENSIONS[provider],
+        "counts": counts,
+    }
+    with open(os.path.join(path, "manifest.json"), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+
+    current = os.path.join(snapshot_path(repo, provider), "CURRENT")
+    with open(current + ".tmp", 'w') as f:
+        f.write(version)
+    os.replace(current + ".tmp", current)
+
+    prune_versions(repo, provider)
+    print(f"Exported snapshot {version} of '{repo}' ({provider}): "
+          + ", ".join(f"{count} {kind}" for kind, count in counts.items()))
+    return version
+
+
+def prune_versions(repo, provider):
+    path = snapshot_path(repo, provider)
+    versions = sorted(v for v in os.listdir(path)
+                      if os.path.isdir(os.path.join(path, v)))
+    for version in versions[:-(KEEP_VERSIONS + 1)]:
+        shutil.rmtree(os.path.join(path, version), ignore_errors=True)
+
+
+class Snapshot:
+    """
+    One snapshot version, memory-mapped read-only. Searches compute exact L2 distances
+    (matching pgvector's <->) against the whole matrix with NumPy.
+    """
+
+    def __init__(self, repo, provider, version):
+        path = snapshot_path(repo, provider, version)
+        with open(os.path.join(path, "manifest.json"), 'r', encoding='utf-8') as f:
+            self.manifest = json.load(f)
+        if self.manifest["format"] != SNAPSHOT_FORMAT:
+            raise ValueError(
+                f"Snapshot {path} has format {self.manifest['format']}, expected {SNAPSHOT_FORMAT}")
+
+        self.vectors = {}
+        self.norms = {}
+        self.rows = {}
+        self.file_folders = None
+        for kind in KEY_COLUMNS:
+            vectors = np.load(os.path.join(
+                path, f"{kind}.npy"), mmap_mode='r')
+            self.vectors[kind] = vectors
+            self.norms[kind] = np.einsum('ij,ij->i', vectors, vectors)
+            with open(os.path.join(path, f"{kind}.json"), 'r', encoding='utf-8') as f:
+                self.rows[kind] = json.load(f)["rows"]
+
+    def in_subtrees(self, folders):
+        if self.file_folders is None:
+            self.file_folders = np.array(
+                [row[1] + "/" for row in self.rows["files"]], dtype=str)
+        mask = np.zeros(len(self.file_folders), dtype=bool)
+        for folder in folders:
+            mask |= np.char.startswith(self.file_folders, folder + "/")
+        return mask
+
+    @property
+    def repo_updated_at(self):
+        return self.manifest["repo_updated_at"]
+
+    def search(self, kind, vector, top_k, folders=None):
+        """
+        Returns the top_k rows nearest to vector as (*keys, description, vector) tuples,
+        the same shape as the corresponding SQL query. For files, `folders` restricts the
+        search to those folders' subtrees.
+        """
+        vectors = self.vectors[kind]
+        if len(vectors) == 0:
+            return []
+        query = np.asarray(vector, dtype=np.float32)
+        # ||v - q||^2 = ||v||^2 - 2 v.q + ||q||^2; the last term doesn't change the order
+        distances = self.norms[kind] - 2 * (vectors @ query)
+        if folders is not None:
+            distances = np.where(self.in_subtrees(folders), distances, np.inf)
+            top_k = min(top_k, int(np.isfinite(distances).sum()))
+            if top_k == 0:
+                return []
+        k = min(top_k, len(distances))
+        nearest = np.argpartition(distances, k - 1)[:k]
+        nearest = nearest[np.argsort(distances[nearest])]
+        return [tuple(self.rows[kind][i]) + (np.array(vectors[i]),) for i in nearest]
+
+
+class SnapshotStore:
+    """
+    Serves retrieval for any repo and provider from the current snapshot on disk. Every
+    SNAPSHOT_CHECK_SECONDS it compares repos.updated_at with the loaded snapshot and, when
+    the repo changed, loads a newer snapshot or exports one if none exists yet.
+
+    Only the first search of a repo and provider waits for a snapshot to load; later checks
+    run on a background thread while searches keep using the loaded snapshot.
+    """
+
+    def __init__(self, auto_export=True):
+        self.auto_export = auto_export
+        # Guards the dicts below; each (repo, provider) has its own lock for loading
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.snapshots = {}
+        self.checked_at = {}
+
+    def get(self, repo, provider):
+        key = (repo, provider)
+        with self.lock:
+            snapshot = self.snapshots.get(key)
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+            due = snapshot is not None and \
+                time.monotonic() - self.checked_at[key] >= SNAPSHOT_CHECK_SECONDS
+        if snapshot is None:
+            # Nothing to serve yet: the first caller loads it and the others wait for it
+            with key_lock:
+                with self.lock:
+                    snapshot = self.snapshots.get(key)
+                if snapshot is None:
+                    snapshot = self.refresh(repo, provider, None)
+                    with self.lock:
+                        self.snapshots[key] = snapshot
+                        self.checked_at[key] = time.monotonic()
+            return snapshot
+        # The key lock is held until the background refresh ends, so only one runs at a time
+        if due and key_lock.acquire(blocking=False):
+            threading.Thread(target=self.refresh_in_background,
+                             args=(key, snapshot, key_lock), daemon=True).start()
+        return snapshot
+
+    def refresh_in_background(self, key, snapshot, key_lock):
+        repo, provider = key
+        try:
+            snapshot = self.refresh(repo, provider, snapshot)
+            with self.lock:
+                self.snapshots[key] = snapshot
+        except Exception as e:
+            print(f"Refreshing the snapshot of '{repo}' ({provider}) failed: {e}")
+        finally:
+            with self.lock:
+                self.checked_at[key] = time.monotonic()
+            key_lock.release()
+
+    def refresh(self, repo, provider, snapshot):
+        conn = connect()
+        try:
+            repo_updated_at = fetch_repo_updated_at(conn, repo)
+        finally:
+            conn.close()
+        if snapshot is not None and snapshot.repo_updated_at == repo_updated_at:
+            return snapshot
+
+        version = current_version(repo, provider)
+        if version and (snapshot is None or version != snapshot.manifest["version"]):
+            candidate = Snapshot(repo, provider, version)
+            if candidate.repo_updated_at == repo_updated_at or not self.auto_export:
+                return candidate
+        if self.auto_export:
+            return Snapshot(repo, provider, export_snapshot(repo, provider))
+        if snapshot is None:
+            raise FileNotFoundError(
+                f"No snapshot of '{repo}' ({provider}) in {SNAPSHOT_DIR}; run snapshot.py export first")
+        return snapshot
+
+    def search(self, kind, provider, repo, vector, top_k, folders=None):
+        return self.get(repo, provider).search(kind, vector, top_k, folders)
+
+
+def show_snapshot(repo, provider, folders=None):
+    """
+    Prints the stored summaries: top-level folders, or the files under the given folders.
+    """
+    version = current_version(repo, provider)
+    if not version:
+        print(f"No snapshot of '{repo}' ({provider}); run snapshot.py export first.")
+        return
+    snapshot = Snapshot(repo, provider, version)
+    print(f"repo: {repo} ({provider}, snapshot {version})")
+
+    if folders:
+        for name, folder, description in snapshot.rows["files"]:
+            if any(folder == f or folder.startswith(f.rstrip("/") + "/") for f in folders):
+                print('--------------------------')
+                print("Folder:", folder, "File:", name)
+                print('----------')
+                print(description)
+        return
+
+    for name, description in snapshot.rows["folders"]:
+        if name.count("/") < 2:
+            print('--------------------------')
+            print("Folder:", name)
+            print('----------')
+            print(description)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Export repo embeddings to memory-mapped snapshots, or print the summaries in one.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser(
+        "export", help="Write a new snapshot version.")
+    export_parser.add_argument("repos", nargs="+", help="The repositories to export.")
+    export_parser.add_argument("--provider", choices=['openai', 'ubicloud'],
+                               help="Only export one provider (default: both).")
+
+    show_parser = subparsers.add_parser(
+        "show", help="Print the summaries in the current snapshot.")
+    show_parser.add_argument("repo", help="The repository to show.")
+    show_parser.add_argument("folders", nargs="*",
+                             help="Only print the files under these folders.")
+    show_parser.add_argument("--provider", choices=['openai', 'ubicloud'], default="openai",
+                             help="Specify the provider.")
+
+    args = parser.parse_args()
+    if args.command == "export":
+        providers = [args.provider] if args.provider else ["openai", "ubicloud"]
+        for repo in args.repos:
+            for provider in providers:
+                export_snapshot(repo, provider)
+    else:
+        show_snapshot(args.repo, args.provider, args.folders)
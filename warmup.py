@@ -0,0 +1,95 @@
+import time
+import asyncio
+from datetime import datetime, timezone
+from pgconf_utils import warm_up_http_async
+from ask_question_async import (get_pool, fetch, get_system_prompt_async, query_files_async,
+                                query_folders_async, query_commits_async, MIN_CONNECTIONS)
+from metrics import span
+
+PROVIDERS = ["openai", "ubicloud"]
+RETRIEVAL_TABLES = ["folders", "files", "commits", "repos"]
+
+# The tables, their TOAST tables (where long summaries and vectors live) and every index on them
+FETCH_PREWARM_RELATIONS = """
+    WITH t AS (SELECT unnest($1::text[]::regclass[])::oid AS oid)
+    SELECT oid FROM t
+    UNION ALL SELECT c.reltoastrelid FROM pg_class c JOIN t ON c.oid = t.oid WHERE c.reltoastrelid <> 0
+    UNION ALL SELECT i.indexrelid FROM pg_index i JOIN t ON i.indrelid = t.oid
+    UNION ALL SELECT i.indexrelid FROM pg_index i JOIN pg_class c ON i.indrelid = c.reltoastrelid JOIN t ON c.oid = t.oid
+"""
+PREWARM = """SELECT oid::regclass::text, pg_prewarm(oid) FROM unnest($1::oid[]) AS oid"""
+
+# Startup state, served by the app's /ready endpoint
+readiness = {"ready": False, "started_at": None,
+             "finished_at": None, "steps": {}, "errors": {}}
+
+
+async def fill_pool():
+    """
+    Creates the pool (which opens MIN_CONNECTIONS connections) and checks out that many
+    at once, so each one has completed its handshake and vector type registration.
+    """
+    pool = await get_pool()
+    connections = [await pool.acquire() for _ in range(MIN_CONNECTIONS)]
+    try:
+        await asyncio.gather(*(conn.execute("SELECT 1") for conn in connections))
+    finally:
+        for conn in connections:
+            await pool.release(conn)
+
+
+async def prewarm_tables():
+    relations = await fetch(FETCH_PREWARM_RELATIONS, RETRIEVAL_TABLES)
+    rows = await fetch(PREWARM, [row[0] for row in relations])
+    return {name: blocks for name, blocks in rows}
+
+
+async def prime_repo(provider, repo):
+    """
+    Runs the question path once per repo and provider with a stored vector as the query,
+    which warms the repo's index pages, the query plans and the cached system prompt.
+    """
+    await get_system_prompt_async(provider, repo)
+    rows = await fetch(f"""SELECT vector_{provider} FROM folders WHERE "repo" = $1 AND vector_{provider} IS NOT NULL LIMIT 1""", repo)
+    if not rows:
+        return
+    vector = rows[0][0]
+    await asyncio.gather(query_folders_async(provider, repo, vector),
+                         query_files_async(provider, repo, vector),
+                         query_commits_async(provider, repo, vector))
+
+
+async def run_step(name, coroutine):
+    start = time.perf_counter()
+    try:
+        with span("warm_up", step=name):
+            await coroutine
+    except Exception as e:
+        readiness["errors"][name] = str(e)
+        print(f"Warm-up step '{name}' failed: {e}")
+    readiness["steps"][name] = round(time.perf_counter() - start, 3)
+
+
+async def warm_up(repos, providers=PROVIDERS):
+    """
+    Brings the app to a warm state before the first question: a full connection pool,
+    retrieval tables and indexes in shared buffers, open provider connections and every
+    repo's query path exercised once. Failed steps are reported but don't block readiness,
+    since each only costs latency on first use.
+    """
+    readiness["started_at"] = datetime.now(timezone.utc).isoformat()
+    start = time.perf_counter()
+
+    await run_step("pool", fill_pool())
+    await asyncio.gather(
+        run_step("prewarm", prewarm_tables()),
+        run_step("http", warm_up_http_async()),
+    )
+    await asyncio.gather(*(run_step(f"repo:{repo}:{provider}", prime_repo(provider, repo))
+                           for repo in repos for provider in providers))
+
+    readiness["finished_at"] = datetime.now(timezone.utc).isoformat()
+    readiness["ready"] = True
+    print(f"Warm-up finished in {time.perf_counter() - start:.1f}s "
+          f"({len(readiness['errors'])} step(s) failed).")
+    return readiness
@@ -0,0 +1,264 @@
+import os
+import socket
+import argparse
+import threading
+import time
+import functools
+from dotenv import load_dotenv
+from process_repo import (pool_connection, connection_pool, process_file, process_folder, process_commits,
+                          insert_repo, is_acceptable_file, is_acceptable_folder)
+from backfill_embeddings import backfill
+from prefilter import Prefilter
+from metrics import print_summary
+
+load_dotenv()
+
+# Seconds a claimed job stays leased without a heartbeat before another worker may take it
+LEASE_SECONDS = 120
+HEARTBEAT_SECONDS = 30
+# Seconds an idle worker waits before polling for work again
+POLL_SECONDS = 5
+MAX_ATTEMPTS = 3
+
+# Queries
+INSERT_JOB = """
+    INSERT INTO jobs ("repo", "kind", "path", "parent", "provider", "override")
+    VALUES (%s, %s, %s, %s, %s, %s)
+    ON CONFLICT ("repo", "kind", "path") DO NOTHING;
+"""
+DELETE_REPO_JOBS = """DELETE FROM jobs WHERE "repo" = %s AND "status" IN ('done', 'failed')"""
+# A folder waits for its files and subfolders, and a repo's finalize job for all its other jobs.
+# Failed children don't block their parent, so one bad file can't stall a repo.
+CLAIM_JOB = """
+    UPDATE jobs SET "status" = 'running', "worker" = %s, "attempts" = "attempts" + 1,
+        "lease_expires_at" = now() + make_interval(secs => %s), "updated_at" = now()
+    WHERE "id" = (
+        SELECT j."id" FROM jobs j
+        WHERE j."status" = 'queued'
+          AND (j."kind" <> 'folder' OR NOT EXISTS (
+              SELECT 1 FROM jobs c
+              WHERE c."repo" = j."repo" AND c."parent" = j."path" AND c."kind" IN ('file', 'folder')
+                AND c."status" IN ('queued', 'running')))
+          AND (j."kind" <> 'finalize' OR NOT EXISTS (
+              SELECT 1 FROM jobs c
+              WHERE c."repo" = j."repo" AND c."id" <> j."id" AND c."status" IN ('queued', 'running')))
+        ORDER BY j."id"
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING "id", "repo", "kind", "path", "parent", "provider", "override";
+"""
+HEARTBEAT_JOB = """UPDATE jobs SET "lease_expires_at" = now() + make_interval(secs => %s), "updated_at" = now() WHERE "id" = %s AND "worker" = %s AND "status" = 'running'"""
+FINISH_JOB = """UPDATE jobs SET "status" = 'done', "error" = NULL, "lease_expires_at" = NULL, "updated_at" = now() WHERE "id" = %s AND "worker" = %s"""
+FAIL_JOB = """
+    UPDATE jobs SET "status" = CASE WHEN "attempts" >= %s THEN 'failed' ELSE 'queued' END,
+        "error" = %s, "worker" = NULL, "lease_expires_at" = NULL, "updated_at" = now()
+    WHERE "id" = %s AND "worker" = %s
+"""
+RELEASE_STALE_JOBS = """
+    UPDATE jobs SET "status" = CASE WHEN "attempts" >= %s THEN 'failed' ELSE 'queued' END,
+        "error" = 'lease expired on ' || "worker", "worker" = NULL, "lease_expires_at" = NULL, "updated_at" = now()
+    WHERE "status" = 'running' AND "lease_expires_at" < now()
+    RETURNING "id"
+"""
+FETCH_STATUS = """SELECT "repo", "kind", "status", count(*) FROM jobs GROUP BY "repo", "kind", "status" ORDER BY "repo", "kind", "status" """
+
+
+def execute(query, params=(), fetch=False):
+    with pool_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(query, params)
+            rows = cur.fetchall() if fetch else None
+        conn.commit()
+    return rows
+
+
+def enqueue_repo(repo_name, provider=None, override=None):
+    """
+    Queues a repo for ingestion. Any worker that claims the repo job expands it into
+    one job per folder and file, a commits job and a finalize job.
+    """
+    execute(DELETE_REPO_JOBS, (repo_name,))
+    execute(INSERT_JOB, (repo_name, "repo", "", None, provider, override))
+    print(f"Queued repository '{repo_name}'.")
+
+
+def folder_parent(folder_name):
+    if folder_name == ".":
+        return None
+    return os.path.dirname(folder_name) or "."
+
+
+@functools.lru_cache(maxsize=None)
+def repo_prefilter(repo_name):
+    """
+    Builds each repo's prefilter once per worker process; folder jobs need it too, so
+    skipped files don't get summarized when a folder lists its children.
+    """
+    repo_path = f"repos/{repo_name}"
+    return Prefilter.for_repo(repo_name, repo_path, is_acceptable_folder, is_acceptable_file)
+
+
+def expand_repo(repo_name, provider, override):
+    repo_path = f"repos/{repo_name}"
+    if not os.path.exists(repo_path):
+        raise Exception(
+            f"Repository '{repo_name}' not found at expected path {repo_path}")
+
+    prefilter = repo_prefilter(repo_name)
+    jobs = []
+    for root, dirs, files in os.walk(repo_path):
+        dirs[:] = [d for d in dirs if is_acceptable_folder(d)]
+        folder_name = os.path.relpath(root, repo_path)
+        jobs.append((repo_name, "folder", folder_name,
+                    folder_parent(folder_name), provider, override))
+        for file_name in files:
+            if is_acceptable_file(file_name) and prefilter.accept(os.path.join(root, file_name)):
+                jobs.append((repo_name, "file", os.path.join(folder_name, file_name),
+                             folder_name, provider, override))
+    jobs.append((repo_name, "commits", "", None, provider, override))
+    jobs.append((repo_name, "finalize", "", None, provider, override))
+
+    with pool_connection() as conn:
+        with conn.cursor() as cur:
+            cur.executemany(INSERT_JOB, jobs)
+        conn.commit()
+    print(f"Expanded '{repo_name}' into {len(jobs)} jobs.")
+    prefilter.report()
+
+
+def run_job(repo_name, kind, path, parent, provider, override):
+    repo_path = f"repos/{repo_name}"
+    if kind == "repo":
+        expand_repo(repo_name, provider, override)
+    elif kind == "file":
+        process_file(os.path.join(repo_path, path),
+                     parent, repo_name, provider, override)
+    elif kind == "folder":
+        process_folder(os.path.normpath(os.path.join(repo_path, path)),
+                       repo_path, repo_name, provider, override, prefilter=repo_prefilter(repo_name))
+    elif kind == "commits":
+        process_commits(repo_path, repo_name, provider, override)
+    elif kind == "finalize":
+        insert_repo(repo_name)
+        backfill(repo_name, provider, override)
+    else:
+        raise ValueError(f"Unknown job kind '{kind}'")
+
+
+class Heartbeat(threading.Thread):
+    """
+    Extends the lease of a running job until stopped.
+    """
+
+    def __init__(self, job_id, worker_id):
+        super().__init__(daemon=True)
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(HEARTBEAT_SECONDS):
+            try:
+                execute(HEARTBEAT_JOB, (LEASE_SECONDS,
+                        self.job_id, self.worker_id))
+            except Exception as e:
+                print(f"Heartbeat for job {self.job_id} failed: {e}")
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def work(worker_id, stop):
+    while not stop.is_set():
+        released = execute(RELEASE_STALE_JOBS, (MAX_ATTEMPTS,), fetch=True)
+        if released:
+            print(f"Released {len(released)} stale job(s).")
+
+        rows = execute(CLAIM_JOB, (worker_id, LEASE_SECONDS), fetch=True)
+        if not rows:
+            stop.wait(POLL_SECONDS)
+            continue
+
+        job_id, repo_name, kind, path, parent, provider, override = rows[0]
+        print(f"[{worker_id}] {kind} {repo_name}:{path}")
+        heartbeat = Heartbeat(job_id, worker_id)
+        heartbeat.start()
+        try:
+            run_job(repo_name, kind, path, parent, provider, override)
+        except Exception as e:
+            print(f"[{worker_id}] {kind} {repo_name}:{path} failed: {e}")
+            heartbeat.stop()
+            execute(FAIL_JOB, (MAX_ATTEMPTS, str(e)[:2000], job_id, worker_id))
+        else:
+            heartbeat.stop()
+            execute(FINISH_JOB, (job_id, worker_id))
+
+
+def run_workers(concurrency, exit_when_idle=False):
+    """
+    Runs `concurrency` worker threads in this process. Start this on as many machines as
+    needed; they only share the database (and each needs the repos checked out under repos/).
+    """
+    stop = threading.Event()
+    base_id = f"{socket.gethostname()}:{os.getpid()}"
+    threads = [threading.Thread(target=work, args=(f"{base_id}:{i}", stop), daemon=True)
+               for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    try:
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(POLL_SECONDS)
+            if exit_when_idle and not execute(
+                    """SELECT 1 FROM jobs WHERE "status" IN ('queued', 'running') LIMIT 1""", fetch=True):
+                break
+    except KeyboardInterrupt:
+        print("Stopping workers after their current jobs...")
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+
+def print_status():
+    rows = execute(FETCH_STATUS, fetch=True)
+    if not rows:
+        print("No jobs.")
+    for repo_name, kind, status, count in rows:
+        print(f"{repo_name:<30} {kind:<10} {status:<10} {count}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Queue repositories for ingestion and run ingestion workers.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    enqueue_parser = subparsers.add_parser(
+        "enqueue", help="Queue repositories for ingestion.")
+    enqueue_parser.add_argument(
+        "repos", nargs="+", help="The repositories to queue.")
+    enqueue_parser.add_argument(
+        "--provider", choices=['openai', 'ubicloud'], help="Specify the provider.")
+    enqueue_parser.add_argument(
+        "--override", help="Enable override mode, which accepts a timestamp for updated_at")
+
+    work_parser = subparsers.add_parser(
+        "work", help="Claim and run jobs until interrupted.")
+    work_parser.add_argument("--concurrency", type=int, default=2,
+                             help="Worker threads in this process.")
+    work_parser.add_argument("--exit-when-idle", action="store_true",
+                             help="Stop once no job is queued or running.")
+
+    subparsers.add_parser("status", help="Show job counts per repo and status.")
+
+    args = parser.parse_args()
+    if args.command == "enqueue":
+        for repo_name in args.repos:
+            enqueue_repo(repo_name, args.provider, args.override)
+    elif args.command == "work":
+        run_workers(args.concurrency, args.exit_when_idle)
+        print_summary()
+    else:
+        print_status()
+
+    connection_pool.closeall()
@@ -0,0 +1,155 @@
+import time
+import threading
+import psycopg2
+from psycopg2.extras import execute_values
+from metrics import registry, span
+
+# Rows buffered before a flush
+BATCH_SIZE = 200
+# A partly filled buffer is flushed by the next write after this many seconds
+FLUSH_SECONDS = 5
+
+
+class WriteBehind:
+    """
+    Buffers upserts and writes them in one transaction per flush, with one execute_values
+    round trip per statement (statements use `VALUES %s`). Rows are keyed: a row queued
+    again before a flush replaces the earlier one, since ON CONFLICT DO UPDATE can't
+    affect the same row twice in one statement.
+
+    Rows can name the journal item (kind, key) they belong to. When a flush fails on the
+    data, the batch is split in halves, keeping each item's rows together, until the bad
+    item is found: the other rows are written and the bad item's rows (its journal entry
+    included) are dropped and reported to `on_error(item, error)`. When the database
+    can't be reached, the rows are kept for the next flush instead.
+
+    Callers must `flush()` before anything reads the rows back from the database. A flush
+    triggered by `add` doesn't raise into whichever item happened to trigger it: its rows
+    stay queued for the next flush, and the final `flush()` raises if they still fail.
+    """
+
+    def __init__(self, pool_connection, batch_size=BATCH_SIZE, flush_seconds=FLUSH_SECONDS, on_error=None):
+        self.pool_connection = pool_connection
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.on_error = on_error
+        self.lock = threading.Lock()
+        # Serializes flushes, so statements are applied in the order their rows were queued
+        self.flush_lock = threading.Lock()
+        # statement -> {key: (row, item)}
+        self.pending = {}
+        self.count = 0
+        self.flushed_at = time.monotonic()
+        # After a failed flush, writes wait flush_seconds before flushing again
+        self.failed_at = None
+
+    def add(self, statement, key, row, item=None):
+        with self.lock:
+            rows = self.pending.setdefault(statement, {})
+            if key not in rows:
+                self.count += 1
+            rows[key] = (row, item)
+            now = time.monotonic()
+            due = self.count >= self.batch_size or now - \
+                self.flushed_at >= self.flush_seconds
+            if self.failed_at is not None and now - self.failed_at < self.flush_seconds:
+                due = False
+        if due:
+            try:
+                self.flush()
+                self.failed_at = None
+            except Exception as e:
+                self.failed_at = time.monotonic()
+                registry.inc("write_behind_flush_errors_total")
+                print(f"Write-behind flush failed, retrying with the next one: {e}")
+
+    def _requeue(self, pending):
+        with self.lock:
+            for statement, rows in pending.items():
+                queued = self.pending.setdefault(statement, {})
+                for key, row in rows.items():
+                    if key not in queued:
+                        queued[key] = row
+                        self.count += 1
+
+    def _execute(self, pending):
+        with span("write_behind_flush"), self.pool_connection() as conn:
+            try:
+                with conn.cursor() as cur:
+                    for statement, keyed_rows in pending.items():
+                        execute_values(cur, statement, [row for row, _ in keyed_rows.values()],
+                                       page_size=self.batch_size)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+    @staticmethod
+    def _groups(pending):
+        """
+        Splits a batch into [(item, pending)] groups, one per journal item; rows without an
+        item form a group of their own.
+        """
+        groups = {}
+        for statement, keyed_rows in pending.items():
+            for key, (row, item) in keyed_rows.items():
+                group = groups.setdefault(
+                    item if item is not None else (statement, key), (item, {}))
+                group[1].setdefault(statement, {})[key] = (row, item)
+        return list(groups.values())
+
+    def _isolate(self, groups):
+        """
+        Writes the groups, halving the batch whenever it fails; a group that fails on its
+        own is dropped. Returns the number of rows written.
+        """
+        pending = {}
+        for _, group in groups:
+            for statement, keyed_rows in group.items():
+                pending.setdefault(statement, {}).update(keyed_rows)
+        try:
+            self._execute(pending)
+            return sum(len(r) for r in pending.values())
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self._requeue(pending)
+            raise
+        except Exception as e:
+            if len(groups) > 1:
+                middle = len(groups) // 2
+                return self._isolate(groups[:middle]) + self._isolate(groups[middle:])
+            item = groups[0][0]
+            keys = [key for keyed_rows in pending.values() for key in keyed_rows]
+            registry.inc("write_behind_rows_dropped_total", len(keys))
+            print(f"Dropping write-behind rows {keys}: {e}")
+            if item is not None and self.on_error:
+                try:
+                    self.on_error(item, e)
+                except Exception as report_error:
+                    print(f"Error reporting the failure of {item}: {report_error}")
+            return 0
+
+    def flush(self):
+        """
+        Writes everything buffered so far. When the database can't be reached the rows are
+        queued again (unless a newer version arrived meanwhile) and the error is raised;
+        any other failure drops only the rows of the item that caused it.
+        """
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending, self.count = self.pending, {}, 0
+                self.flushed_at = time.monotonic()
+            rows = sum(len(r) for r in pending.values())
+            if not rows:
+                return 0
+
+            try:
+                self._execute(pending)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                self._requeue(pending)
+                raise
+            except Exception as e:
+                print(f"Write-behind flush failed ({e}), looking for the bad rows")
+                rows = self._isolate(self._groups(pending))
+            registry.inc("write_behind_flushes_total")
+            registry.inc("write_behind_rows_total", rows)
+            return rows